@@ -17,6 +17,7 @@ if __name__ == "__main__":
                                                    "otherwise bind to 127.0.0.1 (localhost). "
                                                    "This maybe necessary in systems that only run Flask"))
     args = parser.parse_args()
+    app.extensions['warmup'].start()
 
     if args.all_addresses:
         bind_host = '0.0.0.0'
@@ -0,0 +1,212 @@
+import fcntl
+import logging
+import math
+import os
+import threading
+import time as timer
+from contextlib import contextmanager
+
+import pywps.configuration as config
+
+from .settings import config_number
+
+LOG = logging.getLogger('PYWPS')
+
+
+class Busy(Exception):
+    """ The server is at capacity for the requested process. """
+
+
+class SlotSet:
+    """
+    `size` slots shared by every worker process on a host, one lock file each. A slot is
+    held for as long as its file is locked, and the lock goes away with the process holding it.
+    """
+
+    def __init__(self, path, name, size):
+        os.makedirs(path, exist_ok=True)
+        self.filenames = [os.path.join(path, f"{name}.{index}.lock") for index in range(size)]
+
+    def try_acquire(self, count, held=()):
+        """ File descriptors locking `count` more slots, or `None` if there are not enough free. """
+        taken = []
+        for filename in self.filenames:
+            if len(taken) == count:
+                break
+            if filename in held:
+                continue
+            fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            taken.append((filename, fd))
+        if len(taken) < count:
+            self.release(taken)
+            return None
+        return taken
+
+    @staticmethod
+    def release(taken):
+        for _, fd in taken:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+class Ticket:
+    """ The slots one request holds for a process, growing as its cost becomes known. """
+
+    def __init__(self, controller, identifier):
+        self.controller = controller
+        self.identifier = identifier
+        self.slots = []
+
+    @property
+    def weight(self):
+        return len(self.slots)
+
+    def grow(self, weight):
+        """ Hold at least `weight` slots, waiting in the bounded queue for them if need be. """
+        weight = min(weight, self.controller.cap(self.identifier))
+        if weight <= self.weight:
+            return
+        taken = self.controller.acquire(self.identifier, weight - self.weight,
+                                        held={filename for filename, _ in self.slots}, wait=False)
+        if taken is None:
+            # waiting for more slots while holding some deadlocks with another request doing the same,
+            # so the whole weight is waited for with none held
+            self.release()
+            taken = self.controller.acquire(self.identifier, weight)
+        self.slots += taken
+
+    def shrink(self, weight):
+        while self.weight > max(weight, 0):
+            SlotSet.release([self.slots.pop()])
+
+    def release(self):
+        self.shrink(0)
+
+
+class AdmissionController:
+    """
+    Per process concurrency limits across the gunicorn workers of a host. Each process
+    identifier has `cap` slots and requests hold one slot per unit of their estimated cost.
+    A request that finds no free slot waits, if one of the `queue` places in line is free,
+    for up to `max_wait` seconds, and is turned away as `Busy` otherwise. The places in line
+    are shared by all processes, a waiting request ties up a worker whatever it waits for.
+    """
+
+    def __init__(self, path, caps=None, default_cap=8, queue=8, max_wait=30.0, poll=0.05):
+        self.path = path
+        self.caps = caps or {}
+        self.default_cap = default_cap
+        self.queue = queue
+        self.max_wait = max_wait
+        self.poll = poll
+        self._sets = {}
+        self._lock = threading.Lock()
+
+    def cap(self, identifier):
+        return self.caps.get(identifier, self.default_cap)
+
+    def _slots(self, name, size):
+        with self._lock:
+            if name not in self._sets:
+                self._sets[name] = SlotSet(self.path, name, size)
+            return self._sets[name]
+
+    def acquire(self, identifier, count, held=(), wait=True):
+        """ `count` more slots of `identifier`, or `None` without them free and `wait` false. """
+        slots = self._slots(identifier, self.cap(identifier))
+        taken = slots.try_acquire(count, held)
+        if taken is not None or not wait:
+            return taken
+
+        # wait in line, if there is room in it
+        place = self._slots("queue", self.queue).try_acquire(1) if self.queue else None
+        if place is None:
+            LOG.warning("turning away a %s request, its queue is full", identifier)
+            raise Busy(f"{identifier} is at capacity")
+        try:
+            deadline = timer.monotonic() + self.max_wait
+            while timer.monotonic() < deadline:
+                timer.sleep(self.poll)
+                taken = slots.try_acquire(count, held)
+                if taken is not None:
+                    return taken
+        finally:
+            SlotSet.release(place)
+        raise Busy(f"{identifier} is at capacity, gave up after waiting {self.max_wait}s")
+
+    @contextmanager
+    def admit(self, identifier, weight=1):
+        """
+        Hold `weight` slots of `identifier` for the duration. Within a request already
+        admitted for the same process, its ticket grows instead, and shrinks back afterwards.
+        """
+        ticket = getattr(_CURRENT, "ticket", None)
+        if ticket is not None and ticket.identifier == identifier:
+            before = ticket.weight
+            ticket.grow(weight)
+            try:
+                yield ticket
+            finally:
+                ticket.shrink(before)
+            return
+
+        ticket = Ticket(self, identifier)
+        ticket.grow(weight)
+        _CURRENT.ticket = ticket
+        try:
+            yield ticket
+        finally:
+            _CURRENT.ticket = None
+            ticket.release()
+
+
+_CURRENT = threading.local()
+
+_CONTROLLER = []
+_CONTROLLER_LOCK = threading.Lock()
+
+
+def cost_weight(plan):
+    # a request holds one slot per `weight_gb` it is estimated to load
+    unit = config_number("admission", "weight_gb", 2.0) * 1.0e9
+    return max(1, math.ceil(plan.load_bytes / unit))
+
+
+def _caps(value):
+    # "WIT:2, Mangrove Cover Drill:4"
+    items = [item.rsplit(":", 1) for item in value.split(",") if item.strip()]
+    return {identifier.strip(): int(cap) for identifier, cap in items}
+
+
+def admission_controller():
+    """ The configured admission controller, or `None` if admission control is disabled. """
+    with _CONTROLLER_LOCK:
+        if not _CONTROLLER:
+            default_cap = config_number("admission", "default_cap", 0, int)
+            _CONTROLLER.append(AdmissionController(
+                config.get_config_value("admission", "path", "") or "/tmp/datacube-wps-admission",
+                caps=_caps(config.get_config_value("admission", "caps", "") or ""),
+                default_cap=default_cap,
+                queue=config_number("admission", "queue", 4, int),
+                max_wait=config_number("admission", "max_wait", 30.0),
+            ) if default_cap > 0 else None)
+        return _CONTROLLER[0]
+
+
+@contextmanager
+def admit(identifier, weight=1):
+    """ Admission of a request for `identifier` with `weight` units of cost, a no-op when disabled. """
+    controller = admission_controller()
+    if controller is None:
+        yield None
+        return
+    with controller.admit(identifier, weight) as ticket:
+        yield ticket
+
+
+os.register_at_fork(after_in_child=_CONTROLLER.clear)
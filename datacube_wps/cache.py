@@ -0,0 +1,297 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pywps.configuration as config
+from botocore.exceptions import ClientError
+from datacube.api.core import output_geobox
+from datacube.virtual.impl import VirtualProduct
+from prometheus_client import Counter
+
+from .settings import config_number
+
+LOG = logging.getLogger('PYWPS')
+
+CACHE_LOOKUPS = Counter('datacube_wps_result_cache_lookups_total',
+                        'Result cache lookups by outcome',
+                        ['process', 'outcome'])
+
+METADATA_KEY = b'datacube_wps'
+
+
+# the settings of a virtual product that decide the grid its pixels are loaded on
+GRID_KEYS = ("output_crs", "resolution", "align")
+
+
+def _round(coords, digits):
+    if isinstance(coords, (list, tuple)):
+        return [_round(c, digits) for c in coords]
+    return round(float(coords), digits)
+
+
+def _grid_settings(product, inherited=None):
+    # the first source product, with the grid settings it is loaded with
+    settings = {**(inherited or {}), **{key: product[key] for key in GRID_KEYS if key in product}}
+    if "product" in product:
+        return product["product"], settings
+    for value in product.values():
+        children = value if isinstance(value, (list, tuple)) else [value]
+        for child in children:
+            if isinstance(child, VirtualProduct):
+                return _grid_settings(child, settings)
+    return None, settings
+
+
+def pixel_geobox(product, feature, dc=None):
+    """
+    The pixels `product` loads for `feature`, as the virtual product would group them, or `None`
+    if that takes the product definition from the index and `dc` is not given.
+    """
+    name, settings = _grid_settings(product)
+    grid_spec = None
+    if "output_crs" not in settings:
+        if dc is None or name is None:
+            return None
+        grid_spec = dc.index.products.get_by_name(name).grid_spec
+    try:
+        return output_geobox(grid_spec=grid_spec, geopolygon=feature, **settings)
+    except ValueError:
+        return None
+
+
+def _pixels(coords, inverse, point):
+    if isinstance(coords[0], (list, tuple)):
+        return [_pixels(c, inverse, point) for c in coords]
+    col, row = inverse * (coords[0], coords[1])
+    if point:
+        return [math.floor(col), math.floor(row)]
+    return [round(col, 3), round(row, 3)]
+
+
+def canonical_geometry(feature, geobox=None, digits=None):
+    # with the pixels being drilled, points are keyed by the pixel they fall in and other geometries
+    # by their vertices on the pixel grid, so that clicks on the same pixel share a cache entry
+    if geobox is not None:
+        geom = feature.to_crs(str(geobox.crs)).json
+        origin = geobox.affine * (0, 0)
+        return {"crs": str(geobox.crs),
+                "resolution": [geobox.affine.a, geobox.affine.e],
+                "origin": _round(origin, 6),
+                "type": geom["type"],
+                "coordinates": _pixels(geom["coordinates"], ~geobox.affine, geom["type"] == "Point")}
+
+    # otherwise coordinates are rounded to about the size of a pixel
+    if digits is None:
+        digits = config_number("cache", "precision", 4, int)
+    if not feature.crs.geographic:
+        digits = 0
+    geom = feature.json
+    return {"crs": str(feature.crs),
+            "type": geom["type"],
+            "coordinates": _round(geom["coordinates"], digits)}
+
+
+def request_key(identifier, version, feature, time_range, parameters, geobox=None, digits=None):
+    request = {
+        "identifier": identifier,
+        "version": version,
+        "geometry": canonical_geometry(feature, geobox, digits),
+        "time": None if time_range is None else [str(t) for t in time_range],
+        "parameters": parameters,
+    }
+    encoded = json.dumps(request, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def encode_frame(df, metadata):
+    table = pa.Table.from_pandas(df)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           METADATA_KEY: json.dumps(metadata).encode()})
+    sink = pa.BufferOutputStream()
+    pq.write_table(table, sink, compression="zstd")
+    return sink.getvalue()
+
+
+def decode_frame(body):
+    table = pq.read_table(pa.BufferReader(body))
+    metadata = json.loads(table.schema.metadata.get(METADATA_KEY, b'{}'))
+    return table.to_pandas(), metadata
+
+
+class LocalBackend:
+    """ Cache entries as files in a local directory, evicting least recently used. """
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + ".parquet")
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as fl:
+                body = fl.read()
+        except FileNotFoundError:
+            return None
+        self._touch(filename)
+        return body
+
+    @staticmethod
+    def _touch(filename):
+        # the modification time doubles as the last access time for eviction
+        now = time.time()
+        try:
+            os.utime(filename, (now, now))
+        except FileNotFoundError:
+            pass
+
+    def put(self, key, body):
+        filename = self._filename(key)
+        temporary = f"{filename}.{os.getpid()}.{threading.get_ident()}"
+        with open(temporary, 'wb') as fl:
+            fl.write(body)
+        os.replace(temporary, filename)
+        self._touch(filename)
+        self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._filename(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        if not self.max_bytes:
+            return
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.path):
+                if entry.name.endswith(".parquet"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+class S3Backend:
+    """
+    Cache entries as objects under a prefix of an S3 bucket. Size based eviction
+    is left to the bucket lifecycle rules.
+    """
+
+    def __init__(self, bucket, prefix="cache"):
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client = boto3.Session().client("s3")
+
+    def _key(self, key):
+        return f"{self.prefix}/{key}.parquet"
+
+    def get(self, key):
+        try:
+            response = self._client.get_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return response["Body"].read()
+
+    def put(self, key, body):
+        self._client.put_object(Bucket=self.bucket, Key=self._key(key), Body=bytes(body))
+
+    def delete(self, key):
+        self._client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+class ResultCache:
+    def __init__(self, backend, ttl=None):
+        self.backend = backend
+        self.ttl = ttl
+
+    def expired(self, metadata):
+        return bool(self.ttl) and time.time() - metadata.get("created", 0) > self.ttl
+
+    def get_entry(self, key, process="", include_expired=False):
+        try:
+            body = self.backend.get(key)
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception("result cache lookup failed")
+            body = None
+
+        if body is None:
+            CACHE_LOOKUPS.labels(process, "miss").inc()
+            return None, None
+
+        try:
+            df, metadata = decode_frame(body)
+        except Exception:  # pylint: disable=broad-except
+            # a truncated or otherwise unreadable entry is dropped, and computed again
+            LOG.exception("result cache entry %s is unreadable", key)
+            CACHE_LOOKUPS.labels(process, "miss").inc()
+            self.backend.delete(key)
+            return None, None
+
+        if not self.expired(metadata):
+            CACHE_LOOKUPS.labels(process, "hit").inc()
+        elif include_expired:
+            # expired entries can still be brought up to date incrementally
+            CACHE_LOOKUPS.labels(process, "stale").inc()
+        else:
+            CACHE_LOOKUPS.labels(process, "expired").inc()
+            self.backend.delete(key)
+            return None, None
+
+        return df, metadata
+
+    def get(self, key, process=""):
+        df, _ = self.get_entry(key, process)
+        return df
+
+    def put(self, key, df, metadata=None):
+        metadata = {**(metadata or {}), "created": time.time()}
+        try:
+            self.backend.put(key, encode_frame(df, metadata))
+        except Exception:  # pylint: disable=broad-except
+            # a failure to cache should never fail the request
+            LOG.exception("result cache store failed")
+
+
+_CACHE = {}
+
+
+def result_cache():
+    """ The configured result cache, or `None` if caching is disabled. """
+    backend = config.get_config_value("cache", "backend", "")
+    if not backend:
+        return None
+
+    if backend not in _CACHE:
+        ttl = config_number("cache", "ttl", 0.0)
+        if backend == "local":
+            max_bytes = config_number("cache", "max_bytes", 0, int)
+            store = LocalBackend(config.get_config_value("cache", "path", "cache"), max_bytes=max_bytes)
+        elif backend == "s3":
+            bucket = config.get_config_value("cache", "bucket", "") or config.get_config_value("s3", "bucket")
+            store = S3Backend(bucket, config.get_config_value("cache", "prefix", "cache"))
+        else:
+            raise ValueError(f"unknown result cache backend {backend}")
+        _CACHE[backend] = ResultCache(store, ttl=ttl)
+    return _CACHE[backend]
@@ -0,0 +1,195 @@
+import logging
+import os
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import pywps.configuration as config
+from dask.distributed import Client, LocalCluster
+from datacube.utils.rio import configure_s3_access
+
+from .settings import config_number
+
+LOG = logging.getLogger('PYWPS')
+
+DEFAULT_IDLE_TIMEOUT = 600.0
+
+
+def num_workers():
+    return int(os.getenv("DATACUBE_WPS_NUM_WORKERS", "4"))
+
+
+def cluster_settings(kind):
+    # pixel drills read a handful of pixels per time slice and are I/O bound,
+    # polygon drills are CPU bound and need the GIL released across processes
+    if kind == "pixel":
+        return dict(n_workers=1,
+                    processes=False,
+                    threads_per_worker=config_number("dask", "pixel_threads", num_workers(), int))
+    if kind == "polygon":
+        return dict(n_workers=config_number("dask", "polygon_workers", num_workers(), int),
+                    processes=True,
+                    threads_per_worker=config_number("dask", "polygon_threads_per_worker", 1, int))
+    raise ValueError(f"unknown cluster kind {kind}")
+
+
+def stream_slices():
+    # time slices a streaming polygon drill has in flight at once, one per thread of the cluster by default
+    settings = cluster_settings("polygon")
+    return config_number("dask", "stream_slices", settings["n_workers"] * settings["threads_per_worker"], int)
+
+
+class ClusterPool:
+    """
+    Lazily created, long-lived Dask clusters shared by all requests of a single
+    (gunicorn) worker process.
+    """
+
+    def __init__(self, idle_timeout=None):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._in_use = {}
+        self._timers = {}
+        # futures of the clusters being started, by kind
+        self._starting = {}
+        self._idle_timeout = idle_timeout
+
+    @property
+    def idle_timeout(self):
+        if self._idle_timeout is None:
+            return config_number("dask", "idle_timeout", DEFAULT_IDLE_TIMEOUT)
+        return self._idle_timeout
+
+    def _start(self, kind):
+        settings = cluster_settings(kind)
+        memory_limit = config.get_config_value("dask", "memory_limit", "auto") or "auto"
+        LOG.info("starting %s dask cluster %s", kind, settings)
+        cluster = LocalCluster(memory_limit=memory_limit, dashboard_address=None, **settings)
+        client = Client(cluster, set_as_default=False)
+        configure_s3_access(
+            aws_unsigned=True,
+            region_name=os.getenv("AWS_DEFAULT_REGION", "auto"),
+            client=client,
+        )
+        return client
+
+    @staticmethod
+    def _dead(client):
+        # the scheduler is gone or unreachable, a worker the nanny is restarting does not count
+        if client.status != "running":
+            return True
+        cluster = client.cluster
+        return cluster is not None and cluster.status.name in ("closing", "closed", "failed")
+
+    @staticmethod
+    def _close(kind, client):
+        LOG.info("shutting down %s dask cluster", kind)
+        cluster = client.cluster
+        try:
+            try:
+                client.close()
+            finally:
+                if cluster is not None:
+                    cluster.close()
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception("failed to shut down %s dask cluster", kind)
+
+    def acquire(self, kind):
+        with self._lock:
+            timer = self._timers.pop(kind, None)
+            if timer is not None:
+                timer.cancel()
+            # counted in use from here, so that it is not shut down as idle while starting
+            self._in_use[kind] = self._in_use.get(kind, 0) + 1
+
+            dead = None
+            client = self._clients.get(kind)
+            if client is not None and self._dead(client):
+                LOG.warning("%s dask cluster is dead, restarting", kind)
+                dead, client = self._clients.pop(kind), None
+
+            starting = self._starting.get(kind)
+            owner = client is None and starting is None
+            if owner:
+                starting = self._starting[kind] = Future()
+
+        if dead is not None:
+            self._close(kind, dead)
+        if client is not None:
+            return client
+
+        # started outside the lock, other requests for it wait on the same start
+        try:
+            if not owner:
+                return starting.result()
+            try:
+                client = self._start(kind)
+            except BaseException as e:
+                starting.set_exception(e)
+                raise
+            finally:
+                with self._lock:
+                    del self._starting[kind]
+                    if client is not None:
+                        self._clients[kind] = client
+            starting.set_result(client)
+            return client
+        except BaseException:
+            with self._lock:
+                self._in_use[kind] -= 1
+            raise
+
+    def release(self, kind):
+        with self._lock:
+            self._in_use[kind] -= 1
+            if self._in_use[kind] > 0 or self.idle_timeout <= 0:
+                return
+
+            timer = threading.Timer(self.idle_timeout, self._shutdown_if_idle, args=(kind,))
+            timer.daemon = True
+            self._timers[kind] = timer
+            timer.start()
+
+    def _shutdown_if_idle(self, kind):
+        with self._lock:
+            if self._in_use.get(kind, 0) > 0:
+                return
+            self._timers.pop(kind, None)
+            client = self._clients.pop(kind, None)
+        if client is not None:
+            self._close(kind, client)
+
+    def is_running(self, kind):
+        with self._lock:
+            return kind in self._clients
+
+    def shutdown(self):
+        with self._lock:
+            for timer in self._timers.values():
+                timer.cancel()
+            self._timers.clear()
+            clients, self._clients = self._clients, {}
+        for kind, client in clients.items():
+            self._close(kind, client)
+
+    def _reset(self):
+        # clusters belong to the parent process, a forked child starts with none
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._in_use = {}
+        self._timers = {}
+        self._starting = {}
+
+
+POOL = ClusterPool()
+os.register_at_fork(after_in_child=POOL._reset)  # pylint: disable=protected-access
+
+
+@contextmanager
+def cluster_client(kind):
+    client = POOL.acquire(kind)
+    try:
+        with client.as_current():
+            yield client
+    finally:
+        POOL.release(kind)
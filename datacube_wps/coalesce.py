@@ -0,0 +1,130 @@
+import copy
+import fcntl
+import logging
+import os
+import threading
+import time as timer
+from contextlib import contextmanager
+
+import pywps.configuration as config
+from prometheus_client import Counter
+
+from .settings import config_bool, config_number
+
+LOG = logging.getLogger('PYWPS')
+
+COALESCED_REQUESTS = Counter('datacube_wps_coalesced_requests_total',
+                             'Drills that waited on an identical drill in flight, by where it ran',
+                             ['process', 'scope'])
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs one computation at a time per key. Identical requests arriving at a worker while one
+    is in flight wait for it and share its result. With `path`, the leaders on different worker
+    processes also take turns through a lock file per key, so that a leader that waited can pick
+    up the result the first one left in a shared store (such as the result cache) instead of
+    computing it again. Nobody waits longer than `timeout` seconds for either, and computes the
+    result itself instead.
+    """
+
+    def __init__(self, path=None, timeout=300.0, poll=0.05):
+        self.path = path
+        self.timeout = timeout
+        self.poll = poll
+        self._lock = threading.Lock()
+        self._flights = {}
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    @contextmanager
+    def _file_lock(self, key, process):
+        filename = os.path.join(self.path, f"{key}.lock")
+        deadline = timer.monotonic() + self.timeout
+        waited = False
+        while True:
+            fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                if timer.monotonic() > deadline:
+                    LOG.warning("gave up waiting on the drill in flight for %s", key)
+                    yield
+                    return
+                if not waited:
+                    waited = True
+                    COALESCED_REQUESTS.labels(process, "host").inc()
+                timer.sleep(self.poll)
+                continue
+            # the previous holder removes the file before unlocking it, so the lock may be on a stale file
+            try:
+                if os.fstat(fd).st_ino == os.stat(filename).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+        try:
+            yield
+        finally:
+            os.remove(filename)
+            os.close(fd)
+
+    def run(self, key, compute, process="", across_workers=True):
+        """ The result of `compute()`, shared with any identical call made while it runs. """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            COALESCED_REQUESTS.labels(process, "worker").inc()
+            if not flight.done.wait(self.timeout):
+                LOG.warning("gave up waiting on the drill in flight for %s", key)
+                return compute()
+            if flight.error is not None:
+                raise flight.error
+            # callers are free to modify what they are given, the shared result is never handed out
+            return copy.copy(flight.result)
+
+        try:
+            if across_workers and self.path is not None:
+                with self._file_lock(key, process):
+                    flight.result = compute()
+            else:
+                flight.result = compute()
+            return copy.copy(flight.result)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+_SINGLE_FLIGHT = []
+_SINGLE_FLIGHT_LOCK = threading.Lock()
+
+
+def single_flight():
+    """ The request coalescing of this worker, or `None` if it is disabled. """
+    with _SINGLE_FLIGHT_LOCK:
+        if not _SINGLE_FLIGHT:
+            enabled = config_bool("coalesce", "enabled", False)
+            _SINGLE_FLIGHT.append(SingleFlight(config.get_config_value("coalesce", "path", "") or None,
+                                               timeout=config_number("coalesce", "timeout", 300.0))
+                                  if enabled else None)
+        return _SINGLE_FLIGHT[0]
+
+
+os.register_at_fork(after_in_child=_SINGLE_FLIGHT.clear)
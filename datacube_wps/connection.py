@@ -0,0 +1,96 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+import datacube
+from sqlalchemy import event, exc, select
+
+from .settings import config_bool
+
+LOG = logging.getLogger('PYWPS')
+
+APPLICATION_NAME = "datacube-wps"
+
+
+def _engine(dc):
+    # the SQLAlchemy engine behind a postgres or postgis index
+    db = getattr(dc.index, "_db", None)
+    return getattr(db, "_engine", None)
+
+
+def ping_before_use(engine):
+    """
+    Check that each connection `engine` hands out is still alive, reconnecting if the database
+    dropped it, as the `pool_pre_ping` of SQLAlchemy would for an engine created with it.
+    """
+    @event.listens_for(engine, "engine_connect")
+    def ping(connection):
+        try:
+            connection.scalar(select(1))
+        except exc.DBAPIError as e:
+            if not e.connection_invalidated:
+                raise
+            # the dead connection was invalidated, the connection reconnects on its next use
+            connection.scalar(select(1))
+
+    return engine
+
+
+def _connect():
+    # the pool of the index is the one datacube sets up, recycling connections
+    # after its db_connection_timeout
+    dc = datacube.Datacube(app=APPLICATION_NAME)
+    engine = _engine(dc)
+    if engine is not None and config_bool("index", "pre_ping", True):
+        ping_before_use(engine)
+    return dc
+
+
+class DatacubeProvider:
+    """
+    A single datacube connection per worker process, shared by all of its request threads.
+    The index checks out a pooled database connection for each query, so configuration
+    parsing and connection setup happen once per worker rather than once per request.
+    """
+
+    def __init__(self, factory=_connect):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._datacube = None
+
+    def get(self):
+        with self._lock:
+            if self._datacube is None:
+                LOG.info("connecting to the datacube index")
+                self._datacube = self._factory()
+            return self._datacube
+
+    @contextmanager
+    def datacube(self):
+        # the connection outlives the request, it is not closed on exit
+        yield self.get()
+
+    def close(self):
+        with self._lock:
+            dc, self._datacube = self._datacube, None
+        if dc is not None:
+            dc.close()
+
+    def _reset(self):
+        # connections belong to the parent process, a forked child must neither use nor close them
+        dc, self._datacube = self._datacube, None
+        self._lock = threading.Lock()
+        engine = None if dc is None else _engine(dc)
+        if engine is not None:
+            engine.dispose(close=False)
+
+
+DATACUBE = DatacubeProvider()
+
+os.register_at_fork(after_in_child=DATACUBE._reset)  # pylint: disable=protected-access
+
+
+def shared_datacube():
+    """ The datacube of this worker process, as a context manager standing in for `datacube.Datacube()`. """
+    return DATACUBE.datacube()
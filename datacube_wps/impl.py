@@ -1,4 +1,7 @@
+import io
 import os
+import re
+import uuid
 
 import flask
 import yaml
@@ -6,7 +9,11 @@ from datacube.utils import import_function
 from datacube.virtual import construct
 from pywps import Service
 
+from .admission import Busy, admit
+from .publish import PUBLISHER
+from .render import MIMETYPES
 from .startup_utils import initialise_prometheus, setup_logger, setup_sentry
+from .warmup import Warmup
 
 
 def create_process(process, input, **settings):
@@ -21,6 +28,25 @@ def read_process_catalog(catalog_filename):
     return [create_process(**settings) for settings in config['processes']]
 
 
+def execute_identifier(request):
+    """ The identifier of the process a WPS Execute request runs, `None` for other requests. """
+    args = {key.lower(): value for key, value in request.args.items()}
+    if args.get('request', '').lower() == 'execute':
+        return args.get('identifier')
+    if request.method != 'POST':
+        return None
+
+    body = request.get_data(cache=True)
+    # the body is read again by pywps
+    request.environ['wsgi.input'] = io.BytesIO(body)
+    request.environ['CONTENT_LENGTH'] = str(len(body))
+    execute = re.search(rb'<(?:\w+:)?Execute[\s>]', body)
+    identifier = re.search(rb'<(?:\w+:)?Identifier[^>]*>([^<]+)<', body)
+    if execute is None or identifier is None:
+        return None
+    return identifier.group(1).decode().strip()
+
+
 def create_app():
     # pylint: disable=unused-variable
 
@@ -32,7 +58,9 @@ def create_app():
 
     metrics = initialise_prometheus(app)
 
-    service = []
+    warmup = Warmup(lambda: Service(read_process_catalog('datacube-wps-config.yaml'), ['pywps.cfg']))
+    # started by the gunicorn worker hooks, see gunicorn.conf.py
+    app.extensions['warmup'] = warmup
 
     @app.after_request
     def apply_cors(response):
@@ -45,14 +73,28 @@ def create_app():
         if flask.request.method == 'HEAD':
             return ""
 
-        if not service:
-            service.append(Service(read_process_catalog('datacube-wps-config.yaml'), ['pywps.cfg']))
-        return service[0]
+        service = warmup.service()
+        identifier = execute_identifier(flask.request)
+        if identifier is None:
+            return service
+
+        # executions wait for room among those of the same process on this host, or are turned away
+        try:
+            with admit(identifier):
+                return flask.Response.force_type(service, flask.request.environ)
+        except Busy as e:
+            return flask.Response(f"{e}\n", status=503, headers={'Retry-After': '5'})
 
     @app.route('/ping')
     def ping():
         return "WPS is alive\n"
 
+    @app.route('/ready')
+    def ready():
+        # unlike /ping, only succeeds once the worker has warmed up
+        status = 200 if warmup.ready else 503
+        return flask.jsonify(ready=warmup.ready, steps=warmup.state), status
+
     @app.route('/outputs/' + '<path:filename>')
     def outputfile(filename):
         targetfile = os.path.join('outputs', filename)
@@ -67,6 +109,21 @@ def create_app():
 
         flask.abort(404)
 
+    @app.route('/charts/<name>/chart.<format>')
+    def chart(name, format):
+        # deferred charts are rendered on first fetch
+        if format not in MIMETYPES:
+            flask.abort(404)
+        try:
+            name = str(uuid.UUID(name))
+        except ValueError:
+            flask.abort(404)
+
+        body = PUBLISHER.deferred_chart(name, format)
+        if body is None:
+            flask.abort(404)
+        return flask.Response(body, content_type=MIMETYPES[format])
+
     @app.route('/debug-sentry')
     def trigger_error():
         division_by_zero = 1 / 0
@@ -0,0 +1,40 @@
+from contextlib import nullcontext
+from functools import wraps
+
+from prometheus_client import Histogram
+
+STAGE_SECONDS = Histogram('datacube_wps_stage_seconds',
+                          'Seconds spent in each stage of a request, by process',
+                          ['process', 'stage'],
+                          buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                                   10.0, 30.0, 60.0, 120.0, 300.0, 600.0, float("inf")))
+
+# stages are only timed once prometheus metrics are set up, see initialise_prometheus
+_TIMING = []
+
+
+def enable_stage_timing():
+    if not _TIMING:
+        _TIMING.append(True)
+
+
+def stage(process, name):
+    """ Times stage `name` of a request for the process identified by `process`, a no-op unless enabled. """
+    if not _TIMING:
+        return nullcontext()
+    return STAGE_SECONDS.labels(process, name).time()
+
+
+def timed(name):
+    """ Times a method of a process as stage `name` of its requests. """
+    def decorate(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not _TIMING:
+                return func(self, *args, **kwargs)
+            with STAGE_SECONDS.labels(self.about.get("identifier", ""), name).time():
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorate
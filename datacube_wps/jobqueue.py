@@ -0,0 +1,168 @@
+import collections
+import logging
+import os
+import sqlite3
+import threading
+import time as timer
+from contextlib import contextmanager
+
+import pywps.configuration as config
+from pywps.response.status import WPS_STATUS
+
+from .settings import config_number
+
+LOG = logging.getLogger('PYWPS')
+
+Job = collections.namedtuple("Job", ["uuid", "identifier", "request", "attempts", "max_attempts"])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    uuid TEXT PRIMARY KEY,
+    identifier TEXT NOT NULL,
+    request TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker TEXT,
+    enqueued REAL NOT NULL,
+    available REAL NOT NULL,
+    lease REAL,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, priority, enqueued);
+"""
+
+
+class JobQueue:
+    """
+    Asynchronous executions waiting for, or held by, a `datacube-wps-worker`, in a SQLite
+    database shared by the web workers and job workers of a host. Jobs are claimed highest priority first,
+    then oldest first. A claim is a lease of `lease` seconds that the worker renews while it
+    runs the job, and the job of a worker that stops renewing it is claimed again.
+    """
+
+    def __init__(self, path, lease=300.0, timeout=30.0):
+        self.path = path
+        self.lease = lease
+        self.timeout = timeout
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # autocommit, transactions are started explicitly
+        db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def enqueue(self, uuid, identifier, request, rank=0, max_attempts=3):
+        now = timer.time()
+        with self._connect() as db:
+            db.execute("INSERT INTO jobs"
+                       " (uuid, identifier, request, priority, state, max_attempts, enqueued, available)"
+                       " VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                       (str(uuid), identifier, request, rank, max_attempts, now, now))
+
+    def claim(self, worker):
+        """ The next job to run, leased to `worker`, or `None` if there is none. """
+        now = timer.time()
+        with self._connect() as db:
+            # take the write lock up front, so that two workers never claim the same job
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT uuid, identifier, request, attempts, max_attempts FROM jobs"
+                                 " WHERE (state = 'queued' AND available <= ?) OR (state = 'running' AND lease < ?)"
+                                 " ORDER BY priority DESC, enqueued LIMIT 1", (now, now)).fetchone()
+                if row is not None:
+                    db.execute("UPDATE jobs SET state = 'running', worker = ?, lease = ?, attempts = attempts + 1"
+                               " WHERE uuid = ?", (worker, now + self.lease, row[0]))
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+        if row is None:
+            return None
+        uuid, identifier, request, attempts, max_attempts = row
+        return Job(uuid, identifier, request, attempts + 1, max_attempts)
+
+    def renew(self, uuid, worker):
+        """ Extend the lease of `worker` on a job, `False` if the job is no longer leased to it. """
+        with self._connect() as db:
+            cursor = db.execute("UPDATE jobs SET lease = ? WHERE uuid = ? AND worker = ? AND state = 'running'",
+                                (timer.time() + self.lease, uuid, worker))
+            return cursor.rowcount > 0
+
+    def _finish(self, uuid, worker, state, message=None, available=None):
+        # only by the worker holding the job, `False` if it is no longer leased to it
+        with self._connect() as db:
+            cursor = db.execute("UPDATE jobs SET state = ?, message = ?, lease = NULL,"
+                                " available = COALESCE(?, available)"
+                                " WHERE uuid = ? AND worker = ? AND state = 'running'",
+                                (state, message, available, uuid, worker))
+            return cursor.rowcount > 0
+
+    def complete(self, uuid, worker):
+        return self._finish(uuid, worker, "succeeded")
+
+    def fail(self, uuid, worker, message):
+        return self._finish(uuid, worker, "failed", message)
+
+    def retry(self, uuid, worker, message, delay=0.0):
+        """ Put a job back in the queue, to be claimed again after `delay` seconds. """
+        return self._finish(uuid, worker, "queued", message, timer.time() + delay)
+
+    def counts(self):
+        with self._connect() as db:
+            return dict(db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+
+def _priorities(value):
+    # "WOfSDrill:10, WIT:0"
+    items = [item.rsplit(":", 1) for item in value.split(",") if item.strip()]
+    return {identifier.strip(): int(priority) for identifier, priority in items}
+
+
+def priority(identifier):
+    priorities = _priorities(config.get_config_value("jobs", "priorities", "") or "")
+    return priorities.get(identifier, config_number("jobs", "default_priority", 0, int))
+
+
+_JOB_QUEUE = []
+_JOB_QUEUE_LOCK = threading.Lock()
+
+
+def job_queue():
+    """ The configured job queue, or `None` if asynchronous executions run on the web host. """
+    with _JOB_QUEUE_LOCK:
+        if not _JOB_QUEUE:
+            path = config.get_config_value("jobs", "path", "")
+            _JOB_QUEUE.append(JobQueue(path, lease=config_number("jobs", "lease", 300.0)) if path else None)
+        return _JOB_QUEUE[0]
+
+
+def submit(process, wps_request, wps_response):
+    """
+    Queue an asynchronous execution for a worker, instead of running it in a process
+    forked from the web host. `False` if there is no job queue configured.
+    """
+    queue = job_queue()
+    if queue is None:
+        return False
+
+    queue.enqueue(process.uuid, process.identifier, wps_request.json,
+                  rank=priority(process.identifier),
+                  max_attempts=config_number("jobs", "max_attempts", 3, int))
+    wps_response._update_status(WPS_STATUS.ACCEPTED, "PyWPS Process queued", 0)  # pylint: disable=protected-access
+    LOG.info("queued %s request %s", process.identifier, process.uuid)
+    # the worker sets up a working directory of its own
+    process.clean()
+    return True
+
+
+os.register_at_fork(after_in_child=_JOB_QUEUE.clear)
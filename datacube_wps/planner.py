@@ -0,0 +1,155 @@
+import collections
+import math
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from datacube.virtual.impl import VirtualProduct
+from pywps.app.exceptions import ProcessError
+
+from .settings import config_number
+
+GB = 1.0e9
+
+# limits of a budget, by the plan estimate they bound (in units of `scale`) and the message when it is exceeded
+Limit = collections.namedtuple("Limit", ["estimate", "scale", "message"])
+
+BUDGET_LIMITS = {
+    "load_gb": Limit("load_bytes", GB, "requested area requires {:.0f}GB data to load - maximum is {}GB"),
+    "obs_load_gb": Limit("bytes_per_obs", GB,
+                         "requested time slices each requires {:.0f}GB data to load - maximum is {}GB"),
+    "read_gb": Limit("read_bytes", GB, "requested area requires reading {:.0f}GB of source data - maximum is {}GB"),
+    "reads": Limit("reads", 1, "requested area requires {:.0f} tile reads - maximum is {}"),
+    "cpu_seconds": Limit("cpu_seconds", 1,
+                         "requested area requires an estimated {:.0f}s of processing - maximum is {}s"),
+}
+
+
+def _leaf_measurements(product):
+    # the measurements each source product is read for, None when it is read for all of them
+    if "product" in product:
+        return {product["product"]: product.get("measurements")}
+    leaves = {}
+    for value in product.values():
+        children = value if isinstance(value, (list, tuple)) else [value]
+        for child in children:
+            if isinstance(child, VirtualProduct):
+                leaves.update(_leaf_measurements(child))
+    return leaves
+
+
+class ReadPlan:
+    """ What reading a grouped box will cost: files and tiles touched, bytes read and held, and compute. """
+
+    def __init__(self, observations, datasets, reads, read_bytes, load_bytes, cpu_seconds):
+        self.observations = observations
+        self.datasets = datasets
+        self.reads = reads
+        self.read_bytes = read_bytes
+        self.load_bytes = load_bytes
+        self.cpu_seconds = cpu_seconds
+
+    @property
+    def bytes_per_obs(self):
+        return self.load_bytes / self.observations if self.observations else 0
+
+    def __add__(self, other):
+        return ReadPlan(self.observations + other.observations,
+                        self.datasets + other.datasets,
+                        self.reads + other.reads,
+                        self.read_bytes + other.read_bytes,
+                        self.load_bytes + other.load_bytes,
+                        self.cpu_seconds + other.cpu_seconds)
+
+    def as_dict(self):
+        return {"observations": self.observations,
+                "datasets": self.datasets,
+                "reads": self.reads,
+                "read_gb": round(self.read_bytes / GB, 3),
+                "load_gb": round(self.load_bytes / GB, 3),
+                "cpu_seconds": round(self.cpu_seconds, 1)}
+
+
+def plan_reads(input, box, tile_size=None, pixels_per_second=None):
+    """
+    Estimate the cost of loading `box`: every dataset is read for its bands over the part of
+    the box it covers, in internal tiles of `tile_size` pixels square, and each loaded pixel
+    of each measurement is processed at `pixels_per_second`.
+    """
+    if tile_size is None:
+        tile_size = config_number("planner", "tile_size", 512, int)
+    if pixels_per_second is None:
+        pixels_per_second = config_number("planner", "pixels_per_second", 5.0e7)
+
+    geobox = box.geobox
+    pixel_area = abs(geobox.resolution.x * geobox.resolution.y)
+    leaves = _leaf_measurements(input)
+
+    datasets = set()
+    for group in box.input_datasets().values:
+        datasets.update(group)
+
+    reads = 0
+    read_bytes = 0
+    for dataset in datasets:
+        if dataset.extent is None:
+            pixels = geobox.shape[0] * geobox.shape[1]
+        else:
+            pixels = dataset.extent.to_crs(geobox.crs).intersection(geobox.extent).area / pixel_area
+        tiles = math.ceil(pixels / tile_size ** 2) if pixels > 0 else 0
+        measurements = dataset.product.measurements
+        bands = leaves.get(dataset.product.name) or list(measurements)
+        for band in bands:
+            if band in measurements:
+                reads += tiles
+                read_bytes += pixels * np.dtype(measurements[band].dtype).itemsize
+
+    measurement_dicts = input.output_measurements(box.product_definitions)
+    load_pixels = math.prod(box.shape)
+    load_bytes = load_pixels * sum(np.dtype(m.dtype).itemsize for m in measurement_dicts.values())
+    cpu_seconds = load_pixels * len(measurement_dicts) / pixels_per_second
+    return ReadPlan(box.box.shape[0], len(datasets), reads, read_bytes, load_bytes, cpu_seconds)
+
+
+def check_budget(plan, budget):
+    """
+    Reject a plan over any `max_` limit of `budget`, and return the lane it runs in:
+    "slow" when over any of the `slow_` limits, "fast" otherwise.
+    """
+    if plan.observations == 0:
+        raise ProcessError("no data returned for query")
+
+    estimates = {name: getattr(plan, limit.estimate) / limit.scale for name, limit in BUDGET_LIMITS.items()}
+
+    for name, estimate in estimates.items():
+        limit = budget.get(f"max_{name}")
+        if limit is not None and estimate > limit:
+            raise ProcessError(BUDGET_LIMITS[name].message.format(estimate, limit))
+
+    for name, estimate in estimates.items():
+        limit = budget.get(f"slow_{name}")
+        if limit is not None and estimate > limit:
+            return "slow"
+    return "fast"
+
+
+_SLOW_LANE = []
+_SLOW_LANE_LOCK = threading.Lock()
+
+
+@contextmanager
+def lane(name):
+    """ Run a request in its lane, requests in the slow lane run a few at a time per worker. """
+    if name != "slow":
+        yield
+        return
+
+    with _SLOW_LANE_LOCK:
+        if not _SLOW_LANE:
+            _SLOW_LANE.append(threading.BoundedSemaphore(config_number("planner", "slow_lane_slots", 1, int)))
+    with _SLOW_LANE[0]:
+        yield
+
+
+os.register_at_fork(after_in_child=_SLOW_LANE.clear)
@@ -0,0 +1,113 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio
+import xarray
+from datacube.storage import BandInfo
+from datacube.storage._rio import _url2rasterio
+from datacube.utils.math import invalid_mask
+from datacube.utils.rio import activate_from_config, configure_s3_access
+from datacube.virtual.impl import Product
+from rasterio.windows import Window
+
+from .cluster import num_workers
+from .settings import config_number
+
+# product settings that do not change which source pixel ends up in the output
+POINT_READ_KEYS = {'product', 'measurements', 'group_by', 'fuse_func',
+                   'dataset_predicate', 'ensure_location', 'skip_broken_datasets'}
+
+_EXECUTOR = []
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def supports_point_read(product):
+    return isinstance(product, Product) and set(product) <= POINT_READ_KEYS
+
+
+def _executor():
+    with _EXECUTOR_LOCK:
+        if not _EXECUTOR:
+            configure_s3_access(aws_unsigned=True,
+                                region_name=os.getenv("AWS_DEFAULT_REGION", "auto"))
+            threads = config_number("pixeldrill", "read_threads", 4 * num_workers(), int)
+            _EXECUTOR.append(ThreadPoolExecutor(max_workers=threads,
+                                                thread_name_prefix="pointread"))
+        return _EXECUTOR[0]
+
+
+os.register_at_fork(after_in_child=_EXECUTOR.clear)
+
+
+def _read_pixel(path, band, x, y, dtype, nodata):
+    activate_from_config()
+    with rasterio.open(path) as src:
+        row, col = src.index(x, y)
+        if not (0 <= row < src.height and 0 <= col < src.width):
+            return np.array(nodata, dtype=dtype)
+        return src.read(band, window=Window(col, row, 1, 1))[0, 0].astype(dtype)
+
+
+def read_point(product, box, point):
+    """
+    Load the pixel under `point` for every time slice of `box` by reading a 1x1
+    window from each source file, in place of `product.fetch(box)`.
+    """
+    measurements = product.output_measurements(box.product_definitions)
+    fuse_func = product.get('fuse_func')
+    skip_broken = product.get('skip_broken_datasets', False)
+
+    # reproject the point once per source CRS, and read each file only once
+    locations = {}
+    sources = {}
+    reads = {}
+    for datasets in box.box.values:
+        for dataset in datasets:
+            if dataset.crs not in locations:
+                locations[dataset.crs] = point.to_crs(dataset.crs).coords[0]
+            x, y = locations[dataset.crs]
+            for name, measurement in measurements.items():
+                band = BandInfo(dataset, name)
+                key = sources[(dataset.id, name)] = (band.uri, band.band, band.layer)
+                if key not in reads:
+                    path = _url2rasterio(band.uri, band.format, band.layer)
+                    reads[key] = _executor().submit(_read_pixel, path, band.band, x, y,
+                                                    measurement.dtype, measurement.nodata)
+
+    def value(dataset, name):
+        try:
+            return reads[sources[(dataset.id, name)]].result()
+        except Exception:  # pylint: disable=broad-except
+            if not skip_broken:
+                raise
+            return None
+
+    result = xarray.Dataset(coords={'time': box.box.time.data})
+    for name, measurement in measurements.items():
+        dtype = np.dtype(measurement.dtype)
+        out = np.full((len(box.box.time), 1, 1), measurement.nodata, dtype=dtype)
+
+        for index, datasets in enumerate(box.box.values):
+            dest = out[index, 0]
+            if len(datasets) == 1:
+                # a single source is read as is, without fusing
+                pixel = value(datasets[0], name)
+                if pixel is not None:
+                    dest[0] = pixel
+                continue
+
+            for dataset in datasets:
+                pixel = value(dataset, name)
+                if pixel is None:
+                    continue
+                src = np.full((1,), pixel, dtype=dtype)
+                if fuse_func is None:
+                    np.copyto(dest, src, where=invalid_mask(dest, measurement.nodata))
+                else:
+                    fuse_func(dest, src)
+
+        result[name] = xarray.DataArray(out, dims=('time', 'y', 'x'),
+                                        attrs={'nodata': measurement.nodata})
+    return result
@@ -1,28 +1,39 @@
-import io
+import contextvars
 import json
+import logging
 import os
-from functools import wraps
-from timeit import default_timer
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
 
 import altair
-import boto3
-import botocore
-import datacube
 import numpy as np
 import pandas
 import pyarrow as pa
 import pyarrow.parquet as pq
-import pywps.configuration as config
 import rasterio.features
 import xarray
-from botocore.client import Config
-from dask.distributed import Client
-from datacube.utils.geometry import CRS, Geometry
+from datacube.utils.geometry import CRS, Geometry, unary_union
 from datacube.utils.rio import configure_s3_access
+from datacube.virtual.impl import VirtualDatasetBag, VirtualDatasetBox
 from dateutil.parser import parse
 from pywps import ComplexInput, ComplexOutput, Format, Process
 from pywps.app.exceptions import ProcessError
 
+from ..admission import Busy, admit, cost_weight
+from ..cache import pixel_geobox, request_key, result_cache
+from ..cluster import cluster_client, stream_slices
+from ..coalesce import single_flight
+from ..connection import shared_datacube
+from ..instrument import stage, timed
+from ..jobqueue import submit
+from ..planner import check_budget, lane, plan_reads
+from ..pointread import read_point, supports_point_read
+from ..publish import PUBLISHER
+from ..querycache import filter_bag, query_datasets
+from ..render import RENDERER, chart_spec
+from ..settings import config_number
+from ..zonal import gather_indices, gather_zones, zone_pixels
+
 FORMATS = {
     # Defines the format for the returned object
     # in this case a JSON object containing a CSV
@@ -43,81 +54,88 @@ FORMATS = {
     ),
 }
 
-GB = 1.0e9
+# default budget limits of polygon drills, see datacube_wps.planner
 MAX_BYTES_IN_GB = 20.0
 MAX_BYTES_PER_OBS_IN_GB = 2.0
+# streamed drills only hold a few time slices in memory at a time
+MAX_STREAMING_BYTES_IN_GB = 200.0
 
+LOG = logging.getLogger('PYWPS')
 
-def log_call(func):
-    @wraps(func)
-    def log_wrapper(*args, **kwargs):
-        name = func.__name__
-        for index, arg in enumerate(args):
-            try:
-                arg_name = func.__code__.co_varnames[index]
-            except (AttributeError, KeyError, IndexError):
-                arg_name = f"arg #{index}"
-            print(f"{name} {arg_name}: {arg}")
-        for key, value in kwargs.items():
-            print(f"{name} {key}: {value}")
-
-        start = default_timer()
-        result = func(*args, **kwargs)
-        end = default_timer()
-        print("{} returned {}".format(name, result))
-        print("{} took {:.3f}s".format(name, end - start))
-        return result
+# keys of the `about` section configuring the service rather than pywps
+SERVICE_KEYS = ["geometry_type", "guard_rail", "budget", "streaming", "output_format"]
 
-    return log_wrapper
 
+def upload_chart_html_to_S3(chart: altair.Chart, process_id: str):
+    body = RENDERER.render(chart_spec(chart), ["html"])["html"]
+    return PUBLISHER.upload(process_id + "/chart.html", body, "text/html")
 
-@log_call
-def _uploadToS3(filename, data, mimetype):
-    session = boto3.Session()
-    bucket = config.get_config_value("s3", "bucket")
-    s3 = session.client("s3")
-    s3.upload_fileobj(
-        data,
-        bucket,
-        filename,
-        ExtraArgs={"ACL": "public-read", "ContentType": mimetype},
-    )
 
-    # Create unsigned s3 client for determining public s3 url
-    s3 = session.client("s3", config=Config(signature_version=botocore.UNSIGNED))
-    return s3.generate_presigned_url(
-        ClientMethod="get_object",
-        ExpiresIn=0,
-        Params={"Bucket": bucket, "Key": filename},
-    )
+def upload_chart_svg_to_S3(chart: altair.Chart, process_id: str):
+    body = RENDERER.render(chart_spec(chart), ["svg"])["svg"]
+    return PUBLISHER.upload(process_id + "/chart.svg", body, "image/svg+xml")
 
 
-def upload_chart_html_to_S3(chart: altair.Chart, process_id: str):
-    html_io = io.StringIO()
-    chart.save(html_io, format="html")
-    html_bytes = io.BytesIO(html_io.getvalue().encode())
-    return _uploadToS3(process_id + "/chart.html", html_bytes, "text/html")
+ROW_GROUP_SIZE = 100_000
 
 
-def upload_chart_svg_to_S3(chart: altair.Chart, process_id: str):
-    img_io = io.StringIO()
-    chart.save(img_io, format="svg")
-    img_bytes = io.BytesIO(img_io.getvalue().encode())
-    return _uploadToS3(process_id + "/chart.svg", img_bytes, "image/svg+xml")
+def _record_batches(df: pandas.DataFrame, schema):
+    # converted a slice at a time, so the whole table never sits in memory next to the frame
+    for start in range(0, max(len(df), 1), ROW_GROUP_SIZE):
+        yield pa.RecordBatch.from_pandas(df.iloc[start:start + ROW_GROUP_SIZE], schema=schema)
 
 
-def write_df_to_parquet(df: pandas.DataFrame, process_id: str, identifier: str):
-    table = pa.Table.from_pandas(df)
-    writer = pa.BufferOutputStream()
-    pq.write_table(table, writer, compression="snappy")
-    body = bytes(writer.getvalue())
+def _write_parquet(df: pandas.DataFrame, sink):
+    schema = pa.Schema.from_pandas(df)
+    with pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema, compression="snappy") as writer:
+        for batch in _record_batches(df, schema):
+            writer.write_batch(batch)
+
+
+def _write_arrow(df: pandas.DataFrame, sink):
+    schema = pa.Schema.from_pandas(df)
+    with pa.ipc.new_file(pa.PythonFile(sink, mode="w"), schema) as writer:
+        for batch in _record_batches(df, schema):
+            writer.write_batch(batch)
 
-    bucket = config.get_config_value("s3", "bucket")
-    key = "/".join([identifier, process_id, process_id]) + ".snappy.parquet"
-    session = boto3.Session()
-    dev_s3_client = session.client("s3")
-    dev_s3_client.put_object(Body=body, Bucket=bucket, Key=key)
-    return f"s3://{bucket}/{key}"
+
+def _write_json_gz(df: pandas.DataFrame, sink):
+    # records carry no index, a named one (such as the time of WIT rows) is kept as a column
+    if any(name is not None for name in df.index.names):
+        df = df.reset_index()
+    df.to_json(sink, orient="records", date_format="iso", compression="gzip")
+
+
+# tabular output formats other than the default csv embedded in the timeseries output,
+# as writer, file extension and mimetype
+OUTPUT_FORMATS = {
+    "parquet": (_write_parquet, "snappy.parquet", "application/vnd.apache.parquet"),
+    "arrow": (_write_arrow, "arrow", "application/vnd.apache.arrow.file"),
+    "json.gz": (_write_json_gz, "json.gz", "application/gzip"),
+}
+
+
+def _output_format(output_format, outputs=("timeseries",)):
+    if output_format != "csv" and output_format not in OUTPUT_FORMATS:
+        raise ProcessError(f"unsupported output format {output_format}")
+    if output_format == "csv" and "timeseries" not in outputs:
+        # csv tables are embedded in the timeseries output, other formats are returned by url
+        raise ProcessError("output format csv is not supported by this process")
+    return output_format
+
+
+def write_df(df: pandas.DataFrame, process_id: str, identifier: str, output_format: str):
+    write, extension, mimetype = OUTPUT_FORMATS[output_format]
+    key = "/".join([identifier, process_id, process_id]) + "." + extension
+
+    # streamed into the bucket a part at a time while it is being written
+    with PUBLISHER.open(key, mimetype, public=False) as sink:
+        write(df, sink)
+    return PUBLISHER.url(key, public=False)
+
+
+def write_df_to_parquet(df: pandas.DataFrame, process_id: str, identifier: str):
+    return write_df(df, process_id, identifier, "parquet")
 
 
 # from https://stackoverflow.com/a/16353080
@@ -139,6 +157,67 @@ def geometry_mask(geom, geobox, all_touched=False, invert=False):
     )
 
 
+def gather_pixels(data, mask):
+    rows, cols = np.nonzero(mask)
+    return gather_indices(data, rows, cols)
+
+
+def _bounds_area(bounds):
+    left, bottom, right, top = bounds
+    return (right - left) * (top - bottom)
+
+
+def _cluster_features(bag, geoms, max_ratio=4.0):
+    """
+    Group features that share source datasets, so that those datasets are loaded once
+    for the group. A group is loaded over its bounding box, so features are only grouped
+    while that box covers at most `max_ratio` times the area of the bounding boxes of its
+    features: scattered features under the same large scenes are drilled apart rather than
+    over the whole region between them. Yields the feature indices and dataset ids of each group.
+    """
+    parent = list(range(len(geoms)))
+    bounds = [tuple(geom.boundingbox) for geom in geoms]
+    areas = [_bounds_area(box) for box in bounds]
+
+    def root(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    def merge(first, second):
+        first, second = root(first), root(second)
+        if first == second:
+            return
+        merged = (min(bounds[first][0], bounds[second][0]), min(bounds[first][1], bounds[second][1]),
+                  max(bounds[first][2], bounds[second][2]), max(bounds[first][3], bounds[second][3]))
+        if _bounds_area(merged) > max_ratio * (areas[first] + areas[second]):
+            return
+        parent[second] = first
+        bounds[first] = merged
+        areas[first] += areas[second]
+
+    crs = geoms[0].crs
+    covers = {}
+    for dataset in bag.contained_datasets():
+        extent = dataset.extent.to_crs(crs)
+        hits = [index for index, geom in enumerate(geoms) if extent.intersects(geom)]
+        if not hits:
+            continue
+        covers[dataset.id] = hits
+        for index in hits[1:]:
+            merge(hits[0], index)
+
+    groups = {}
+    for index in range(len(geoms)):
+        groups.setdefault(root(index), ([], set()))[0].append(index)
+    for dataset_id, hits in covers.items():
+        for index in hits:
+            groups[root(index)][1].add(dataset_id)
+
+    yield from groups.values()
+
+
 def wofls_fuser(dest, src):
     where_nodata = (src & 1) == 0
     np.copyto(dest, src, where=where_nodata)
@@ -158,72 +237,62 @@ def chart_dimensions(style):
     return (width, height)
 
 
-def _guard_rail(input, box):
-    measurement_dicts = input.output_measurements(box.product_definitions)
+def _datetimeExtractor(data):
+    return parse(json.loads(data)["properties"]["timestamp"]["date-time"])
 
-    byte_count = 1
-    for x in box.shape:
-        byte_count *= x
-    byte_count *= sum(np.dtype(m.dtype).itemsize for m in measurement_dicts.values())
 
-    print("byte count for query: ", byte_count)
-    if byte_count > MAX_BYTES_IN_GB * GB:
-        raise ProcessError(
-            ("requested area requires {}GB data to load - " "maximum is {}GB").format(
-                int(byte_count / GB), MAX_BYTES_IN_GB
-            )
-        )
+def _feature_id(feature, index):
+    if "id" in feature:
+        return feature["id"]
+    return feature.get("properties", {}).get("id", index)
 
-    grouped = box.box
 
-    print("grouped shape", grouped.shape)
-    assert len(grouped.shape) == 1
+def _parse_geoms(request_json):
+    features = request_json["features"]
+    if len(features) < 1:
+        # can't drill if there is no geometry
+        raise ProcessError("no features specified")
 
-    if grouped.shape[0] == 0:
-        raise ProcessError("no data returned for query")
+    max_features = config_number("batch", "max_features", 1000, int)
+    if len(features) > max_features:
+        raise ProcessError(f"too many features specified - maximum is {max_features}")
 
-    bytes_per_obs = byte_count / grouped.shape[0]
-    if bytes_per_obs > MAX_BYTES_PER_OBS_IN_GB * GB:
-        raise ProcessError(
-            (
-                "requested time slices each requires {}GB data to load - "
-                "maximum is {}GB"
-            ).format(int(bytes_per_obs / GB), MAX_BYTES_PER_OBS_IN_GB)
-        )
+    geoms = []
+    for index, feature in enumerate(features):
+        if hasattr(request_json, "crs"):
+            crs = CRS(request_json["crs"]["properties"]["name"])
+        elif hasattr(feature, "crs"):
+            crs = CRS(feature["crs"]["properties"]["name"])
+        else:
+            # http://geojson.org/geojson-spec.html#coordinate-reference-system-objects
+            crs = CRS("urn:ogc:def:crs:OGC:1.3:CRS84")
 
+        geoms.append((_feature_id(feature, index), Geometry(feature["geometry"], crs)))
 
-def _datetimeExtractor(data):
-    return parse(json.loads(data)["properties"]["timestamp"]["date-time"])
+    return geoms
 
 
 def _parse_geom(request_json):
-    features = request_json["features"]
-    if len(features) < 1:
-        # can't drill if there is no geometry
-        raise ProcessError("no features specified")
-
-    if len(features) > 1:
+    geoms = _parse_geoms(request_json)
+    if len(geoms) > 1:
         # do we need multipolygon support here?
         raise ProcessError("multiple features specified")
 
-    feature = features[0]
+    _, geom = geoms[0]
+    return geom
 
-    if hasattr(request_json, "crs"):
-        crs = CRS(request_json["crs"]["properties"]["name"])
-    elif hasattr(feature, "crs"):
-        crs = CRS(feature["crs"]["properties"]["name"])
-    else:
-        # http://geojson.org/geojson-spec.html#coordinate-reference-system-objects
-        crs = CRS("urn:ogc:def:crs:OGC:1.3:CRS84")
 
-    return Geometry(feature["geometry"], crs)
+def _get_request_json(request):
+    stream = request.inputs["geometry"][0].stream
+    return json.loads(stream.readline())
 
 
 def _get_feature(request):
-    stream = request.inputs["geometry"][0].stream
-    request_json = json.loads(stream.readline())
+    return _parse_geom(_get_request_json(request))
 
-    return _parse_geom(request_json)
+
+def _get_features(request):
+    return _parse_geoms(_get_request_json(request))
 
 
 def _get_time(request):
@@ -257,38 +326,57 @@ def _render_outputs(
     is_enabled=True,
     name="Timeseries",
     header=True,
+    output_format="csv",
+    identifier="",
+    plan=None,
 ):
-    html_url = upload_chart_html_to_S3(chart, str(uuid))
-    img_url = upload_chart_svg_to_S3(chart, str(uuid))
-
-    try:
-        csv_df = df.drop(columns=["latitude", "longitude"])
-    except KeyError:
-        csv_df = df
-
-    csv_df.set_index("time", inplace=True)
-    csv = csv_df.to_csv(header=header, date_format="%Y-%m-%d")
+    # charts are rendered and uploaded in the background while the table is prepared
+    if chart is not None:
+        chart_urls = PUBLISHER.publish_chart(str(uuid), chart_spec(chart))
 
     if "table" in style:
         table_style = {"tableStyle": style["table"]}
     else:
         table_style = {}
 
+    outputs = {}
+    if output_format == "csv":
+        with stage(identifier, "serialize"):
+            try:
+                csv_df = df.drop(columns=["latitude", "longitude"])
+            except KeyError:
+                csv_df = df
+
+            if "time" in csv_df.columns:
+                csv_df = csv_df.set_index("time")
+            csv = csv_df.to_csv(header=header, date_format="%Y-%m-%d")
+        table = {"data": csv, "type": "csv"}
+    else:
+        # the table is stored next to the charts and referred to by url
+        with stage(identifier, "serialize"):
+            url = write_df(df, str(uuid), identifier.lower(), output_format)
+        table = {"url": url, "type": output_format}
+        if chart is None:
+            outputs["url"] = {"data": url}
+
     output_dict = {
-        "data": csv,
+        **table,
         "isEnabled": is_enabled,
-        "type": "csv",
         "name": name,
         **table_style,
     }
+    if plan is not None:
+        # the estimated cost of the request, as planned before reading
+        output_dict["plan"] = plan.as_dict()
+        # also on its own, for processes returning no timeseries
+        outputs["plan"] = {"data": json.dumps(plan.as_dict())}
 
-    output_json = json.dumps(output_dict, cls=DatetimeEncoder)
+    outputs["timeseries"] = {"data": json.dumps(output_dict, cls=DatetimeEncoder)}
 
-    outputs = {
-        "image": {"data": img_url},
-        "url": {"data": html_url},
-        "timeseries": {"data": output_json},
-    }
+    if chart is not None:
+        with stage(identifier, "upload"):
+            outputs["image"] = {"data": chart_urls["svg"].result()}
+            outputs["url"] = {"data": chart_urls["html"].result()}
 
     return outputs
 
@@ -304,8 +392,126 @@ def _populate_response(response, outputs):
                 response.outputs[ident].url = output_value["url"]
 
 
-def num_workers():
-    return int(os.getenv("DATACUBE_WPS_NUM_WORKERS", "4"))
+@contextmanager
+def _dask_client(kind, dask_client=None):
+    if dask_client is None:
+        with cluster_client(kind) as client:
+            yield client
+        return
+
+    with dask_client:
+        configure_s3_access(
+            aws_unsigned=True,
+            region_name=os.getenv("AWS_DEFAULT_REGION", "auto"),
+            client=dask_client,
+        )
+        yield dask_client
+
+
+def _time_keys(times):
+    return pandas.DatetimeIndex(pandas.to_datetime(times)).strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+def _frame_times(df):
+    if "time" in df.columns:
+        return _time_keys(df["time"])
+    return _time_keys(df.index.get_level_values("time"))
+
+
+def _dataset_signatures(box):
+    # a time slice needs recomputing when the datasets behind it change,
+    # either new ones arrive or existing ones are re-indexed
+    return {
+        key: sorted(f"{ds.id}:{ds.indexed_time}" for ds in datasets)
+        for key, datasets in zip(_time_keys(box.box.time.data), box.input_datasets().values)
+    }
+
+
+def _select_times(box, keys):
+    index = [i for i, key in enumerate(_time_keys(box.box.time.data)) if key in keys]
+    return VirtualDatasetBox(
+        box.box.isel(time=index),
+        box.geobox,
+        box.load_natively,
+        box.product_definitions,
+        geopolygon=box.geopolygon,
+    )
+
+
+def _sort_frame(df):
+    if "time" in df.columns:
+        return df.sort_values("time", kind="stable").reset_index(drop=True)
+    return df.sort_index(kind="stable")
+
+
+def _pixel_geobox(process, feature):
+    # the pixels drilled for a feature, which identify the results kept and shared for it
+    geobox = pixel_geobox(process.input, feature)
+    if geobox is None:
+        with shared_datacube() as dc:
+            geobox = pixel_geobox(process.input, feature, dc)
+    return geobox
+
+
+def _drill(process, client, time, feature, parameters):
+    flights = single_flight()
+    if flights is None:
+        return _drill_once(process, client, time, feature, parameters)
+
+    # identical drills in flight are computed once, on other workers the result is picked up from the cache
+    identifier = process.about.get("identifier", "")
+    key = request_key(identifier, process.about.get("version"), feature, time, parameters,
+                      geobox=_pixel_geobox(process, feature))
+    return flights.run(key, lambda: _drill_once(process, client, time, feature, parameters),
+                       process=identifier, across_workers=result_cache() is not None)
+
+
+def _drill_once(process, client, time, feature, parameters):
+    parameters = {"time": time, "feature": feature, **parameters}
+
+    cache = result_cache()
+    if cache is None:
+        with client:
+            with shared_datacube() as dc:
+                box = process.query_box(dc, time, feature)
+                return process.drill_box(box, feature, parameters)
+
+    identifier = process.about.get("identifier", "")
+    incremental = process.incremental(parameters)
+    requested = None if time is None else [str(t) for t in time]
+
+    # incremental results are kept per start date and extended as time goes on
+    key_time = time[:1] if incremental and time is not None else time
+    key = request_key(
+        identifier,
+        process.about.get("version"),
+        feature,
+        key_time,
+        {k: v for k, v in parameters.items() if k not in ["time", "feature"]},
+        geobox=_pixel_geobox(process, feature),
+    )
+    cached, metadata = cache.get_entry(key, process=identifier, include_expired=incremental)
+    if cached is not None and not cache.expired(metadata) and metadata.get("time") == requested:
+        return cached
+
+    with client:
+        with shared_datacube() as dc:
+            box = process.query_box(dc, time, feature)
+            signatures = _dataset_signatures(box)
+
+            if cached is None:
+                df = process.drill_box(box, feature, parameters)
+            else:
+                stored = metadata.get("datasets", {})
+                changed = [t for t, signature in signatures.items() if stored.get(t) != signature]
+                unchanged = set(signatures) - set(changed)
+                df = cached[_frame_times(cached).isin(unchanged)]
+                if changed:
+                    update = process.drill_box(_select_times(box, changed), feature, parameters)
+                    df = _sort_frame(pandas.concat([df, update]))
+
+    cache.put(key, df, {"time": requested, "datasets": signatures})
+    return df
 
 
 class PixelDrill(Process):
@@ -320,13 +526,14 @@ class PixelDrill(Process):
             **{
                 key: value
                 for key, value in about.items()
-                if key not in ["geometry_type", "guard_rail"]
+                if key not in SERVICE_KEYS
             },
         )
 
         self.about = about
         self.input = input
         self.style = style
+        self.output_format = _output_format(about.get("output_format", "csv"))
 
     def input_formats(self):
         return [
@@ -348,10 +555,17 @@ class PixelDrill(Process):
             )
         ]
 
+    def _run_async(self, wps_request, wps_response):
+        # with a job queue configured, asynchronous executions run on datacube-wps-worker
+        if not submit(self, wps_request, wps_response):
+            super()._run_async(wps_request, wps_response)
+
     def request_handler(self, request, response):
         time = _get_time(request)
         feature = _get_feature(request)
         parameters = _get_parameters(request)
+        if "output_format" in parameters:
+            self.output_format = _output_format(parameters.pop("output_format"))
 
         result = self.query_handler(time, feature, parameters=parameters)
 
@@ -359,45 +573,51 @@ class PixelDrill(Process):
         _populate_response(response, outputs)
         return response
 
-    @log_call
     def query_handler(self, time, feature, dask_client=None, parameters=None):
         if parameters is None:
             parameters = {}
 
-        if dask_client is None:
-            dask_client = Client(
-                n_workers=1, processes=False, threads_per_worker=num_workers()
-            )
+        if dask_client is None and supports_point_read(self.input):
+            # point reads go straight to the files, no cluster required
+            client = nullcontext()
+        else:
+            client = _dask_client("pixel", dask_client)
 
-        with dask_client:
-            configure_s3_access(
-                aws_unsigned=True,
-                region_name=os.getenv("AWS_DEFAULT_REGION", "auto"),
-                client=dask_client,
-            )
+        df = _drill(self, client, time, feature, parameters)
+        with stage(self.about.get("identifier", ""), "render_chart"):
+            chart = self.render_chart(df)
 
-            with datacube.Datacube() as dc:
-                data = self.input_data(dc, time, feature)
+        return {"data": df, "chart": chart}
 
-        df = self.process_data(data, {"time": time, "feature": feature, **parameters})
-        chart = self.render_chart(df)
+    def incremental(self, parameters):
+        # pylint: disable=unused-argument
+        # whether results for new time slices can be appended to earlier ones
+        return True
 
-        return {"data": df, "chart": chart}
+    def query_box(self, dc, time, feature):
+        identifier = self.about.get("identifier", "")
+        with stage(identifier, "query"):
+            bag = query_datasets(self.input, dc, time, feature)
+        with stage(identifier, "group"):
+            return self.input.group(bag)
 
-    @log_call
     def input_data(self, dc, time, feature):
-        if time is None:
-            bag = self.input.query(dc, geopolygon=feature)
-        else:
-            bag = self.input.query(dc, time=time, geopolygon=feature)
+        return self.load_box(self.query_box(dc, time, feature), feature)
+
+    def drill_box(self, box, feature, parameters):
+        return self.process_data(self.load_box(box, feature), parameters)
 
+    @timed("load")
+    def load_box(self, box, feature):
         lonlat = feature.coords[0]
 
-        measurements = self.input.output_measurements(bag.product_definitions)
-        box = self.input.group(bag)
+        measurements = self.input.output_measurements(box.product_definitions)
 
-        data = self.input.fetch(box, dask_chunks={"time": 1})
-        data = data.compute()
+        if supports_point_read(self.input):
+            data = read_point(self.input, box, feature)
+        else:
+            data = self.input.fetch(box, dask_chunks={"time": 1})
+            data = data.compute()
 
         coords = {
             "longitude": np.array([lonlat[0]]),
@@ -441,10 +661,16 @@ class PixelDrill(Process):
             is_enabled=is_enabled,
             name=name,
             header=header,
+            output_format=self.output_format,
+            identifier=self.about.get("identifier", ""),
         )
 
 
 class PolygonDrill(Process):
+    # whether process_data reduces data gathered by zone (see datacube_wps.zonal),
+    # so that a batch of features is reduced together rather than one at a time
+    zonal = False
+
     def __init__(self, about, input, style):
         if "geometry_type" in about:
             assert about["geometry_type"] == "polygon"
@@ -456,14 +682,19 @@ class PolygonDrill(Process):
             **{
                 key: value
                 for key, value in about.items()
-                if key not in ["geometry_type", "guard_rail"]
+                if key not in SERVICE_KEYS
             },
         )
 
         self.about = about
         self.input = input
         self.style = style
+        # processes without a timeseries output return their table by url
+        self.output_format = self.check_output_format(
+            about.get("output_format", "csv" if "timeseries" in self.output_ids() else "parquet"))
         self.mask_all_touched = False
+        # estimated cost of the boxes read for the request
+        self.plan = None
 
     def input_formats(self):
         return [
@@ -486,76 +717,220 @@ class PolygonDrill(Process):
             )
         ]
 
+    def output_ids(self):
+        return [output.identifier for output in self.outputs]
+
+    def check_output_format(self, output_format):
+        return _output_format(output_format, self.output_ids())
+
+    def _run_async(self, wps_request, wps_response):
+        # with a job queue configured, asynchronous executions run on datacube-wps-worker
+        if not submit(self, wps_request, wps_response):
+            super()._run_async(wps_request, wps_response)
+
     def request_handler(self, request, response):
         time = _get_time(request)
-        feature = _get_feature(request)
+        features = _get_features(request)
         parameters = _get_parameters(request)
+        if "output_format" in parameters:
+            self.output_format = self.check_output_format(parameters.pop("output_format"))
 
-        result = self.query_handler(time, feature, parameters=parameters)
+        if len(features) > 1:
+            df = self.batch_handler(time, features, parameters=parameters)
+            outputs = self.render_batch_outputs(df)
+        else:
+            _, feature = features[0]
+            result = self.query_handler(time, feature, parameters=parameters)
+            outputs = self.render_outputs(result["data"], result["chart"])
 
-        outputs = self.render_outputs(result["data"], result["chart"])
         _populate_response(response, outputs)
         return response
 
-    @log_call
     def query_handler(self, time, feature, dask_client=None, parameters=None):
         if parameters is None:
             parameters = {}
 
-        if dask_client is None:
-            dask_client = Client(
-                n_workers=num_workers(), processes=True, threads_per_worker=1
-            )
-
-        with dask_client:
-            configure_s3_access(
-                aws_unsigned=True,
-                region_name=os.getenv("AWS_DEFAULT_REGION", "auto"),
-                client=dask_client,
-            )
-
-            with datacube.Datacube() as dc:
-                data = self.input_data(dc, time, feature)
-
-        df = self.process_data(data, {"time": time, "feature": feature, **parameters})
-        chart = self.render_chart(df)
+        df = _drill(self, _dask_client("polygon", dask_client), time, feature, parameters)
+        with stage(self.about.get("identifier", ""), "render_chart"):
+            chart = self.render_chart(df)
 
         return {"data": df, "chart": chart}
 
-    def input_data(self, dc, time, feature):
-        if time is None:
-            bag = self.input.query(dc, geopolygon=feature)
-        else:
-            bag = self.input.query(dc, time=time, geopolygon=feature)
-
-        box = self.input.group(bag)
+    def batch_handler(self, time, features, dask_client=None, parameters=None):
+        if parameters is None:
+            parameters = {}
+        parameters = {"time": time, **parameters}
+
+        frames = {}
+        with _dask_client("polygon", dask_client):
+            with shared_datacube() as dc:
+                geoms = [geom for _, geom in features]
+                bag = self.query_bag(dc, time, unary_union(geoms))
+                max_ratio = config_number("batch", "max_cluster_ratio", 4.0)
+                for indices, dataset_ids in _cluster_features(bag, geoms, max_ratio=max_ratio):
+                    if not dataset_ids:
+                        continue
+                    cluster = [features[index] for index in indices]
+                    cluster_bag = VirtualDatasetBag(
+                        filter_bag(bag.bag, lambda dataset, ids=dataset_ids: dataset.id in ids),
+                        unary_union([geom for _, geom in cluster]),
+                        bag.product_definitions,
+                    )
+                    with stage(self.about.get("identifier", ""), "group"):
+                        cluster_box = self.input.group(cluster_bag)
+                    frames.update(zip(indices, self.drill_features(cluster_box, cluster, parameters)))
+
+        if not frames:
+            raise ProcessError("no data returned for query")
+        # one table for all features, in the order they were requested
+        return pandas.concat([frames[index] for index in sorted(frames)])
+
+    def drill_features(self, box, features, parameters):
+        with self.admitted(box):
+            return self._drill_features(box, features, parameters)
+
+    def _drill_features(self, box, features, parameters):
+        # every source dataset is read once for all the features it covers
+        identifier = self.about.get("identifier", "")
+        data = self.input.fetch(box, dask_chunks={"time": 1})
+        dims = data.geobox.dimensions
+        geoms = [geom for _, geom in features]
+        pixels = zone_pixels(geoms, data.geobox, all_touched=self.mask_all_touched)
+
+        # reads are lazy, the load stage spans the computations they are part of
+        with stage(identifier, "load"):
+            if self.zonal:
+                # one reduction for all features, labelled by zone
+                df = self.process_data(gather_zones(data, pixels, dims=dims), {**parameters, "features": geoms})
+                frames = [df[df["zone"] == zone].drop(columns="zone") for zone in range(len(features))]
+            else:
+                # read once, then reduced feature by feature
+                data = data.persist()
+                frames = [
+                    self.process_data(gather_indices(data, rows, cols, dims=dims), {**parameters, "feature": geom})
+                    for geom, (rows, cols) in zip(geoms, pixels)
+                ]
+
+        for (feature_id, _), df in zip(features, frames):
+            df.insert(0, "feature_id", feature_id)
+        return frames
+
+    def incremental(self, parameters):
+        # pylint: disable=unused-argument
+        # whether results for new time slices can be appended to earlier ones
+        return True
+
+    @timed("query")
+    def query_bag(self, dc, time, geopolygon):
+        return query_datasets(self.input, dc, time, geopolygon)
+
+    def query_box(self, dc, time, feature):
+        bag = self.query_bag(dc, time, feature)
+        with stage(self.about.get("identifier", ""), "group"):
+            return self.input.group(bag)
 
+    def input_data(self, dc, time, feature):
+        box = self.query_box(dc, time, feature)
+        self.plan_box(box)
+        return self.load_box(box, feature)
+
+    def budget(self, streaming=False):
+        """
+        Limits on the estimated cost of a request, see datacube_wps.planner. The `budget`
+        in the process settings adds to the default limits, or replaces them with `guard_rail: False`.
+        """
+        budget = {}
         if self.about.get("guard_rail", True):
-            _guard_rail(self.input, box)
-
+            budget["max_load_gb"] = MAX_STREAMING_BYTES_IN_GB if streaming else MAX_BYTES_IN_GB
+            budget["max_obs_load_gb"] = MAX_BYTES_PER_OBS_IN_GB
+        budget.update(self.about.get("budget", {}))
+        return budget
+
+    @timed("plan")
+    def plan_box(self, box, streaming=False):
+        # estimates what loading the box costs, rejecting it when over budget,
+        # returns the plan and the lane it is to run in
+        plan = plan_reads(self.input, box)
+        self.plan = plan if self.plan is None else self.plan + plan
+        LOG.debug("read plan %s", plan.as_dict())
+        return plan, check_budget(plan, self.budget(streaming))
+
+    @contextmanager
+    def admitted(self, box, streaming=False):
+        # the box is read once admitted for its estimated cost, in its lane
+        plan, lane_name = self.plan_box(box, streaming=streaming)
+        with ExitStack() as stack:
+            try:
+                stack.enter_context(admit(self.about.get("identifier", ""), cost_weight(plan)))
+            except Busy as e:
+                raise ProcessError(f"server is busy, please try again later ({e})") from e
+            stack.enter_context(lane(lane_name))
+            yield plan
+
+    def drill_box(self, box, feature, parameters):
+        streaming = self.about.get("streaming", False)
+        with self.admitted(box, streaming=streaming):
+            if not streaming:
+                # reads are lazy, the load stage spans the computation they are part of
+                with stage(self.about.get("identifier", ""), "load"):
+                    return self.process_data(self.load_box(box, feature), parameters)
+            return self._stream_box(box, feature, parameters)
+
+    def _stream_box(self, box, feature, parameters):
+        # load, mask and reduce time slices as separate computations on the cluster, a few at a time,
+        # so that only that many slices are ever held in memory
+        mask = geometry_mask(feature, box.geobox, all_touched=self.mask_all_touched, invert=True)
+
+        def reduce_slice(time_slice):
+            with stage(self.about.get("identifier", ""), "load"):
+                data = self.input.fetch(time_slice, dask_chunks={"time": 1})
+                return self.reduce_slice(self.mask_data(data, mask), parameters)
+
+        with ThreadPoolExecutor(max_workers=stream_slices()) as executor:
+            # every slice runs in a copy of the request context, where the cluster client is current
+            futures = [executor.submit(contextvars.copy_context().run, reduce_slice, time_slice)
+                       for time_slice in box.split("time")]
+            frames = [future.result() for future in futures]
+
+        return _sort_frame(pandas.concat(frames))
+
+    def load_box(self, box, feature):
         # TODO customize the number of processes
         data = self.input.fetch(box, dask_chunks={"time": 1})
         mask = geometry_mask(
             feature, data.geobox, all_touched=self.mask_all_touched, invert=True
         )
+        return self.mask_data(data, mask)
 
-        # mask out data outside requested polygon
-        for band_name, band_array in data.data_vars.items():
-            if "nodata" in band_array.attrs:
-                data[band_name] = band_array.where(
-                    mask, other=band_array.attrs["nodata"]
-                )
-            else:
-                data[band_name] = band_array.where(mask)
-
-        return data
+    def mask_data(self, data, mask):
+        # only the pixels inside the requested polygon are kept,
+        # statistics are computed over the "pixel" dimension
+        return gather_pixels(data, mask)
 
     def process_data(self, data: xarray.Dataset, parameters: dict) -> pandas.DataFrame:
         raise NotImplementedError
 
+    def reduce_slice(self, data: xarray.Dataset, parameters: dict) -> pandas.DataFrame:
+        # statistics for a single time slice when streaming,
+        # processes whose rows are independent per time slice can reuse process_data
+        return self.process_data(data, parameters)
+
     def render_chart(self, df: pandas.DataFrame) -> altair.Chart:
         raise NotImplementedError
 
+    def render_batch_outputs(self, df: pandas.DataFrame):
+        # one table for all features, without a chart
+        return _render_outputs(
+            self.uuid,
+            self.style,
+            df,
+            None,
+            name=self.about.get("title", "Timeseries"),
+            output_format=self.output_format,
+            identifier=self.about.get("identifier", ""),
+            plan=self.plan,
+        )
+
     def render_outputs(
         self,
         df: pandas.DataFrame,
@@ -564,13 +939,6 @@ class PolygonDrill(Process):
         name="Timeseries",
         header=True,
     ):
-        # patch in here for the time being
-        # might be better
-        if "wit" == self.about.get("identifier", "").lower():
-            url = write_df_to_parquet(
-                df, str(self.uuid), self.about.get("identifier").lower()
-            )
-            return {'url': {'data': url}}
         return _render_outputs(
             self.uuid,
             self.style,
@@ -579,4 +947,7 @@ class PolygonDrill(Process):
             is_enabled=is_enabled,
             name=name,
             header=header,
+            output_format=self.output_format,
+            identifier=self.about.get("identifier", ""),
+            plan=self.plan,
         )
@@ -1,15 +1,48 @@
-from timeit import default_timer
-
 import altair
 import numpy as np
 import xarray
-from datacube.utils.masking import make_mask
+from datacube.utils.masking import create_mask_value
+from datacube.utils.math import invalid_mask
 from pywps import ComplexOutput, LiteralOutput
 
-from . import FORMATS, PolygonDrill, chart_dimensions, log_call
+from ..instrument import timed
+from ..zonal import zonal_frame, zonal_histogram
+from . import FORMATS, PolygonDrill, chart_dimensions
+
+WOFS_MASK_FLAGS = [
+    dict(dry=True),
+    dict(terrain_or_low_angle=False, high_slope=False, cloud_shadow=False, cloud=False, sea=False)
+]
+
+
+def fc_class_block(bs, pv, npv, water, nodata=(), clear=()):
+    """
+    The dominant fractional cover class of each pixel: 0 for bare soil, 1 and 2 for
+    photosynthetic and non-photosynthetic vegetation, 3 for pixels that are valid but
+    not clear and dry, and 4 for invalid pixels.
+    """
+    valid = np.ones(bs.shape, dtype=bool)
+    for band, band_nodata in zip((bs, pv, npv), nodata):
+        valid &= ~invalid_mask(band, band_nodata)
+
+    # pixels must also be clear and dry according to WOfS
+    observable = valid.copy()
+    check = np.empty(bs.shape, dtype=bool)
+    for mask, value in clear:
+        np.equal(np.bitwise_and(water, mask), value, out=check)
+        observable &= check
+
+    # ties go to the first class, as with argmax
+    classes = np.full(bs.shape, 2, dtype='uint8')
+    classes[(pv >= npv)] = 1
+    classes[(bs >= pv) & (bs >= npv)] = 0
+    classes[~observable] = 3
+    classes[~valid] = 4
+    return classes
 
 
 class FCDrill(PolygonDrill):
+    zonal = True
     SHORT_NAMES = ['BS', 'PV', 'NPV', 'Unobservable']
     LONG_NAMES = ['Bare Soil',
                   'Photosynthetic Vegetation',
@@ -22,72 +55,34 @@ class FCDrill(PolygonDrill):
                 ComplexOutput('timeseries', 'Fractional Cover Polygon Drill Timeseries',
                               supported_formats=[FORMATS['output_json']])]
 
-    @log_call
+    @timed("process_data")
     def process_data(self, data, parameters):
-        wofs_mask_flags = [
-            dict(dry=True),
-            dict(terrain_or_low_angle=False, high_slope=False, cloud_shadow=False, cloud=False, sea=False)
-        ]
-
         water = data.data_vars['water']
-        data = data.drop_vars(['water'])
-
-        total = data.count(dim=['x', 'y'])
-        total_valid = (data != -1).sum(dim=['x', 'y'])
-
-        # TODO enable this check, investigate why it fails
-        # if total_valid <= 0:
-        #     raise ProcessError('query returned no data')
-
-        for m in wofs_mask_flags:
-            mask = make_mask(water, **m)
-            data = data.where(mask)
-
-        total_invalid = (np.isnan(data)).sum(dim=['x', 'y'])
-        not_pixels = total_valid - (total - total_invalid)
+        # bare soil, photosynthetic and non-photosynthetic vegetation, in that order
+        fc = [band for name, band in data.data_vars.items() if name != 'water']
 
-        # following robbi's advice, cast the dataset to a dataarray
-        maxFC = data.to_array(dim='variable', name='maxFC')
+        flags = water.attrs['flags_definition']
+        clear = [create_mask_value(flags, **m) for m in WOFS_MASK_FLAGS]
 
-        # turn FC array into integer only as nanargmax doesn't seem to handle floats the way we want it to
-        FC_int = maxFC.astype('int16')
+        classes = xarray.apply_ufunc(
+            fc_class_block, *fc, water,
+            kwargs=dict(nodata=[band.attrs.get('nodata') for band in fc], clear=clear),
+            dask='parallelized',
+            output_dtypes=[np.uint8],
+        )
+        # pixel counts per class, invalid pixels are left out
+        counts = zonal_histogram(classes, data, bins=len(self.SHORT_NAMES))
 
-        # use numpy.nanargmax to get the index of the maximum value along the variable dimension
-        # BSPVNPV=np.nanargmax(FC_int, axis=0)
-        BSPVNPV = FC_int.argmax(dim='variable')
-
-        FC_mask = np.isfinite(maxFC).all(dim='variable')   # pylint: disable=no-member,unexpected-keyword-arg
-
-        # #re-mask with nans to remove no-data
-        BSPVNPV = BSPVNPV.where(FC_mask)
-
-        FC_dominant = xarray.Dataset({
-            'BS': (BSPVNPV == 0).where(FC_mask),
-            'PV': (BSPVNPV == 1).where(FC_mask),
-            'NPV': (BSPVNPV == 2).where(FC_mask)
-        })
-
-        FC_count = FC_dominant.sum(dim=['x', 'y'])
+        counts = counts.compute()
 
         # Fractional cover pixel count method
-        # Get number of FC pixels, divide by total number of pixels per polygon
-        new_ds = xarray.Dataset({
-            'BS': (FC_count.BS / total_valid)['BS'] * 100,
-            'PV': (FC_count.PV / total_valid)['PV'] * 100,
-            'NPV': (FC_count.NPV / total_valid)['NPV'] * 100,
-            'Unobservable': (not_pixels / total_valid)['BS'] * 100
-        })
-
-        print('dask compute')
-        dask_time = default_timer()
-        new_ds = new_ds.compute()
-        print('dask took', default_timer() - dask_time, 'seconds')
-        print(new_ds)
-
-        df = new_ds.to_dataframe()
-        df = df.drop('spatial_ref', axis=1)
-        df.reset_index(inplace=True)
-        return df
+        # Get number of FC pixels, divide by total number of valid pixels per polygon
+        total_valid = counts.sum('bin')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percentages = counts / total_valid * 100
+
+        percentages = percentages.assign_coords(bin=self.SHORT_NAMES).to_dataset('bin')
+        return zonal_frame(percentages, data)
 
     def render_chart(self, df):
         width, height = chart_dimensions(self.style)
@@ -1,30 +1,22 @@
 import altair
-import xarray
 
-from . import PolygonDrill, chart_dimensions, log_call
+from ..instrument import timed
+from ..zonal import zonal_frame, zonal_histogram
+from . import PolygonDrill, chart_dimensions
 
 
 class MangroveDrill(PolygonDrill):
+    # canopy cover classes 1, 2 and 3
+    CLASSES = ['Woodland', 'Open Forest', 'Closed Forest']
+    zonal = True
 
-    @log_call
+    @timed("process_data")
     def process_data(self, data, parameters):
-        data = data.compute()
-
         # TODO raise ProcessError('query returned no data') when appropriate
-        woodland = data.where(data == 1).count(['x', 'y'])
-        woodland = woodland.rename(name_dict={'canopy_cover_class': 'Woodland'})
-        open_forest = data.where(data == 2).count(['x', 'y'])
-        open_forest = open_forest.rename(name_dict={'canopy_cover_class': 'Open Forest'})
-        closed_forest = data.where(data == 3).count(['x', 'y'])
-        closed_forest = closed_forest.rename(name_dict={"canopy_cover_class": 'Closed Forest'})
-
-        final = xarray.merge([woodland, open_forest, closed_forest])
-        result = final.to_dataframe()
-        result = result.drop('spatial_ref', axis=1)
-        result.reset_index(inplace=True)
-        return result
-
-    @log_call
+        counts = zonal_histogram(data.canopy_cover_class, data, bins=len(self.CLASSES) + 1).compute()
+        final = counts.isel(bin=slice(1, None)).assign_coords(bin=self.CLASSES).to_dataset('bin')
+        return zonal_frame(final, data)
+
     def render_chart(self, df):
         width, height = chart_dimensions(self.style)
 
@@ -51,7 +43,6 @@ class MangroveDrill(PolygonDrill):
 
         return chart
 
-    @log_call
     def render_outputs(self, df, chart):
         return super().render_outputs(df, chart, is_enabled=True, name="Mangrove Cover",
                                       header=['Woodland', 'Open Forest', 'Closed Forest'])
@@ -1,3 +1,4 @@
+import logging
 from datetime import datetime, timezone
 
 import numpy as np
@@ -7,7 +8,11 @@ from datacube.virtual.impl import Transformation
 from datacube.virtual.transformations import ApplyMask
 from pywps import LiteralOutput
 
-from . import PolygonDrill, geometry_mask, log_call
+from ..instrument import timed
+from ..zonal import has_zones, zonal_count, zonal_frame, zonal_sum, zone_labels
+from . import PolygonDrill
+
+LOG = logging.getLogger('PYWPS')
 
 ls_timezone = timezone.utc
 
@@ -34,38 +39,94 @@ def ls5_on_1ym(dataset):
 
 
 class WIT(PolygonDrill):
+    zonal = True
+
     def __init__(self, about, input, style):
         super().__init__(about, input, style)
         self.mask_all_touched = True
-        print("mask all touch", self.mask_all_touched)
 
     def output_formats(self):
-        return [LiteralOutput("url", "WIT timeseries data")]
+        return [LiteralOutput("url", "WIT timeseries data"),
+                LiteralOutput("plan", "Estimated cost of the request")]
 
-    @log_call
+    def incremental(self, parameters):
+        # aggregation windows are anchored at the first observation
+        return parameters.get('aggregate', 0) == 0
+
+    @timed("process_data")
     def process_data(self, data, parameters):
-        feature = parameters.get('feature')
+        # a batch of features is reduced together, one zone each
+        features = parameters.get('features') or [parameters.get('feature')]
         adays = parameters.get('aggregate', 0)
-        print("feature in wit", feature)
-        print("geobox of data", data.geobox)
-        geomask = geometry_mask(feature, data.geobox, invert=True, all_touched=self.mask_all_touched)
+        LOG.debug("WIT for %d features", len(features))
 
         if adays > 0:
             aggregated = aggregate_over_time(data, adays)
         else:
             aggregated = data
-        total_area = geomask.astype('int').sum()
-        print("polygon area", total_area)
-        re_wit = cal_area(aggregated)
-        re_wit = re_wit[(re_wit['valid']/total_area) > 0.9].dropna()
-        re_wit = re_wit.drop(columns=['valid']).div(re_wit['valid'], axis=0)
-        re_wit['geometry'] = feature.geom.convex_hull.wkt
+        # data only holds the pixels inside the polygons
+        labels, count = zone_labels(data)
+        total_area = np.bincount(labels, minlength=count)
+        LOG.debug("polygon areas %s", total_area)
+        re_wit = cal_area(aggregated, data)
+        zones = re_wit['zone'].values if has_zones(data) else 0
+        re_wit = re_wit[(re_wit['valid'] / total_area[zones]) > 0.9].dropna()
+        columns = ['water', 'wet', 'bs', 'pv', 'npv']
+        re_wit[columns] = re_wit[columns].div(re_wit['valid'], axis=0)
+        re_wit = re_wit.drop(columns=['valid'])
+        hulls = [feature.geom.convex_hull.wkt for feature in features]
+        re_wit['geometry'] = re_wit['zone'].map(hulls.__getitem__) if has_zones(data) else hulls[0]
         return re_wit
 
     def render_chart(self, df):
         pass
 
 
+# WOfS bits
+WET = 1 << 7
+# cloud, cloud shadow, noncontiguous and nodata
+NOT_CLEAR = (1 << 6) | (1 << 5) | (1 << 1) | 1
+# fmask classes for nodata, cloud and cloud shadow
+FMASK_INVALID = (0, 2, 3)
+TC_NODATA = -9999
+
+
+def wit_mask_block(fmask, contiguity, water):
+    """ Water observed and the clear pixel mask for one block of data, in a single pass. """
+    flags = np.bitwise_and(water, WET | NOT_CLEAR)
+    scratch = np.empty(flags.shape, dtype=bool)
+
+    water_value = np.empty(flags.shape, dtype='int16')
+    np.equal(flags, WET, out=scratch)
+    np.copyto(water_value, scratch, casting='unsafe')
+
+    pmask = np.equal(flags, 0)
+    np.equal(contiguity, 1, out=scratch)
+    pmask &= scratch
+    for value in FMASK_INVALID:
+        np.not_equal(fmask, value, out=scratch)
+        pmask &= scratch
+    return water_value, pmask
+
+
+def twn_mask_block(fmask, contiguity, water, *bands, weights=(), nodata=()):
+    """ Tasseled cap index, water observed and the clear pixel mask for one block of data. """
+    tci = np.zeros(water.shape, dtype='float32')
+    valid = np.ones(water.shape, dtype=bool)
+    scratch = np.empty(water.shape, dtype='float32')
+    check = np.empty(water.shape, dtype=bool)
+    for band, weight, band_nodata in zip(bands, weights, nodata):
+        np.greater(band, band_nodata, out=check)
+        valid &= check
+        np.multiply(band, np.float32(weight), out=scratch, casting='unsafe')
+        tci += scratch
+    np.logical_not(valid, out=check)
+    np.copyto(tci, TC_NODATA, where=check)
+
+    water_value, pmask = wit_mask_block(fmask, contiguity, water)
+    return tci, water_value, pmask
+
+
 class TWnMask(Transformation):
     def __init__(self, category='wetness', coeffs=None):
         self.category = category
@@ -83,32 +144,21 @@ class TWnMask(Transformation):
         self.var_name = f'TC{category[0].upper()}'
 
     def compute(self, data):
-        tci_var = 0
-        for key in self.coeffs[self.category].keys():
-            nodata = getattr(data[key], 'nodata', -1)
-            data[key] = data[key].where(data[key] > nodata)
-            tci_var += data[key] * self.coeffs[self.category][key]
-        tci_var.data[np.isnan(tci_var.data)] = -9999
-        tci_var = tci_var.astype(np.float32)
-        tci_var.attrs = dict(nodata=-9999, units=1, crs=data.attrs['crs'])
-        tci_var = tci_var.to_dataset(name=self.var_name)
-
-        def make_mask():
-            water_value = (((data.water & (1 << 7)) != 0)
-                           & (((data.water & (1 << 6)) | (data.water & (1 << 5)) | (data.water & (1 << 1))
-                               | (data.water & 1)) == 0)).astype('int16')
-            water_value.attrs = dict(nodata=0, units=1, crs=data.attrs['crs'])
-            water_value = water_value.to_dataset(name='water')
-
-            pmask = (((data.fmask != 2) & (data.fmask != 3) & (data.fmask != 0) & (data.nbart_contiguity == 1))
-                     & (((data.water & (1 << 7)) | (data.water & (1 << 6)) | (data.water & (1 << 5))
-                         | (data.water & (1 << 1)) | (data.water & 1)) == 0))
-            pmask.attrs = dict(nodata=False, units=1, crs=data.attrs['crs'])
-            pmask = pmask.to_dataset(name='pmask')
-            return pmask.merge(water_value)
-        pmask = tci_var.merge(make_mask())
-        pmask.attrs = data.attrs
-        return pmask
+        coeffs = self.coeffs[self.category]
+        # computed per block, so dask-backed data stays lazy and parallel
+        tci, water_value, pmask = xr.apply_ufunc(
+            twn_mask_block, data.fmask, data.nbart_contiguity, data.water, *[data[key] for key in coeffs],
+            kwargs=dict(weights=list(coeffs.values()),
+                        nodata=[getattr(data[key], 'nodata', -1) for key in coeffs]),
+            output_core_dims=[[], [], []],
+            dask='parallelized',
+            output_dtypes=[np.float32, np.int16, bool])
+
+        crs = data.attrs['crs']
+        tci.attrs = dict(nodata=TC_NODATA, units=1, crs=crs)
+        water_value.attrs = dict(nodata=0, units=1, crs=crs)
+        pmask.attrs = dict(nodata=False, units=1, crs=crs)
+        return xr.Dataset({self.var_name: tci, 'pmask': pmask, 'water': water_value}, attrs=data.attrs)
 
     def measurements(self, input_measurements):
         return {self.var_name: Measurement(name=self.var_name, dtype='float32', nodata=-9999, units='1'),
@@ -117,97 +167,121 @@ class TWnMask(Transformation):
 
 
 def mask_data(loaded):
-    def make_mask():
-        # water mask
-        # flags = {'cloud': False,
-        #    'cloud_shadow': False,
-        #    'noncontiguous': False,
-        #    'water_observed': False,
-        #    'nodata': False
-        #    }
-        # water value
-        # flags = {'cloud': False,
-        #    'cloud_shadow': False,
-        #    'noncontiguous': False,
-        #    'water_observed': True,
-        #    'nodata': False
-        #    }
-        water_value = (((loaded.water & (1 << 7)) != 0)
-                       & (((loaded.water & (1 << 6)) | (loaded.water & (1 << 5)) | (loaded.water & (1 << 1))
-                           | (loaded.water & 1)) == 0)).astype('int16').to_dataset(name='water')
-        pmask = (((loaded.fmask != 2) & (loaded.fmask != 3) & (loaded.fmask != 0) & (loaded.nbart_contiguity == 1))
-                 & (((loaded.water & (1 << 7)) | (loaded.water & (1 << 6)) | (loaded.water & (1 << 5))
-                     | (loaded.water & (1 << 1)) | (loaded.water & 1)) == 0)).to_dataset(name='pmask')
-        return pmask.merge(water_value)
-
-    pmask = make_mask()
-    loaded = loaded.drop(['fmask', 'nbart_contiguity', 'water']).merge(pmask)
+    water_value, pmask = xr.apply_ufunc(
+        wit_mask_block, loaded.fmask, loaded.nbart_contiguity, loaded.water,
+        output_core_dims=[[], []],
+        dask='parallelized',
+        output_dtypes=[np.int16, bool])
+
+    loaded = loaded.drop(['fmask', 'nbart_contiguity', 'water'])
+    loaded = loaded.merge(xr.Dataset({'pmask': pmask, 'water': water_value}))
     loaded = ApplyMask('pmask', apply_to=['bs', 'pv', 'npv', 'TCW']).compute(loaded)
     return loaded
 
 
-def average_over_day(masked):
+def time_windows(times, days):
+    # windows are anchored at their first observation and span `days` days from it,
+    # the next window starts at the first observation left over
+    starts = []
+    start = 0
+    while start < len(times):
+        starts.append(start)
+        end = np.searchsorted(times, times[start] + np.timedelta64(days, 'D'), side='left')
+        start = max(int(end), start + 1)
+    starts = np.array(starts, dtype='int64')
+    labels = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(times))))
+    return starts, labels
+
+
+def _invalid(var):
+    return np.abs(var - var.attrs['nodata']) < 1e-5
+
+
+def _per_window(grouped, masked, starts):
+    # one row per window, stamped with the time of its first observation
+    grouped = grouped.rename(window='time').assign_coords(time=masked.time.data[starts])
+    return grouped.transpose('time', ...)
+
+
+def average_over_day(masked, starts, labels):
+    windows = xr.DataArray(labels, dims='time', coords={'time': masked.time}, name='window')
+    sizes = xr.DataArray(np.diff(np.append(starts, masked.time.size)), dims='window')
+
     tmp = xr.Dataset()
     for var in masked.data_vars:
         if var != 'water':
-            valid_var = ~(np.abs(masked[var] - masked[var].attrs['nodata']) < 1e-5)
-            # to suppress the warnings from dask if using `mean`
-            # haven't got another way
-            tmp[var] = ((masked[var].where(valid_var).sum('time', skipna=False, keep_attrs=True) / masked.time.shape[0])
+            # a pixel is only averaged if it is valid at every observation in the window
+            valid_var = ~_invalid(masked[var])
+            total = masked[var].where(valid_var, 0).groupby(windows).sum(skipna=False)
+            invalid = (~valid_var).groupby(windows).any()
+            tmp[var] = ((total / sizes).where(~invalid)
                         .fillna(masked[var].attrs['nodata']).astype('float32'))
         else:
-            tmp[var] = masked[var].astype('int16').sum('time', keep_attrs=True).astype('int16')
+            tmp[var] = masked[var].astype('int16').groupby(windows).sum().astype('int16')
         tmp[var].attrs = masked[var].attrs
 
-    tmp = tmp.expand_dims(time=masked.time[0:1], axis=0)
+    tmp = _per_window(tmp, masked, starts)
     tmp.attrs = masked.attrs
     return tmp
 
 
-def aggregate_data(masked):
-    tmp = masked[dict(time=[0])].copy(deep=True)
-    for time in masked.time.data[1:]:
-        for var in masked.data_vars:
-            if var != 'water':
-                valid_var = ~(np.abs(tmp[var] - masked[var].attrs['nodata']) < 1e-5) | tmp.water > 0
-            else:
-                valid_var = ~(np.abs(tmp.TCW - masked.TCW.attrs['nodata']) < 1e-5) | tmp.water > 0
-            tmp[var] = tmp[var].where(valid_var, 0) + masked[var].sel(time=time).where(~valid_var, 0)
-            tmp[var].attrs = masked[var].attrs
+def aggregate_data(masked, starts, labels):
+    windows = xr.DataArray(labels, dims='time', coords={'time': masked.time}, name='window')
+    is_first = np.zeros(masked.time.size, dtype=bool)
+    is_first[starts] = True
+    is_first = xr.DataArray(is_first, dims='time', coords={'time': masked.time})
+    is_last = np.zeros(masked.time.size, dtype=bool)
+    is_last[np.append(starts[1:], masked.time.size) - 1] = True
+    is_last = xr.DataArray(is_last, dims='time', coords={'time': masked.time})
+
+    def first_or_last(key):
+        # the first observation in the window where `key` holds, or the last if there is none
+        seen = key.astype('int32').groupby(windows).cumsum()
+        return (key & (seen == 1)) | (is_last & (seen == 0))
+
+    # the wetness of a pixel is that of the first observation in the window that is valid or wet,
+    # its water goes along unless the wetness only became valid after the first observation,
+    # and once the pixel is wet every band keeps what it holds
+    wet = masked.water > 0
+    valid_tcw = ~_invalid(masked.TCW)
+    chosen_tcw = first_or_last(valid_tcw | wet)
+    chosen_water = chosen_tcw & (~valid_tcw | is_first)
+    wet_since = (chosen_water & wet).astype('int32').groupby(windows).cumsum() > 0
+
+    tmp = xr.Dataset()
+    for var in masked.data_vars:
+        if var == 'water':
+            chosen = chosen_water
+        elif var == 'TCW':
+            chosen = chosen_tcw
+        else:
+            chosen = first_or_last(~_invalid(masked[var]) | wet_since)
+        tmp[var] = (masked[var].where(chosen, 0).groupby(windows).sum(skipna=False)
+                    .astype(masked[var].dtype))
+        tmp[var].attrs = masked[var].attrs
+
+    tmp = _per_window(tmp, masked, starts)
+    tmp.attrs = masked.attrs
     return tmp
 
 
 def aggregate_over_time(masked, days):
-    i_start = 0
-    i_end = i_start + 1
-    aggregated = None
-    print("aggregate over days", days)
-    while i_end < masked.time.size:
-        time = masked.time.data[i_start]
-        while np.abs(time - masked.time.data[i_end]).astype('timedelta64[D]') < np.timedelta64(days, 'D'):
-            i_end += 1
-            if i_end >= masked.time.size:
-                break
-        if days > 1:
-            tmp = aggregate_data(masked[dict(time=np.arange(i_start, i_end))])
-        else:
-            tmp = average_over_day(masked[dict(time=np.arange(i_start, i_end))])
-        if aggregated is None:
-            aggregated = tmp
-        else:
-            aggregated = xr.concat([aggregated, tmp], dim='time')
-        i_start = i_end
-        i_end = i_start + 1
-    print("finish aggregating", datetime.now())
+    starts, labels = time_windows(masked.time.data, days)
+    if days > 1:
+        aggregated = aggregate_data(masked, starts, labels)
+    else:
+        aggregated = average_over_day(masked, starts, labels)
     return aggregated
 
 
-def cal_area(aggregated, wet_threshold=-350):
-    non_columns = ['spatial_ref']
-    water = aggregated.water.sum(dim=['x', 'y']).to_dataset(name='water')
+def cal_area(aggregated, data=None, wet_threshold=-350):
+    # per zone areas, `data` holds the zones when they were lost in aggregation
+    data = aggregated if data is None else data
     valid = np.abs(aggregated.TCW - aggregated.TCW.attrs['nodata']) > 1e-5
-    valid_area = (water.water + valid.sum(dim=['x', 'y'])).to_dataset(name='valid')
-    wet = (aggregated.TCW > wet_threshold).astype('int').sum(dim=['x', 'y']).to_dataset(name='wet')
-    fc_com = (aggregated[['bs', 'pv', 'npv']].where(((aggregated.TCW < wet_threshold) & valid), 0)
-              / 100).sum(dim=['x', 'y'])
-    return xr.merge([valid_area, water, wet, fc_com]).load().to_dataframe().drop(columns=non_columns)
+    water = zonal_sum(aggregated.water, data)
+    valid_area = water + zonal_count(valid, data)
+    wet = zonal_count(aggregated.TCW > wet_threshold, data)
+    dry = (aggregated.TCW < wet_threshold) & valid
+    fc_com = {band: zonal_sum(aggregated[band].where(dry, 0) / 100, data) for band in ['bs', 'pv', 'npv']}
+    result = xr.Dataset({'valid': valid_area, 'water': water, 'wet': wet, **fc_com}).load()
+    return zonal_frame(result, data).set_index('time')
@@ -1,9 +1,80 @@
+import json
+
 import altair
 import datacube
 import numpy as np
+import pandas
 from pywps import ComplexInput, ComplexOutput, LiteralOutput
 
-from . import FORMATS, PixelDrill, chart_dimensions, log_call
+from ..instrument import timed
+from . import FORMATS, PixelDrill, chart_dimensions
+
+OBSERVATIONS = ['wet', 'dry', 'not observable']
+
+# applied in sequence, the first rule to match decides the observation
+WOFS_RULES = [
+    {
+        'op': any,
+        'flags': ['terrain_or_low_angle', 'cloud_shadow', 'cloud', 'high_slope', 'noncontiguous'],
+        'value': 'not observable'
+    },
+    {
+        'op': all,
+        'flags': ['dry', 'sea'],
+        'value': 'not observable'
+    },
+    {
+        'op': any,
+        'flags': ['dry'],
+        'value': 'dry'
+    },
+    {
+        'op': any,
+        'flags': ['wet', 'sea'],
+        'value': 'wet'
+    }
+]
+
+
+def classify_flags(flags_definition, rules, value, default='not observable'):
+    flag_dict = datacube.utils.masking.mask_to_dict(flags_definition, value)
+    flags = list(filter(flag_dict.get, flag_dict))
+    for rule in rules:
+        if rule['op']([r in flags for r in rule['flags']]):
+            return rule['value']
+    return default
+
+
+def compile_classifier(flags_definition, rules, default='not observable'):
+    """
+    Compile `rules` over `flags_definition` into a function mapping an array
+    of flag values to codes into `OBSERVATIONS`.
+    """
+    bits = 0
+    for definition in flags_definition.values():
+        flag_bits = definition['bits'] if isinstance(definition['bits'], list) else [definition['bits']]
+        for bit in flag_bits:
+            bits |= 1 << bit
+
+    # values that agree on the defined bits decode to the same flags,
+    # so classifying each combination once gives a complete lookup table
+    lut = np.array([OBSERVATIONS.index(classify_flags(flags_definition, rules, value, default))
+                    for value in range(bits + 1)], dtype='int8')
+
+    def classify(values):
+        return lut[np.asarray(values).astype('int64') & bits]
+
+    return classify
+
+
+_CLASSIFIERS = {}
+
+
+def wofs_classifier(flags_definition):
+    key = json.dumps(flags_definition, sort_keys=True, default=str)
+    if key not in _CLASSIFIERS:
+        _CLASSIFIERS[key] = compile_classifier(flags_definition, WOFS_RULES)
+    return _CLASSIFIERS[key]
 
 
 class WOfSDrill(PixelDrill):
@@ -15,57 +86,22 @@ class WOfSDrill(PixelDrill):
                 LiteralOutput("url", "WOfS Pixel Drill Graph"),
                 ComplexOutput('timeseries', 'Timeseries Drill', supported_formats=[FORMATS['output_json']])]
 
-    @log_call
+    @timed("process_data")
     def process_data(self, data, parameters):
         # TODO raise ProcessError('query returned no data') when appropriate
 
-        rules = [
-            {
-                'op': any,
-                'flags': ['terrain_or_low_angle', 'cloud_shadow', 'cloud', 'high_slope', 'noncontiguous'],
-                'value': 'not observable'
-            },
-            {
-                'op': all,
-                'flags': ['dry', 'sea'],
-                'value': 'not observable'
-            },
-            {
-                'op': any,
-                'flags': ['dry'],
-                'value': 'dry'
-            },
-            {
-                'op': any,
-                'flags': ['wet', 'sea'],
-                'value': 'wet'
-            }
-        ]
-
         # TODO: investigate why PixelDrill is changing datatype
         water = data.data_vars['water']
-        data['observation'] = water.astype('int16')
-        data = data.drop_vars(['water'])
+        classify = wofs_classifier(water.attrs['flags_definition'])
 
-        def get_flags(val):
-            flag_dict = datacube.utils.masking.mask_to_dict(water.attrs['flags_definition'], val)
-            flags = list(filter(flag_dict.get, flag_dict))
-            # apply rules in sequence
-            ret_val = 'not observable'
-            for rule in rules:
-                if rule['op']([r in flags for r in rule['flags']]):
-                    ret_val = rule['value']
-                    break
-            return ret_val
-        gf = np.vectorize(get_flags)
-
-        data['observation'].values = gf(data['observation'].values)
+        data['observation'] = water.copy(data=classify(water.values))
+        data = data.drop_vars(['water'])
 
         df = data.to_dataframe()
         df.reset_index(inplace=True)
+        df['observation'] = pandas.Categorical.from_codes(df['observation'], categories=OBSERVATIONS)
         return df
 
-    @log_call
     def render_chart(self, df):
         width, height = chart_dimensions(self.style)
 
@@ -92,7 +128,6 @@ class WOfSDrill(PixelDrill):
                                                      type='temporal')])
         return chart
 
-    @log_call
     def render_outputs(self, df, chart):
         return super().render_outputs(df, chart,
                                       is_enabled=False, name="WOfS", header=['Observation'])
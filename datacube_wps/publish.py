@@ -0,0 +1,258 @@
+import io
+import json
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit
+
+import boto3
+import pywps.configuration as config
+from botocore.client import Config
+from botocore.exceptions import ClientError
+
+from .render import MIMETYPES, RENDERER
+from .settings import config_number
+
+LOG = logging.getLogger('PYWPS')
+
+
+def deferred_charts():
+    # deferred charts store only the Vega-Lite spec, and are rendered when first fetched
+    return config.get_config_value("output", "charts", "eager") == "deferred"
+
+
+def chart_url(name, format):
+    base = config.get_config_value("server", "url").rstrip("/")
+    return f"{base}/charts/{name}/chart.{format}"
+
+
+def _then(future, func):
+    # a future for `func(future.result())`, without tying up a pool thread waiting,
+    # `func` may itself return a future
+    result = Future()
+
+    def forward(completed):
+        try:
+            result.set_result(completed.result())
+        except Exception as e:  # pylint: disable=broad-except
+            result.set_exception(e)
+
+    def done(completed):
+        try:
+            value = func(completed.result())
+        except Exception as e:  # pylint: disable=broad-except
+            result.set_exception(e)
+            return
+        if isinstance(value, Future):
+            value.add_done_callback(forward)
+        else:
+            result.set_result(value)
+
+    future.add_done_callback(done)
+    return result
+
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class MultipartUpload(io.RawIOBase):
+    """
+    A writable file streaming into an S3 multipart upload. Parts are uploaded in the
+    background as soon as they fill up, with at most `max_pending` of them in memory
+    besides the one being filled. Outputs smaller than a part are stored with a single put.
+    The upload is aborted if the file is left through an exception.
+    """
+
+    def __init__(self, client, executor, bucket, key, part_size=8 * 1024 * 1024, max_pending=2, **extra):
+        super().__init__()
+        self._client = client
+        self._executor = executor
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.max_pending = max_pending
+        self._extra = extra
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            self._send(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, number, body):
+        response = self._client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                            PartNumber=number, Body=body)
+        return {"ETag": response["ETag"], "PartNumber": number}
+
+    def _send(self, body):
+        if self._upload_id is None:
+            response = self._client.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self._extra)
+            self._upload_id = response["UploadId"]
+
+        # bound the memory held by parts still uploading
+        pending = [part for part in self._parts if not part.done()]
+        if len(pending) >= self.max_pending:
+            pending[0].result()
+        self._parts.append(self._executor.submit(self._upload_part, len(self._parts) + 1, bytes(body)))
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self._client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer), **self._extra)
+            else:
+                if self._buffer:
+                    self._send(self._buffer)
+                parts = [part.result() for part in self._parts]
+                self._client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                                       MultipartUpload={"Parts": parts})
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            super().close()
+
+    def abort(self):
+        if self._upload_id is not None:
+            for part in self._parts:
+                part.cancel()
+            self._client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            self._upload_id = None
+        self._buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class OutputPublisher:
+    """
+    Uploads request outputs to the results bucket through a single, connection-pooled
+    S3 client shared by all requests of a worker process, from a small thread pool so
+    that the uploads of a request run concurrently with each other and with rendering.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._executor = None
+
+    @property
+    def bucket(self):
+        return config.get_config_value("s3", "bucket")
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                pool_size = config_number("s3", "max_pool_connections", 16, int)
+                self._client = boto3.Session().client("s3", config=Config(max_pool_connections=pool_size))
+            return self._client
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=config_number("s3", "upload_threads", 8, int),
+                                                    thread_name_prefix="publish")
+            return self._executor
+
+    def public_url(self, key):
+        # the unsigned form of a presigned url, built locally without a request
+        url = self.client.generate_presigned_url(ClientMethod="get_object",
+                                                 ExpiresIn=0,
+                                                 Params={"Bucket": self.bucket, "Key": key})
+        return urlunsplit(urlsplit(url)._replace(query=""))
+
+    def url(self, key, public=True):
+        if public:
+            return self.public_url(key)
+        return f"s3://{self.bucket}/{key}"
+
+    @staticmethod
+    def _extra(mimetype, public):
+        extra = {}
+        if mimetype is not None:
+            extra["ContentType"] = mimetype
+        if public:
+            extra["ACL"] = "public-read"
+        return extra
+
+    def upload(self, key, body, mimetype=None, public=True):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=bytes(body), **self._extra(mimetype, public))
+        return self.url(key, public)
+
+    def open(self, key, mimetype=None, public=True):
+        """ A file streaming into `key`, for outputs too large to build in memory first. """
+        part_size = config_number("s3", "part_size_mb", 8, int) * 1024 * 1024
+        return MultipartUpload(self.client, self.executor, self.bucket, key,
+                               part_size=part_size, **self._extra(mimetype, public))
+
+    def submit(self, key, render, mimetype=None, public=True):
+        """
+        Render and upload an output in the background. `render` is called on a
+        pool thread and returns the body. Returns a future for the url.
+        """
+        return self.executor.submit(lambda: self.upload(key, render(), mimetype, public=public))
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return response["Body"].read()
+
+    def publish_chart(self, name, spec):
+        """ Futures for the urls of the HTML and SVG renderings of a chart, by format. """
+        if not deferred_charts():
+            # rendered in one go by the render workers, then uploaded side by side
+            rendered = self.executor.submit(RENDERER.render, spec, MIMETYPES)
+            return {format: _then(rendered, lambda bodies, format=format, mimetype=mimetype:
+                                  self.submit(f"{name}/chart.{format}", lambda: bodies[format], mimetype))
+                    for format, mimetype in MIMETYPES.items()}
+
+        stored = self.submit(f"{name}/chart.json", lambda: json.dumps(spec).encode(),
+                             "application/json", public=False)
+        return {format: _then(stored, lambda _, format=format: chart_url(name, format))
+                for format in MIMETYPES}
+
+    def deferred_chart(self, name, format):
+        """ The rendered chart, rendering and storing it on first access. `None` if there is no such chart. """
+        key = f"{name}/chart.{format}"
+        body = self.get(key)
+        if body is not None:
+            return body
+
+        spec = self.get(f"{name}/chart.json")
+        if spec is None:
+            return None
+
+        body = RENDERER.render(json.loads(spec), [format])[format]
+        self.upload(key, body, MIMETYPES[format])
+        return body
+
+    def _reset(self):
+        # connections and threads do not survive a fork
+        self._lock = threading.Lock()
+        self._client = None
+        self._executor = None
+
+
+PUBLISHER = OutputPublisher()
+
+os.register_at_fork(after_in_child=PUBLISHER._reset)  # pylint: disable=protected-access
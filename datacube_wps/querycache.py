@@ -0,0 +1,136 @@
+import json
+import math
+import os
+import threading
+import time as timer
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+
+from datacube.utils.geometry import box as bounding_box
+from datacube.virtual.impl import VirtualDatasetBag
+from prometheus_client import Counter
+
+from .settings import config_number
+
+QUERY_CACHE_LOOKUPS = Counter('datacube_wps_query_cache_lookups_total',
+                              'Index query cache lookups by outcome',
+                              ['outcome'])
+
+
+def filter_bag(bag, keep):
+    # the same nesting of datasets as the bag, with only those kept
+    if isinstance(bag, Sequence):
+        return [dataset for dataset in bag if keep(dataset)]
+    return {key: [filter_bag(child, keep) for child in children] for key, children in bag.items()}
+
+
+def _canonical(product):
+    # virtual product recipes nest, functions in them are identified by name and address
+    if isinstance(product, Mapping):
+        return {key: _canonical(value) for key, value in product.items()}
+    if isinstance(product, (list, tuple)):
+        return [_canonical(value) for value in product]
+    return product
+
+
+def _query(product, dc, time, geopolygon):
+    if time is None:
+        return product.query(dc, geopolygon=geopolygon)
+    return product.query(dc, time=time, geopolygon=geopolygon)
+
+
+def tile(geopolygon, size):
+    """ The longitude and latitude box of whole tiles of `size` degrees covering `geopolygon`. """
+    bbox = geopolygon.to_crs('EPSG:4326').boundingbox
+    left, bottom = math.floor(bbox.left / size) * size, math.floor(bbox.bottom / size) * size
+    right, top = math.ceil(bbox.right / size) * size, math.ceil(bbox.top / size) * size
+    # points and tile aligned edges still need a tile of their own
+    right, top = max(right, left + size), max(top, bottom + size)
+    return bounding_box(round(left, 9), round(bottom, 9), round(right, 9), round(top, 9), 'EPSG:4326')
+
+
+class QueryCache:
+    """
+    Results of virtual product index queries, per worker process. Queries are widened to
+    whole tiles of `tile_size` degrees, so that drills at nearby locations over the same
+    time range share an entry, and the datasets of a tile are then narrowed down to those
+    the query polygon overlaps, as the index would. Entries expire after `ttl` seconds,
+    datasets indexed, archived or updated in the meantime are only seen after that.
+    """
+
+    def __init__(self, ttl=600.0, tile_size=0.1, max_entries=256):
+        self.ttl = ttl
+        self.tile_size = tile_size
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, "miss"
+
+            created, bag = entry
+            if self.ttl and timer.monotonic() - created > self.ttl:
+                del self._entries[key]
+                return None, "expired"
+
+            self._entries.move_to_end(key)
+            return bag, "hit"
+
+    def _store(self, key, bag):
+        with self._lock:
+            self._entries[key] = (timer.monotonic(), bag)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def query(self, product, dc, time, geopolygon):
+        """ The datasets of `product` over `geopolygon` and `time`, as `product.query` would find them. """
+        area = tile(geopolygon, self.tile_size)
+        key = json.dumps({"product": _canonical(product),
+                          "tile": list(area.boundingbox),
+                          "time": None if time is None else [str(t) for t in time]},
+                         sort_keys=True, default=repr)
+
+        bag, outcome = self._lookup(key)
+        QUERY_CACHE_LOOKUPS.labels(outcome).inc()
+        if bag is None:
+            bag = _query(product, dc, time, area)
+            self._store(key, bag)
+
+        def overlaps(dataset):
+            return dataset.extent is None or dataset.extent.intersects(geopolygon.to_crs(dataset.crs))
+
+        return VirtualDatasetBag(filter_bag(bag.bag, overlaps), geopolygon, bag.product_definitions)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_QUERY_CACHE = []
+_QUERY_CACHE_LOCK = threading.Lock()
+
+
+def query_cache():
+    """ The index query cache of this worker, or `None` if it is disabled. """
+    with _QUERY_CACHE_LOCK:
+        if not _QUERY_CACHE:
+            max_entries = config_number("query_cache", "max_entries", 0, int)
+            _QUERY_CACHE.append(QueryCache(ttl=config_number("query_cache", "ttl", 600.0),
+                                           tile_size=config_number("query_cache", "tile_size", 0.1),
+                                           max_entries=max_entries)
+                                if max_entries > 0 else None)
+        return _QUERY_CACHE[0]
+
+
+def query_datasets(product, dc, time, geopolygon):
+    """ `product.query` for `time` and `geopolygon`, through the query cache when it is enabled. """
+    cache = query_cache()
+    if cache is None:
+        return _query(product, dc, time, geopolygon)
+    return cache.query(product, dc, time, geopolygon)
+
+
+os.register_at_fork(after_in_child=_QUERY_CACHE.clear)
@@ -0,0 +1,187 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+import altair
+from altair.utils.mimebundle import spec_to_mimebundle
+
+from .settings import config_number
+
+LOG = logging.getLogger('PYWPS')
+
+MIMETYPES = {"html": "text/html", "svg": "image/svg+xml"}
+
+WARM_SPEC = {
+    "$schema": altair.SCHEMA_URL,
+    "data": {"values": [{"x": 0, "y": 0}, {"x": 1, "y": 1}]},
+    "mark": "line",
+    "encoding": {"x": {"field": "x", "type": "quantitative"}, "y": {"field": "y", "type": "quantitative"}},
+}
+
+
+def chart_spec(chart):
+    """ The Vega-Lite spec of a chart, with all data inlined. """
+    with altair.data_transformers.enable("default"), altair.data_transformers.disable_max_rows():
+        return chart.to_dict(context={"pre_transform": False})
+
+
+def render_chart(spec, format):
+    """ Render a Vega-Lite spec to HTML or SVG bytes. """
+    bundle = spec_to_mimebundle(spec=spec,
+                                format=format,
+                                mode="vega-lite",
+                                vega_version=altair.VEGA_VERSION,
+                                vegaembed_version=altair.VEGAEMBED_VERSION,
+                                vegalite_version=altair.VEGALITE_VERSION)
+    return bundle[MIMETYPES[format]].encode()
+
+
+def render_formats(spec, formats):
+    # all renderings of a chart are made in one call, so the spec is only sent once
+    return {format: render_chart(spec, format) for format in formats}
+
+
+def _warm():
+    # start the JavaScript runtime behind vl-convert before the first real chart arrives
+    render_chart(WARM_SPEC, "svg")
+
+
+def _serve(conn):
+    # a render worker: specs in, their renderings or the error raised out
+    _warm()
+    while True:
+        try:
+            spec, formats = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send((render_formats(spec, formats), None))
+        except Exception as e:  # pylint: disable=broad-except
+            conn.send((None, e))
+
+
+class RenderWorker:
+    """ A worker process rendering one chart at a time, sent over a pipe. """
+
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        # a daemon, so that it goes away with the request handling process
+        self.process = context.Process(target=_serve, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+
+    def render(self, spec, formats, timeout=None):
+        """ Renderings of a spec by format and the error raised making them, if any. """
+        try:
+            self.conn.send((spec, formats))
+            if self.conn.poll(timeout):
+                return self.conn.recv()
+        except (EOFError, OSError) as e:
+            raise BrokenProcessPool("chart render worker died") from e
+        raise FutureTimeout(f"chart rendering took longer than {timeout}s")
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+class RenderPool:
+    """
+    Worker processes that keep the chart renderer warm and render charts out of the
+    request handling process. With no workers configured charts are rendered in-process.
+    A render past its timeout only takes down the worker it runs on, which is replaced.
+    """
+
+    def __init__(self, workers=None, timeout=None):
+        self._lock = threading.Lock()
+        self._idle = None
+        self._workers = workers
+        self._timeout = timeout
+        # spawned rather than forked, the request handling process has threads of its own
+        self._context = multiprocessing.get_context("spawn")
+
+    @property
+    def workers(self):
+        if self._workers is None:
+            return config_number("output", "render_workers", 2, int)
+        return self._workers
+
+    @property
+    def timeout(self):
+        if self._timeout is None:
+            return config_number("output", "render_timeout", 60.0)
+        return self._timeout
+
+    def _pool(self):
+        with self._lock:
+            if self._idle is None:
+                LOG.info("starting %d chart render workers", self.workers)
+                self._idle = queue.Queue()
+                for _ in range(self.workers):
+                    self._idle.put(RenderWorker(self._context))
+            return self._idle
+
+    def _put_back(self, idle, worker):
+        with self._lock:
+            if idle is self._idle:
+                idle.put(worker)
+                return
+        # the pool was shut down while the worker was rendering
+        worker.stop()
+
+    def _replace(self, idle, worker):
+        worker.stop()
+        self._put_back(idle, RenderWorker(self._context))
+
+    def render(self, spec, formats):
+        """ Renderings of a Vega-Lite spec by format. """
+        formats = list(formats)
+        if not self.workers:
+            return render_formats(spec, formats)
+
+        for attempt in range(2):
+            idle = self._pool()
+            worker = idle.get()
+            try:
+                result, error = worker.render(spec, formats, timeout=self.timeout)
+            except BrokenProcessPool:
+                # the worker died, replace it and try once more
+                LOG.warning("chart render worker died, restarting it")
+                self._replace(idle, worker)
+                if attempt:
+                    raise
+                continue
+            except FutureTimeout:
+                LOG.error("chart rendering took longer than %ss", self.timeout)
+                self._replace(idle, worker)
+                raise
+            except BaseException:
+                # its reply to this chart would be taken for the next one
+                self._replace(idle, worker)
+                raise
+            self._put_back(idle, worker)
+            if error is not None:
+                raise error
+            return result
+        return None
+
+    def shutdown(self):
+        with self._lock:
+            idle, self._idle = self._idle, None
+        while idle is not None and not idle.empty():
+            idle.get().stop()
+
+    def _reset(self):
+        # the workers belong to the parent process
+        self._lock = threading.Lock()
+        self._idle = None
+
+
+RENDERER = RenderPool()
+
+os.register_at_fork(after_in_child=RENDERER._reset)  # pylint: disable=protected-access
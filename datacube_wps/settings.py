@@ -0,0 +1,27 @@
+import pywps.configuration as config
+
+# pywps turns true and false into booleans itself
+TRUE = (True, "1", "yes", "on")
+FALSE = (False, "0", "no", "off")
+
+
+def config_number(section, option, default, kind=float):
+    """ A number from the pywps configuration, `default` if it is not set. """
+    value = config.get_config_value(section, option, "")
+    if value in ("", None):
+        return default
+    return kind(value)
+
+
+def config_bool(section, option, default):
+    """ A flag from the pywps configuration, `default` if it is not set. """
+    value = config.get_config_value(section, option, "")
+    if value in ("", None):
+        return default
+    if isinstance(value, str):
+        value = value.lower()
+    if value in TRUE:
+        return True
+    if value in FALSE:
+        return False
+    raise ValueError(f"[{section}] {option} is not a boolean: {value}")
@@ -6,6 +6,8 @@ from prometheus_flask_exporter.multiprocess import \
     GunicornInternalPrometheusMetrics
 from sentry_sdk.integrations.flask import FlaskIntegration
 
+from .instrument import enable_stage_timing
+
 LOG_FORMAT = ('%(asctime)s] [%(levelname)s] file=%(pathname)s line=%(lineno)s '
               'module=%(module)s function=%(funcName)s %(message)s')
 
@@ -20,6 +22,8 @@ def setup_logger():
 def initialise_prometheus(app, log=None):
     if os.environ.get("PROMETHEUS_MULTIPROC_DIR", False):
         metrics = GunicornInternalPrometheusMetrics(app)
+        # request stages are timed into histograms collected from every worker process
+        enable_stage_timing()
         if log:
             log.info("Prometheus metrics enabled")
         return metrics
@@ -0,0 +1,77 @@
+import logging
+import threading
+
+from .cluster import cluster_client
+from .connection import shared_datacube
+from .render import RENDERER, WARM_SPEC
+
+LOG = logging.getLogger('PYWPS')
+
+
+def warm_index():
+    # connects to the index and loads the product definitions
+    with shared_datacube() as dc:
+        list(dc.index.products.get_all())
+
+
+def warm_clusters():
+    # starts the dask clusters, they shut down again if left idle past their timeout
+    for kind in ["pixel", "polygon"]:
+        with cluster_client(kind):
+            pass
+
+
+def warm_renderer():
+    RENDERER.render(WARM_SPEC, ["svg"])
+
+
+class Warmup:
+    """
+    Builds the pywps service and warms up what requests depend on, in a background
+    thread started when a worker boots, rather than on the first request. The service
+    is still built on demand if a request arrives first. A worker is ready once every
+    step has been run and none of the `required` steps has failed.
+    """
+
+    def __init__(self, build_service, steps=None, required=("catalog", "index")):
+        self._build_service = build_service
+        self._service = None
+        self._lock = threading.Lock()
+        self._thread = None
+        if steps is None:
+            steps = {"index": warm_index, "dask": warm_clusters, "renderer": warm_renderer}
+        # the catalog comes first, building the service loads the pywps configuration
+        self.steps = {"catalog": self.service, **steps}
+        self.required = required
+        self.state = {step: "pending" for step in self.steps}
+
+    def service(self):
+        with self._lock:
+            if self._service is None:
+                self._service = self._build_service()
+            return self._service
+
+    def run(self):
+        for name, step in self.steps.items():
+            self.state[name] = "running"
+            try:
+                step()
+            except Exception as e:  # pylint: disable=broad-except
+                LOG.exception("warm up step %s failed", name)
+                self.state[name] = f"failed: {e}"
+            else:
+                self.state[name] = "ready"
+        LOG.info("warm up finished %s", self.state)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name="warmup", daemon=True)
+                self._thread.start()
+        return self._thread
+
+    @property
+    def ready(self):
+        state = dict(self.state)
+        finished = all(value == "ready" or value.startswith("failed") for value in state.values())
+        return finished and all(state.get(step, "ready") == "ready" for step in self.required)
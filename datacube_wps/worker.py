@@ -0,0 +1,166 @@
+import argparse
+import ctypes
+import json
+import logging
+import os
+import socket
+import threading
+
+from pywps import Service, WPSRequest
+from pywps.app.exceptions import ProcessError
+from pywps.response.execute import ExecuteResponse
+from pywps.response.status import WPS_STATUS
+
+from .impl import read_process_catalog
+from .jobqueue import job_queue
+from .settings import config_number
+from .startup_utils import setup_logger, setup_sentry
+
+LOG = logging.getLogger('PYWPS')
+
+
+class Retry(BaseException):
+    """
+    A failed attempt at a job that is to be retried. It derives from `BaseException` to get past
+    pywps, which would otherwise report the execution as failed in its status document.
+    """
+
+
+class LeaseLost(BaseException):
+    """ The lease on a running job was lost to another worker, the attempt is abandoned. """
+
+
+def _interrupt(thread_id):
+    # raised in the thread at its next instruction, as KeyboardInterrupt would be
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id), ctypes.py_object(LeaseLost))
+
+
+class Worker:
+    """
+    Runs queued asynchronous executions, one at a time, writing their status documents to the
+    configured output store as pywps would. An attempt failing with anything but a `ProcessError`
+    is retried after `retry_delay` seconds, doubling with each attempt, until the job runs out
+    of attempts. An attempt is abandoned as soon as the lease on its job is lost.
+    """
+
+    def __init__(self, queue, service, name=None, poll=1.0, retry_delay=30.0):
+        self.queue = queue
+        self.service = service
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.poll = poll
+        self.retry_delay = retry_delay
+        self._stop = threading.Event()
+        self._running = threading.Lock()
+
+    def _prepare(self, job):
+        # as pywps does for the requests it stores when over its parallelprocesses limit
+        wps_request = WPSRequest()
+        wps_request.json = json.loads(job.request)
+        process = self.service.prepare_process_for_execution(job.identifier)
+        process._set_uuid(job.uuid)  # pylint: disable=protected-access
+        process._setup_status_storage()  # pylint: disable=protected-access
+        process.async_ = True
+        process.setup_outputs_from_wps_request(wps_request)
+        wps_response = ExecuteResponse(wps_request, process=process, uuid=job.uuid)
+        wps_response.store_status_file = True
+        return process, wps_request, wps_response
+
+    def _keep_lease(self, job, done, runner):
+        while not done.wait(self.queue.lease / 3):
+            if not self.queue.renew(job.uuid, self.name):
+                LOG.warning("lost the lease on job %s, abandoning it", job.uuid)
+                with self._running:
+                    if not done.is_set():
+                        _interrupt(runner)
+                return
+
+    def run_job(self, job):
+        # pylint: disable=protected-access
+        process, wps_request, wps_response = self._prepare(job)
+        if job.attempts > job.max_attempts:
+            message = f"Process failed after {job.max_attempts} attempts, please check server error log"
+            wps_response._update_status(WPS_STATUS.FAILED, message, 100)
+            self.queue.fail(job.uuid, self.name, message)
+            return
+
+        handler = process.handler
+
+        def attempt(request, response):
+            try:
+                return handler(request, response)
+            except ProcessError:
+                raise
+            except Exception as e:
+                if job.attempts < job.max_attempts:
+                    raise Retry(str(e)) from e
+                raise
+
+        process.handler = attempt
+        done = threading.Event()
+        lease = threading.Thread(target=self._keep_lease, args=(job, done, threading.get_ident()), daemon=True)
+        lease.start()
+        LOG.info("running %s job %s, attempt %d of %d", job.identifier, job.uuid, job.attempts, job.max_attempts)
+        try:
+            try:
+                process._run_process(wps_request, wps_response)
+            finally:
+                # once done the attempt is no longer interrupted, an interruption already on its way
+                # is raised before done is set
+                with self._running:
+                    done.set()
+                lease.join()
+        except Retry as e:
+            LOG.warning("attempt %d at job %s failed, retrying: %s", job.attempts, job.uuid, e)
+            wps_response._update_status(WPS_STATUS.ACCEPTED, "PyWPS Process queued for another attempt", 0, False)
+            self.queue.retry(job.uuid, self.name, str(e), delay=self.retry_delay * 2 ** (job.attempts - 1))
+            process.clean()
+            return
+        except LeaseLost:
+            # the job and its status document belong to the worker that took it over
+            process.clean()
+            return
+
+        if wps_response.status == WPS_STATUS.SUCCEEDED:
+            self.queue.complete(job.uuid, self.name)
+        else:
+            self.queue.fail(job.uuid, self.name, wps_response.message)
+
+    def run_once(self):
+        """ Run the next job, `False` if there was none. """
+        job = self.queue.claim(self.name)
+        if job is None:
+            return False
+        self.run_job(job)
+        return True
+
+    def run(self):
+        LOG.info("worker %s taking jobs from %s", self.name, self.queue.path)
+        while not self._stop.is_set():
+            if not self.run_once():
+                self._stop.wait(self.poll)
+
+    def stop(self):
+        self._stop.set()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Runs asynchronous datacube-wps executions from the job queue")
+    parser.add_argument('-c', '--config', default='pywps.cfg', help="pywps configuration")
+    parser.add_argument('--catalog', default='datacube-wps-config.yaml', help="process catalog")
+    parser.add_argument('--name', help="name of this worker, defaults to host:pid")
+    args = parser.parse_args(args)
+
+    setup_logger()
+    setup_sentry()
+    service = Service(read_process_catalog(args.catalog), [args.config])
+
+    queue = job_queue()
+    if queue is None:
+        parser.error(f"no job queue configured, set path in the [jobs] section of {args.config}")
+    Worker(queue, service, name=args.name,
+           poll=config_number("jobs", "poll", 1.0),
+           retry_delay=config_number("jobs", "retry_delay", 30.0)).run()
+
+
+if __name__ == "__main__":
+    main()
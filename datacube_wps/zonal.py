@@ -0,0 +1,162 @@
+import numpy as np
+import rasterio.features
+import xarray
+
+# Zonal statistics for any number of polygons ("zones") at once. The pixels of every
+# zone are gathered into one "pixel" dimension, labelled by a "zone" coordinate, and
+# each statistic is a single bincount over zone labels per block of time slices.
+# A pixel inside several overlapping zones is gathered once for each of them.
+
+
+def _overlap_layers(geoms):
+    # features that do not overlap each other can share a labelled raster
+    layers = []
+    for index, geom in enumerate(geoms):
+        for layer in layers:
+            if not any(geom.intersects(geoms[other]) for other in layer):
+                layer.append(index)
+                break
+        else:
+            layers.append([index])
+    return layers
+
+
+def zone_pixels(geoms, geobox, all_touched=False):
+    """
+    The (rows, cols) of the pixels inside each of `geoms`, from a labelled rasterization
+    of all of them at once (one per set of mutually non-overlapping features).
+    """
+    pixels = [None] * len(geoms)
+    for layer in _overlap_layers(geoms):
+        labels = rasterio.features.rasterize(
+            [(geoms[index].to_crs(geobox.crs), label) for label, index in enumerate(layer, start=1)],
+            out_shape=geobox.shape,
+            transform=geobox.affine,
+            fill=0,
+            all_touched=all_touched,
+            dtype='int32',
+        ).ravel()
+
+        # pixel indices sorted by label, split at the label boundaries
+        order = np.argsort(labels, kind='stable')
+        bounds = np.searchsorted(labels[order], np.arange(len(layer) + 2))
+        for label, index in enumerate(layer, start=1):
+            pixels[index] = np.unravel_index(order[bounds[label]:bounds[label + 1]], geobox.shape)
+    return pixels
+
+
+def gather_indices(data, rows, cols, dims=None):
+    # flatten the given pixels into a single "pixel" dimension,
+    # leaving the rest of the bounding box behind
+    ydim, xdim = data.geobox.dimensions if dims is None else dims
+    return data.isel({ydim: xarray.DataArray(rows, dims='pixel'), xdim: xarray.DataArray(cols, dims='pixel')})
+
+
+def gather_zones(data, pixels, dims=None):
+    """ The pixels of all zones along one "pixel" dimension, with the "zone" each belongs to. """
+    rows = np.concatenate([rows for rows, _ in pixels]).astype('int64')
+    cols = np.concatenate([cols for _, cols in pixels]).astype('int64')
+    labels = np.repeat(np.arange(len(pixels)), [len(rows) for rows, _ in pixels])
+    gathered = gather_indices(data, rows, cols, dims=dims)
+    return gathered.assign_coords(zone=xarray.DataArray(labels, dims='pixel', attrs={'zones': len(pixels)}))
+
+
+def zone_labels(data):
+    """ The zone label of every pixel and the number of zones, a single zone unless gathered by zone. """
+    if 'zone' not in data.coords:
+        return np.zeros(data.sizes['pixel'], dtype='int64'), 1
+    return data.zone.values, data.zone.attrs['zones']
+
+
+def has_zones(data):
+    return 'zone' in data.coords
+
+
+def _bins(labels, count, rows, bins=1, values=None):
+    # a flat bin for every (row, zone, bin), rows being the leading (time) axes
+    index = labels * bins + (count * bins) * np.arange(rows)[:, np.newaxis]
+    if values is not None:
+        index = index + values
+    return index.ravel()
+
+
+def zonal_sum_block(values, labels=None, count=1):
+    """ Sums per zone along the last axis of `values`, as a new last axis. NaNs are skipped. """
+    lead = values.shape[:-1]
+    flat = values.reshape(-1, values.shape[-1])
+    index = _bins(labels, count, flat.shape[0])
+    if flat.dtype == bool:
+        sums = np.bincount(index[flat.ravel()], minlength=flat.shape[0] * count)
+    else:
+        weights = flat.ravel()
+        if weights.dtype.kind == 'f':
+            weights = np.where(np.isnan(weights), 0, weights)
+        sums = np.bincount(index, weights=weights, minlength=flat.shape[0] * count)
+        if flat.dtype.kind in 'iu':
+            sums = sums.astype('int64')
+    return sums.reshape(lead + (count,))
+
+
+def zonal_histogram_block(values, labels=None, count=1, bins=1):
+    """
+    Counts of the integer `values` in [0, bins) per zone along the last axis,
+    as new (zone, bin) last axes. Values outside the range are not counted.
+    """
+    lead = values.shape[:-1]
+    flat = values.reshape(-1, values.shape[-1])
+    inside = (flat >= 0) & (flat < bins)
+    index = _bins(labels, count, flat.shape[0], bins=bins, values=np.where(inside, flat, 0).astype('int64'))
+    counts = np.bincount(index[inside.ravel()], minlength=flat.shape[0] * count * bins)
+    return counts.reshape(lead + (count, bins))
+
+
+def _zonal(block, values, data, dtype, bins=None):
+    labels, count = zone_labels(data)
+    new_dims, sizes, kwargs = ['zone'], {'zone': count}, {}
+    if bins is not None:
+        new_dims.append('bin')
+        sizes['bin'] = kwargs['bins'] = bins
+
+    result = xarray.apply_ufunc(
+        block, values,
+        input_core_dims=[['pixel']],
+        output_core_dims=[new_dims],
+        kwargs=dict(labels=labels, count=count, **kwargs),
+        dask='parallelized',
+        output_dtypes=[dtype],
+        dask_gufunc_kwargs=dict(output_sizes=sizes, allow_rechunk=True),
+    )
+    return result.assign_coords(zone=np.arange(count))
+
+
+def zonal_sum(values, data):
+    """ Per zone sums of the (time, pixel) `values`, where `data` holds the zones. """
+    dtype = np.int64 if values.dtype.kind in 'biu' else np.float64
+    return _zonal(zonal_sum_block, values, data, dtype)
+
+
+def zonal_count(mask, data):
+    """ Per zone counts of the pixels set in `mask`. """
+    return zonal_sum(mask.astype(bool), data)
+
+
+def zonal_mean(values, data):
+    """ Per zone means of the valid (not NaN) `values`. """
+    valid = values.notnull() if values.dtype.kind == 'f' else xarray.ones_like(values, dtype=bool)
+    return zonal_sum(values, data) / zonal_count(valid, data)
+
+
+def zonal_histogram(values, data, bins):
+    """ Per zone counts of each of the integer `values` in [0, bins), along a new "bin" dimension. """
+    return _zonal(zonal_histogram_block, values, data, np.int64, bins=bins)
+
+
+def zonal_frame(result, data):
+    """
+    A table of per zone statistics with one row per zone and time step. The "zone"
+    column is left out when `data` is a single polygon rather than gathered by zone.
+    """
+    df = result.reset_coords(drop=True).to_dataframe(dim_order=['zone', 'time']).reset_index()
+    if not has_zones(data):
+        df = df.drop(columns='zone')
+    return df
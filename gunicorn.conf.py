@@ -4,3 +4,9 @@ from prometheus_flask_exporter.multiprocess import \
 
 def child_exit(server, worker):
     GunicornInternalPrometheusMetrics.mark_process_dead_on_child_exit(worker.pid)
+
+
+def post_worker_init(worker):
+    # build the process catalog and warm up the worker in the background,
+    # /ready reports when it is done
+    worker.wsgi.extensions["warmup"].start()
@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+
+from datacube_wps.admission import AdmissionController, Busy, SlotSet
+from datacube_wps.impl import create_app
+
+
+def test_cap_and_fast_rejection(tmp_path):
+    controller = AdmissionController(str(tmp_path), caps={"WIT": 2}, default_cap=4, queue=0)
+    with controller.admit("WIT"), controller.admit("Other"):
+        # requests on other threads do not share the ticket of this one
+        held = []
+        thread = threading.Thread(target=lambda: held.append(controller.acquire("WIT", 1)))
+        thread.start()
+        thread.join()
+        with pytest.raises(Busy):
+            controller.acquire("WIT", 1)
+        # other processes have slots of their own
+        controller.acquire("Other", 3)
+
+
+def test_waiting_requests_are_admitted_in_time(tmp_path):
+    controller = AdmissionController(str(tmp_path), default_cap=1, queue=1, max_wait=5, poll=0.01)
+    admitted = threading.Event()
+    release = threading.Event()
+
+    def first():
+        with controller.admit("WIT"):
+            admitted.set()
+            release.wait()
+
+    thread = threading.Thread(target=first)
+    thread.start()
+    admitted.wait()
+
+    results = []
+
+    def second():
+        with controller.admit("WIT"):
+            results.append("admitted")
+
+    waiter = threading.Thread(target=second)
+    waiter.start()
+    time.sleep(0.05)
+    # the only place in line is taken by the waiting request
+    with pytest.raises(Busy):
+        controller.acquire("WIT", 1)
+
+    release.set()
+    thread.join()
+    waiter.join()
+    assert results == ["admitted"]
+
+
+def test_ticket_grows_with_cost(tmp_path):
+    controller = AdmissionController(str(tmp_path), default_cap=3, queue=0)
+    with controller.admit("WIT") as ticket:
+        with controller.admit("WIT", 5):
+            # capped at the slots there are
+            assert ticket.weight == 3
+        assert ticket.weight == 1
+
+
+def test_heavy_requests_do_not_deadlock(tmp_path):
+    controller = AdmissionController(str(tmp_path), caps={"WIT": 2}, queue=2, max_wait=5, poll=0.01)
+    admitted = threading.Barrier(2)
+    results = []
+
+    def request():
+        with controller.admit("WIT"):
+            # both hold their first slot before either asks for its whole weight
+            admitted.wait()
+            with controller.admit("WIT", 2) as ticket:
+                results.append(ticket.weight)
+                time.sleep(0.05)
+
+    threads = [threading.Thread(target=request) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [2, 2]
+
+
+def test_execute_over_capacity_is_503(tmp_path, monkeypatch):
+    controller = AdmissionController(str(tmp_path), default_cap=1, queue=0)
+    monkeypatch.setattr("datacube_wps.admission.admission_controller", lambda: controller)
+    client = create_app().test_client()
+
+    # held as if by another worker
+    held = controller.acquire("WIT", 1)
+    r = client.get('/?service=WPS&version=1.0.0&request=Execute&identifier=WIT')
+    assert r.status_code == 503
+    assert r.headers["Retry-After"]
+    body = ('<wps:Execute xmlns:wps="http://www.opengis.net/wps/1.0.0" xmlns:ows="http://www.opengis.net/ows/1.1">'
+            '<ows:Identifier>WIT</ows:Identifier></wps:Execute>')
+    r = client.post('/', data=body)
+    assert r.status_code == 503
+    SlotSet.release(held)
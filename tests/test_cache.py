@@ -0,0 +1,155 @@
+from contextlib import nullcontext
+
+import boto3
+import pandas
+from datacube.testutils import mk_sample_dataset
+from datacube.utils.geometry import CRS, Geometry
+from datacube.virtual import construct
+from datacube.virtual.impl import VirtualDatasetBag
+from moto import mock_s3
+
+from datacube_wps.cache import (LocalBackend, ResultCache, S3Backend,
+                                pixel_geobox, request_key)
+from datacube_wps.processes import _drill
+
+DF = pandas.DataFrame({
+    "time": pandas.date_range("2000-01-01", periods=3),
+    "observation": pandas.Categorical(["wet", "dry", "wet"], categories=["wet", "dry", "not observable"]),
+})
+
+
+def _point(lon, lat):
+    return Geometry({"type": "Point", "coordinates": [lon, lat]}, crs=CRS("EPSG:4326"))
+
+
+def test_request_key_rounds_coordinates():
+    key = request_key("WOfSDrill", "0.4", _point(146.850297, -32.944597), None, {}, digits=4)
+    assert key == request_key("WOfSDrill", "0.4", _point(146.850301, -32.944602), None, {}, digits=4)
+    assert key != request_key("WOfSDrill", "0.4", _point(146.8510, -32.944597), None, {}, digits=4)
+    assert key != request_key("WOfSDrill", "0.5", _point(146.850297, -32.944597), None, {}, digits=4)
+    assert key != request_key("WOfSDrill", "0.4", _point(146.850297, -32.944597), None, {"aggregate": 1}, digits=4)
+
+
+def test_request_key_snaps_to_pixels():
+    product = construct(product="sample", measurements=["red"], output_crs="EPSG:3577", resolution=25)
+
+    def key(lon, lat):
+        point = _point(lon, lat)
+        return request_key("WOfSDrill", "0.4", point, None, {}, geobox=pixel_geobox(product, point))
+
+    # about 13m apart within one 25m pixel, then about 2m apart either side of a pixel edge,
+    # which rounding to 4 decimal places would have taken for the same place
+    assert key(146.85002, -32.94462) == key(146.85016, -32.94462)
+    assert key(146.85018, -32.94462) != key(146.85020, -32.94462)
+
+    # the pixel grid of products without one of their own is that of their definition in the index
+    product = construct(product="sample", measurements=["red"])
+    assert pixel_geobox(product, _point(146.85, -32.94)) is None
+
+
+def test_local_cache_roundtrip(tmp_path):
+    cache = ResultCache(LocalBackend(str(tmp_path)))
+    assert cache.get("abc") is None
+
+    cache.put("abc", DF)
+    result = cache.get("abc")
+    pandas.testing.assert_frame_equal(result, DF)
+
+
+def test_local_cache_expires(tmp_path):
+    cache = ResultCache(LocalBackend(str(tmp_path)), ttl=1e-6)
+    cache.put("abc", DF)
+    assert cache.get("abc") is None
+    assert not list(tmp_path.iterdir())
+
+
+def test_local_cache_drops_unreadable_entries(tmp_path):
+    cache = ResultCache(LocalBackend(str(tmp_path)))
+    cache.put("abc", DF)
+    body = (tmp_path / "abc.parquet").read_bytes()
+    (tmp_path / "abc.parquet").write_bytes(body[:len(body) // 2])
+
+    assert cache.get("abc") is None
+    assert not list(tmp_path.iterdir())
+
+
+def test_local_cache_evicts_least_recently_used(tmp_path):
+    backend = LocalBackend(str(tmp_path))
+    cache = ResultCache(backend)
+    cache.put("first", DF)
+    size = (tmp_path / "first.parquet").stat().st_size
+
+    backend.max_bytes = 2 * size + size // 2
+    cache.put("second", DF)
+    cache.get("first")
+    cache.put("third", DF)
+
+    assert cache.get("first") is not None
+    assert cache.get("second") is None
+    assert cache.get("third") is not None
+
+
+@mock_s3
+def test_s3_cache_roundtrip():
+    client = boto3.client("s3", region_name="ap-southeast-2")
+    client.create_bucket(Bucket="test-cache", CreateBucketConfiguration={"LocationConstraint": "ap-southeast-2"})
+
+    cache = ResultCache(S3Backend("test-cache"))
+    assert cache.get("abc") is None
+    cache.put("abc", DF)
+    pandas.testing.assert_frame_equal(cache.get("abc"), DF)
+
+
+class FakeDrill:
+    about = {"identifier": "FakeDrill", "version": "0.1"}
+    input = construct(product="sample", measurements=["red"], group_by="time",
+                      output_crs="EPSG:4326", resolution=0.1)
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.computed = []
+
+    def incremental(self, parameters):
+        return True
+
+    def query_box(self, dc, time, feature):
+        bag = VirtualDatasetBag(self.datasets, feature, {"sample": self.datasets[0].product})
+        return self.input.group(bag)
+
+    def drill_box(self, box, feature, parameters):
+        return self.process_data(box.box.time.data, parameters)
+
+    def process_data(self, data, parameters):
+        self.computed.append(list(data))
+        return pandas.DataFrame({"time": data, "value": [len(self.computed)] * len(data)})
+
+
+def _sample(timestamp, id):
+    return mk_sample_dataset([{"name": "red"}], timestamp=timestamp, id=id)
+
+
+def test_incremental_drill(tmp_path, monkeypatch):
+    cache = ResultCache(LocalBackend(str(tmp_path)), ttl=1e-6)
+    monkeypatch.setattr("datacube_wps.processes.result_cache", lambda: cache)
+    monkeypatch.setattr("datacube_wps.processes.shared_datacube", nullcontext)
+
+    time = ("2000-01-01", "2001-01-01")
+    first = _sample("2000-01-01", "10000000-0000-0000-0000-000000000001")
+    second = _sample("2000-02-01", "10000000-0000-0000-0000-000000000002")
+    drill = FakeDrill([first, second])
+    df = _drill(drill, nullcontext(), time, _point(146.85, -32.94), {})
+    assert len(df) == 2
+    assert len(drill.computed) == 1
+
+    # a new acquisition is the only slice computed
+    third = _sample("2000-03-01", "10000000-0000-0000-0000-000000000003")
+    drill.datasets = [first, second, third]
+    df = _drill(drill, nullcontext(), time, _point(146.85, -32.94), {})
+    assert list(df["value"]) == [1, 1, 2]
+    assert [len(slices) for slices in drill.computed] == [2, 1]
+
+    # a re-indexed dataset replaces its slice
+    drill.datasets = [first, _sample("2000-02-01", "10000000-0000-0000-0000-000000000004"), third]
+    df = _drill(drill, nullcontext(), time, _point(146.85, -32.94), {})
+    assert list(df["value"]) == [1, 3, 2]
+    assert list(df["time"]) == sorted(df["time"])
@@ -0,0 +1,85 @@
+import threading
+import time
+
+import dask.array as da
+
+from datacube_wps.cluster import ClusterPool
+
+
+def test_cluster_is_reused():
+    pool = ClusterPool(idle_timeout=0)
+    try:
+        first = pool.acquire("pixel")
+        pool.release("pixel")
+        second = pool.acquire("pixel")
+        pool.release("pixel")
+        assert first is second
+        assert int(first.compute(da.ones(10).sum()).result()) == 10
+    finally:
+        pool.shutdown()
+
+
+def test_cluster_restarts_when_unhealthy():
+    pool = ClusterPool(idle_timeout=0)
+    try:
+        first = pool.acquire("pixel")
+        pool.release("pixel")
+        first.close()
+        second = pool.acquire("pixel")
+        pool.release("pixel")
+        assert second is not first
+        assert second.status == "running"
+    finally:
+        pool.shutdown()
+
+
+def test_cluster_missing_a_worker_is_kept():
+    pool = ClusterPool(idle_timeout=0)
+    try:
+        first = pool.acquire("pixel")
+        # as while the nanny restarts a worker
+        first.cluster.scale(0)
+        while first.scheduler_info()["workers"]:
+            time.sleep(0.05)
+        second = pool.acquire("pixel")
+        assert second is first
+        pool.release("pixel")
+        pool.release("pixel")
+    finally:
+        pool.shutdown()
+
+
+def test_cluster_is_started_once(monkeypatch):
+    pool = ClusterPool(idle_timeout=0)
+    starts = []
+    start = pool._start
+
+    def slow_start(kind):
+        starts.append(kind)
+        time.sleep(0.5)
+        return start(kind)
+
+    monkeypatch.setattr(pool, "_start", slow_start)
+    clients = []
+    threads = [threading.Thread(target=lambda: clients.append(pool.acquire("pixel"))) for _ in range(4)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert starts == ["pixel"]
+        assert len(clients) == 4 and all(client is clients[0] for client in clients)
+    finally:
+        pool.shutdown()
+
+
+def test_idle_cluster_shuts_down():
+    pool = ClusterPool(idle_timeout=0.1)
+    try:
+        pool.acquire("pixel")
+        pool.release("pixel")
+        assert pool.is_running("pixel")
+        time.sleep(1.0)
+        assert not pool.is_running("pixel")
+    finally:
+        pool.shutdown()
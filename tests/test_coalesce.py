@@ -0,0 +1,160 @@
+import threading
+import time
+from contextlib import nullcontext
+
+import pandas
+import pytest
+
+from datacube_wps.cache import LocalBackend, ResultCache
+from datacube_wps.coalesce import SingleFlight
+from datacube_wps.processes import _drill, _render_outputs
+
+from .test_cache import FakeDrill, _point, _sample
+
+
+def _in_threads(count, target):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(target())) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_duplicates_share_one_computation():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        release.wait()
+        return {"value": 42}
+
+    threads, results = _in_threads(4, lambda: flights.run("key", compute))
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [{"value": 42}] * 4
+    # each caller has a copy of its own
+    assert len({id(result) for result in results}) == 4
+
+
+def test_leader_is_not_handed_the_shared_result():
+    flights = SingleFlight()
+    shared = pandas.DataFrame({"time": pandas.date_range("2000-01-01", periods=2), "value": [1, 2]})
+    result = flights.run("key", lambda: shared)
+    assert result is not shared and result.equals(shared)
+
+    # rendering leaves the drilled frame as it is, for whoever else holds it
+    _render_outputs("uuid", {}, shared, None, identifier="FakeDrill")
+    assert list(shared.columns) == ["time", "value"]
+
+
+def test_followers_stop_waiting_on_a_hung_leader():
+    flights = SingleFlight(timeout=0.05)
+    release = threading.Event()
+    thread = threading.Thread(target=flights.run, args=("key", release.wait))
+    thread.start()
+    time.sleep(0.01)
+    assert flights.run("key", lambda: "own") == "own"
+    release.set()
+    thread.join()
+
+
+def test_duplicates_share_failures():
+    flights = SingleFlight()
+    release = threading.Event()
+    errors = []
+
+    def compute():
+        release.wait()
+        raise ValueError("no data")
+
+    def call():
+        try:
+            flights.run("key", compute)
+        except ValueError as e:
+            errors.append(e)
+
+    threads, _ = _in_threads(3, call)
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 3
+
+    # nothing is left in flight
+    assert flights.run("key", lambda: "retried") == "retried"
+
+
+def test_workers_take_turns(tmp_path):
+    first, second = SingleFlight(str(tmp_path)), SingleFlight(str(tmp_path), poll=0.01)
+    started, release = threading.Event(), threading.Event()
+    order = []
+
+    def slow():
+        started.set()
+        release.wait()
+        order.append("first")
+
+    thread = threading.Thread(target=first.run, args=("key", slow))
+    thread.start()
+    started.wait()
+
+    waiter = threading.Thread(target=second.run, args=("key", lambda: order.append("second")))
+    waiter.start()
+    time.sleep(0.05)
+    assert order == []
+
+    release.set()
+    thread.join()
+    waiter.join()
+    assert order == ["first", "second"]
+    assert not list(tmp_path.iterdir())
+
+    def failing():
+        raise RuntimeError("failed")
+
+    with pytest.raises(RuntimeError):
+        first.run("key", failing)
+    assert not list(tmp_path.iterdir())
+
+
+class SlowDrill(FakeDrill):
+    def __init__(self, datasets):
+        super().__init__(datasets)
+        self.release = threading.Event()
+
+    def process_data(self, data, parameters):
+        self.release.wait()
+        return super().process_data(data, parameters)
+
+
+def test_concurrent_drills_are_coalesced(tmp_path, monkeypatch):
+    cache = ResultCache(LocalBackend(str(tmp_path / "cache")))
+    flights = SingleFlight(str(tmp_path / "flights"))
+    monkeypatch.setattr("datacube_wps.processes.result_cache", lambda: cache)
+    monkeypatch.setattr("datacube_wps.processes.single_flight", lambda: flights)
+    monkeypatch.setattr("datacube_wps.processes.shared_datacube", nullcontext)
+
+    drill = SlowDrill([_sample("2000-01-01", "10000000-0000-0000-0000-000000000001")])
+    time_range = ("2000-01-01", "2001-01-01")
+
+    def request(lon):
+        return lambda: _drill(drill, nullcontext(), time_range, _point(lon, -32.94), {})
+
+    threads, results = _in_threads(3, request(146.85))
+    # a different location is drilled on its own
+    other, other_results = _in_threads(1, request(146.95))
+    time.sleep(0.05)
+    drill.release.set()
+    for thread in threads + other:
+        thread.join()
+
+    assert len(drill.computed) == 2
+    assert len(results) == 3 and len(other_results) == 1
+    for df in results[1:]:
+        assert df.equals(results[0])
@@ -0,0 +1,55 @@
+import threading
+
+import sqlalchemy
+
+from datacube_wps.connection import DatacubeProvider, ping_before_use
+
+
+class FakeDatacube:
+    created = 0
+
+    def __init__(self):
+        FakeDatacube.created += 1
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_provider_shares_one_datacube_across_threads():
+    FakeDatacube.created = 0
+    provider = DatacubeProvider(factory=FakeDatacube)
+    seen = []
+
+    def request():
+        with provider.datacube() as dc:
+            seen.append(dc)
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert FakeDatacube.created == 1
+    assert all(dc is seen[0] for dc in seen)
+    assert not seen[0].closed
+
+    provider.close()
+    assert seen[0].closed
+    with provider.datacube() as dc:
+        assert dc is not seen[0]
+
+
+def test_dropped_connections_are_replaced(tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'index.db'}", isolation_level="AUTOCOMMIT")
+    ping_before_use(engine)
+    with engine.connect() as connection:
+        connection.execute(sqlalchemy.text("create table t (x integer)"))
+        pooled = connection.connection.dbapi_connection
+    # as if the database dropped it while in the pool
+    pooled.close()
+
+    with engine.connect() as connection:
+        connection.execute(sqlalchemy.text("insert into t values (1)"))
+        assert connection.execute(sqlalchemy.text("select count(*) from t")).scalar() == 1
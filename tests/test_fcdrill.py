@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import xarray
+
+from datacube_wps.processes.fcdrill import FCDrill
+
+WOFS_FLAGS = {
+    'dry': {'bits': [7, 6, 5, 4, 3, 2, 1, 0], 'values': {0: True}},
+    'nodata': {'bits': 0, 'values': {1: True}},
+    'noncontiguous': {'bits': 1, 'values': {0: False, 1: True}},
+    'sea': {'bits': 2, 'values': {0: False, 1: True}},
+    'terrain_or_low_angle': {'bits': 3, 'values': {0: False, 1: True}},
+    'high_slope': {'bits': 4, 'values': {0: False, 1: True}},
+    'cloud_shadow': {'bits': 5, 'values': {0: False, 1: True}},
+    'cloud': {'bits': 6, 'values': {0: False, 1: True}},
+    'wet': {'bits': [7, 6, 5, 4, 3, 2, 1, 0], 'values': {128: True}},
+}
+
+
+def _data(seed=0):
+    rng = np.random.default_rng(seed)
+    shape = (4, 300)
+    dims = ('time', 'pixel')
+
+    def band():
+        values = rng.integers(0, 100, size=shape).astype('uint8')
+        values[rng.random(shape) < 0.1] = 255
+        return xarray.DataArray(values, dims=dims, attrs={'nodata': 255})
+
+    water = rng.choice([0, 0, 0, 1, 4, 64, 128], size=shape).astype('uint8')
+    return xarray.Dataset({
+        'bs': band(), 'pv': band(), 'npv': band(),
+        'water': xarray.DataArray(water, dims=dims, attrs={'nodata': 1, 'flags_definition': WOFS_FLAGS}),
+    }, coords={'time': np.arange(shape[0]).astype('datetime64[D]')})
+
+
+def _expected(data):
+    fc = np.stack([data.bs.values, data.pv.values, data.npv.values])
+    valid = (fc != 255).all(axis=0)
+    observable = valid & (data.water.values == 0)
+    dominant = fc.argmax(axis=0)
+    total = valid.sum(axis=1)
+    counts = [((dominant == index) & observable).sum(axis=1) for index in range(3)]
+    counts.append((valid & ~observable).sum(axis=1))
+    return np.stack(counts, axis=1) / total[:, None] * 100
+
+
+@pytest.mark.parametrize('chunks', [None, {'time': 1, 'pixel': 100}])
+def test_process_data_counts_dominant_class(chunks):
+    data = _data()
+    drill = FCDrill(about={'identifier': 'FractionalCoverDrill', 'title': 'FC'}, input=None, style={})
+
+    df = drill.process_data(data if chunks is None else data.chunk(chunks), {})
+    assert list(df.columns) == ['time'] + FCDrill.SHORT_NAMES
+    assert (df['time'].values == data.time.values).all()
+    np.testing.assert_allclose(df[FCDrill.SHORT_NAMES].values, _expected(data))
+
+
+def test_process_data_by_zone():
+    data = _data()
+    labels = np.random.default_rng(1).integers(0, 3, size=data.sizes['pixel'])
+    zoned = data.assign_coords(zone=xarray.DataArray(labels, dims='pixel', attrs={'zones': 3}))
+    drill = FCDrill(about={'identifier': 'FractionalCoverDrill', 'title': 'FC'}, input=None, style={})
+
+    df = drill.process_data(zoned, {})
+    assert list(df.columns) == ['zone', 'time'] + FCDrill.SHORT_NAMES
+    for zone in range(3):
+        rows = df[df['zone'] == zone]
+        np.testing.assert_allclose(rows[FCDrill.SHORT_NAMES].values, _expected(data.isel(pixel=labels == zone)))
@@ -0,0 +1,55 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from datacube_wps import instrument
+from datacube_wps.instrument import stage, timed
+
+from .test_polygondrill import POLYGON, _box, _drill
+
+
+class Drill:
+    about = {"identifier": "TimedDrill"}
+
+    @timed("process_data")
+    def process_data(self, value):
+        return value * 2
+
+
+def _count(process, name):
+    return REGISTRY.get_sample_value("datacube_wps_stage_seconds_count", {"process": process, "stage": name}) or 0
+
+
+def test_stages_are_not_timed_until_enabled(monkeypatch):
+    monkeypatch.setattr(instrument, "_TIMING", [])
+    assert Drill().process_data(2) == 4
+    with stage("TimedDrill", "query"):
+        pass
+    assert _count("TimedDrill", "process_data") == 0
+    assert _count("TimedDrill", "query") == 0
+
+
+def test_stages_are_timed_per_process(monkeypatch):
+    monkeypatch.setattr(instrument, "_TIMING", [])
+    instrument.enable_stage_timing()
+
+    before = _count("TimedDrill", "process_data")
+    assert Drill().process_data(3) == 6
+    assert _count("TimedDrill", "process_data") == before + 1
+
+    before = _count("TimedDrill", "upload")
+    with stage("TimedDrill", "upload"):
+        pass
+    assert _count("TimedDrill", "upload") == before + 1
+
+
+@pytest.mark.parametrize("streaming, loads", [(False, 1), (True, 5)])
+def test_loads_are_timed(tmp_path, monkeypatch, streaming, loads):
+    monkeypatch.setattr(instrument, "_TIMING", [])
+    instrument.enable_stage_timing()
+    drill = _drill(streaming=streaming)
+    box = _box(tmp_path, drill.input)
+
+    before = _count("CountDrill", "load")
+    drill.drill_box(box, POLYGON, {})
+    # the stage spans the computation the lazy reads are part of, for the box or each time slice
+    assert _count("CountDrill", "load") == before + loads
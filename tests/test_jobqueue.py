@@ -0,0 +1,125 @@
+import sqlite3
+import time
+
+import pywps.configuration as config
+from pywps import LiteralInput, LiteralOutput, Process, Service
+from werkzeug.test import Client
+
+from datacube_wps import jobqueue
+from datacube_wps.jobqueue import JobQueue, submit
+from datacube_wps.worker import Worker
+
+
+def test_claims_follow_priority_and_leases(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), lease=60)
+    queue.enqueue("a", "WIT", "{}", rank=0)
+    queue.enqueue("b", "WOfSDrill", "{}", rank=10)
+    queue.enqueue("c", "WOfSDrill", "{}", rank=10)
+
+    assert [queue.claim("w").uuid for _ in range(3)] == ["b", "c", "a"]
+    assert queue.claim("w") is None
+    assert queue.renew("a", "w") and not queue.renew("a", "other")
+
+    queue.retry("a", "w", "boom", delay=60)
+    assert queue.claim("w") is None
+    # only the worker holding a job finishes it
+    assert not queue.complete("b", "other")
+    assert queue.complete("b", "w")
+    assert not queue.fail("b", "w", "too late")
+    assert queue.counts() == {"queued": 1, "running": 1, "succeeded": 1}
+
+    # a job whose lease has run out is claimed again
+    expiring = JobQueue(str(tmp_path / "expiring.sqlite3"), lease=0)
+    expiring.enqueue("d", "WIT", "{}")
+    assert expiring.claim("w").attempts == 1
+    job = expiring.claim("other")
+    assert job.uuid == "d" and job.attempts == 2
+
+
+FAILURES = []
+
+
+class Echo(Process):
+    def __init__(self):
+        super().__init__(self.handler, identifier="echo", title="Echo",
+                         inputs=[LiteralInput("message", "Message", data_type="string")],
+                         outputs=[LiteralOutput("echo", "Echo", data_type="string")],
+                         store_supported=True, status_supported=True)
+
+    def handler(self, request, response):
+        # the first attempt fails, each attempt runs on a copy of the process
+        if not FAILURES:
+            FAILURES.append(request.inputs["message"][0].data)
+            raise RuntimeError("flaky")
+        response.outputs["echo"].data = request.inputs["message"][0].data
+        return response
+
+    def _run_async(self, wps_request, wps_response):
+        if not submit(self, wps_request, wps_response):
+            super()._run_async(wps_request, wps_response)
+
+
+class Stolen(Echo):
+    def handler(self, request, response):
+        # the lease goes to another worker while the attempt runs, which is then abandoned
+        with sqlite3.connect(config.get_config_value("jobs", "path")) as db:
+            db.execute("UPDATE jobs SET worker = 'other'")
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            time.sleep(0.01)
+        response.outputs["echo"].data = "not abandoned"
+        return response
+
+
+def _service(tmp_path, monkeypatch, process):
+    monkeypatch.setenv("WPS_BASEURL", "http://localhost")
+    (tmp_path / "outputs").mkdir()
+    service = Service([process], ["pywps.cfg"])
+    monkeypatch.setitem(config.CONFIG["server"], "storagetype", "file")
+    monkeypatch.setitem(config.CONFIG["server"], "outputpath", str(tmp_path / "outputs"))
+    monkeypatch.setitem(config.CONFIG["server"], "workdir", str(tmp_path))
+    monkeypatch.setitem(config.CONFIG["logging"], "database", f"sqlite:///{tmp_path}/logs.sqlite3")
+    monkeypatch.setitem(config.CONFIG["jobs"], "path", str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setattr(jobqueue, "_JOB_QUEUE", [])
+
+    r = Client(service).get("/?service=WPS&request=Execute&version=1.0.0&identifier=echo"
+                            "&DataInputs=message=hello&storeExecuteResponse=true&status=true")
+    assert r.status_code == 200
+    return service, r
+
+
+def test_queued_execution_is_retried_by_worker(tmp_path, monkeypatch):
+    FAILURES.clear()
+    service, r = _service(tmp_path, monkeypatch, Echo())
+    assert b"ProcessAccepted" in r.data
+
+    queue = jobqueue.job_queue()
+    assert queue.counts() == {"queued": 1}
+    status = next((tmp_path / "outputs").glob("*.xml"))
+    assert b"ProcessAccepted" in status.read_bytes()
+
+    worker = Worker(queue, service, retry_delay=0)
+    assert worker.run_once()
+    assert queue.counts() == {"queued": 1}
+    # the failed attempt is not reported to the client
+    assert b"ProcessAccepted" in status.read_bytes()
+
+    assert worker.run_once()
+    assert not worker.run_once()
+    assert queue.counts() == {"succeeded": 1}
+    document = status.read_bytes()
+    assert b"ProcessSucceeded" in document and b"hello" in document
+
+
+def test_attempt_is_abandoned_when_lease_is_lost(tmp_path, monkeypatch):
+    service, _ = _service(tmp_path, monkeypatch, Stolen())
+    queue = jobqueue.job_queue()
+    queue.lease = 0.3
+
+    started = time.monotonic()
+    assert Worker(queue, service).run_once()
+    assert time.monotonic() - started < 10
+    # still running, for the worker that took it over
+    assert queue.counts() == {"running": 1}
+    status = next((tmp_path / "outputs").glob("*.xml")).read_bytes()
+    assert b"ProcessSucceeded" not in status
@@ -0,0 +1,73 @@
+import json
+import threading
+
+import pandas
+import pytest
+from pywps.app.exceptions import ProcessError
+
+from datacube_wps.planner import GB, ReadPlan, check_budget, lane, plan_reads
+from datacube_wps.processes import _render_outputs
+from datacube_wps.processes.witprocess import WIT
+
+from .test_polygondrill import POLYGON, _box, _drill
+
+
+def test_plan_reads(tmp_path):
+    drill = _drill(streaming=False)
+    box = _box(tmp_path, drill.input)
+    plan = plan_reads(drill.input, box, tile_size=8)
+
+    # five single band uint8 datasets, each covering the whole box
+    pixels = box.shape[1] * box.shape[2]
+    assert plan.observations == 5
+    assert plan.datasets == 5
+    assert plan.read_bytes == pytest.approx(5 * pixels)
+    assert plan.reads == 5 * -(-pixels // 64)
+    assert plan.load_bytes == 5 * pixels
+
+    assert check_budget(plan, {}) == "fast"
+    assert check_budget(plan, {"slow_reads": plan.reads - 1}) == "slow"
+    with pytest.raises(ProcessError, match="tile reads"):
+        check_budget(plan, {"max_reads": plan.reads - 1, "slow_reads": 0})
+
+
+def test_drill_over_budget_is_rejected(tmp_path):
+    drill = _drill(streaming=False)
+    box = _box(tmp_path, drill.input)
+    drill.about["budget"] = {"max_load_gb": 1e-7}
+    with pytest.raises(ProcessError, match="data to load"):
+        drill.drill_box(box, POLYGON, {})
+
+    drill.about["budget"] = {"slow_load_gb": 1e-7}
+    drill.plan = None
+    assert len(drill.drill_box(box, POLYGON, {})) == 5
+    assert drill.plan.observations == 5
+
+
+def test_plan_is_returned_without_a_timeseries():
+    plan = ReadPlan(2, 1, 4, GB, 2 * GB, 10.0)
+    df = pandas.DataFrame({"time": pandas.date_range("2000-01-01", periods=2), "value": [1, 2]})
+    outputs = _render_outputs("abcd", {}, df, None, plan=plan)
+    assert json.loads(outputs["timeseries"]["data"])["plan"] == plan.as_dict()
+    # WIT only returns urls, and the plan next to them
+    assert json.loads(outputs["plan"]["data"]) == plan.as_dict()
+    assert "plan" in WIT(about={"identifier": "WIT", "title": "WIT"}, input=None, style={}).output_ids()
+
+
+def test_slow_lane_runs_one_at_a_time():
+    running = []
+    overlapped = []
+
+    def request():
+        with lane("slow"):
+            running.append(1)
+            overlapped.append(len(running) > 1)
+            threading.Event().wait(0.01)
+            running.pop()
+
+    threads = [threading.Thread(target=request) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlapped == [False] * 4
@@ -0,0 +1,45 @@
+import uuid
+
+import numpy as np
+from datacube.testutils import mk_sample_dataset
+from datacube.testutils.io import write_gtiff
+from datacube.utils.geometry import CRS, Geometry
+from datacube.virtual import construct
+from datacube.virtual.impl import VirtualDatasetBag
+
+from datacube_wps.pointread import read_point, supports_point_read
+
+
+def _dataset(tmp_path, timestamp, values):
+    name = str(uuid.uuid4())
+    meta = write_gtiff(tmp_path / f'{name}.tif', values, crs='EPSG:3577', resolution=(25, -25),
+                       offset=(1000000.0, -3000000.0), nodata=255)
+    return mk_sample_dataset([dict(name='water', path=f'{name}.tif', layer=1, nodata=255, dtype='uint8')],
+                             uri=(tmp_path / f'{name}.yaml').absolute().as_uri(),
+                             timestamp=timestamp, id=name, geobox=meta.geobox)
+
+
+def test_read_point_matches_fetch(tmp_path):
+    rng = np.random.default_rng(0)
+    partial = rng.integers(0, 200, size=(16, 16), dtype='uint8')
+    partial[:, 8:] = 255
+
+    datasets = [_dataset(tmp_path, '2020-01-01', rng.integers(0, 200, size=(16, 16), dtype='uint8')),
+                _dataset(tmp_path, '2020-02-01', rng.integers(0, 200, size=(16, 16), dtype='uint8')),
+                _dataset(tmp_path, '2020-03-01', partial),
+                _dataset(tmp_path, '2020-03-01', rng.integers(0, 200, size=(16, 16), dtype='uint8'))]
+
+    product = construct(product='sample', measurements=['water'], group_by='time')
+    assert supports_point_read(product)
+
+    product_definitions = {'sample': datasets[0].product}
+    for x in (1000030.0, 1000310.0):
+        point = Geometry({'type': 'Point', 'coordinates': [x, -3000030.0]}, crs=CRS('EPSG:3577'))
+        bag = VirtualDatasetBag(datasets, point, product_definitions)
+        box = product.group(bag, output_crs='EPSG:3577', resolution=25)
+
+        expected = product.fetch(box)
+        result = read_point(product, box, point)
+
+        assert (result.time.data == expected.time.data).all()
+        assert (result.water.values.ravel() == expected.water.values.ravel()).all()
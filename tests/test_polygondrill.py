@@ -0,0 +1,166 @@
+import uuid
+from contextlib import nullcontext
+
+import numpy as np
+import pandas
+import pytest
+from dask.distributed import Client
+from datacube.testutils import mk_sample_dataset
+from datacube.testutils.io import write_gtiff
+from datacube.utils.geometry import CRS, Geometry
+from datacube.virtual import construct
+from datacube.virtual.impl import VirtualDatasetBag
+
+from datacube_wps.processes import (PolygonDrill, _cluster_features,
+                                    _parse_geoms, geometry_mask)
+from datacube_wps.zonal import zonal_count, zonal_frame
+
+POLYGON = Geometry({
+    "type": "Polygon",
+    "coordinates": [[(1000010.0, -3000010.0), (1000300.0, -3000020.0), (1000150.0, -3000380.0),
+                     (1000010.0, -3000010.0)]],
+}, crs=CRS("EPSG:3577"))
+
+
+class CountDrill(PolygonDrill):
+    def process_data(self, data, parameters):
+        counts = (data.water > 100).sum(dim="pixel").compute()
+        return pandas.DataFrame({"time": counts.time.data, "count": counts.data})
+
+
+def _dataset(tmp_path, timestamp, values, offset=(1000000.0, -3000000.0)):
+    name = str(uuid.uuid4())
+    meta = write_gtiff(tmp_path / f"{name}.tif", values, crs="EPSG:3577", resolution=(25, -25),
+                       offset=offset, nodata=255)
+    return mk_sample_dataset([dict(name="water", path=f"{name}.tif", layer=1, nodata=255, dtype="uint8")],
+                             uri=(tmp_path / f"{name}.yaml").absolute().as_uri(),
+                             timestamp=timestamp, id=name, geobox=meta.geobox)
+
+
+def _box(tmp_path, product):
+    rng = np.random.default_rng(0)
+    datasets = [_dataset(tmp_path, f"2020-0{month}-01", rng.integers(0, 200, size=(20, 20), dtype="uint8"))
+                for month in range(1, 6)]
+    bag = VirtualDatasetBag(datasets, POLYGON, {"sample": datasets[0].product})
+    return product.group(bag)
+
+
+def _drill(streaming):
+    product = construct(product="sample", measurements=["water"], group_by="time",
+                        output_crs="EPSG:3577", resolution=25)
+    about = {"identifier": "CountDrill", "title": "Count", "streaming": streaming}
+    return CountDrill(about=about, input=product, style={})
+
+
+def test_streaming_matches_full_load(tmp_path):
+    drill = _drill(streaming=False)
+    box = _box(tmp_path, drill.input)
+    expected = drill.drill_box(box, POLYGON, {})
+
+    result = _drill(streaming=True).drill_box(box, POLYGON, {})
+    pandas.testing.assert_frame_equal(result, expected)
+    assert (result["count"] > 0).all()
+
+
+class ClientCountDrill(CountDrill):
+    clients = []
+
+    def reduce_slice(self, data, parameters):
+        self.clients.append(Client.current(allow_global=False))
+        return super().reduce_slice(data, parameters)
+
+
+def test_streaming_runs_on_the_cluster(tmp_path, monkeypatch):
+    monkeypatch.setattr("datacube_wps.processes.stream_slices", lambda: 2)
+    drill = _drill(streaming=False)
+    box = _box(tmp_path, drill.input)
+    expected = drill.drill_box(box, POLYGON, {})
+
+    streaming = ClientCountDrill(about={"identifier": "CountDrill", "title": "Count", "streaming": True},
+                                 input=drill.input, style={})
+    with Client(processes=False, n_workers=1, threads_per_worker=2, dashboard_address=None) as client:
+        with client.as_current():
+            result = streaming.drill_box(box, POLYGON, {})
+    pandas.testing.assert_frame_equal(result, expected)
+    assert streaming.clients == [client] * 5
+
+
+def test_mask_data_keeps_polygon_pixels(tmp_path):
+    drill = _drill(streaming=False)
+    box = _box(tmp_path, drill.input)
+    data = drill.input.fetch(box)
+    mask = geometry_mask(POLYGON, data.geobox, invert=True)
+
+    gathered = drill.mask_data(data, mask)
+    assert gathered.water.dims == ("time", "pixel")
+    assert gathered.sizes["pixel"] == mask.sum()
+    expected = data.water.where(mask).sum(dim=["x", "y"])
+    assert (gathered.water.sum(dim="pixel") == expected).all()
+
+
+def _polygon(x, y, size):
+    return {"type": "Polygon",
+            "coordinates": [[(x, y), (x + size, y - size / 3), (x + size / 2, y - size), (x, y)]]}
+
+
+class ZonalCountDrill(CountDrill):
+    zonal = True
+
+    def process_data(self, data, parameters):
+        counts = zonal_count(data.water > 100, data).compute()
+        return zonal_frame(counts.to_dataset(name="count"), data)
+
+
+class IndexedCountDrill(CountDrill):
+    datasets = []
+
+    def query_bag(self, dc, time, geopolygon):
+        # stands in for the index, datasets overlapping the query polygon
+        datasets = [ds for ds in self.datasets if ds.extent.intersects(geopolygon.to_crs(ds.crs))]
+        return VirtualDatasetBag(datasets, geopolygon, {"sample": self.datasets[0].product})
+
+
+@pytest.mark.parametrize("zonal", [False, True])
+def test_batch_matches_single_drills(tmp_path, monkeypatch, zonal):
+    monkeypatch.setattr("datacube_wps.processes._dask_client", lambda kind, client=None: nullcontext())
+    monkeypatch.setattr("datacube_wps.processes.shared_datacube", nullcontext)
+
+    rng = np.random.default_rng(1)
+    IndexedCountDrill.datasets = [
+        _dataset(tmp_path, f"2020-0{month}-01", rng.integers(0, 200, size=(20, 20), dtype="uint8"), offset=offset)
+        for month in range(1, 4) for offset in [(1000000.0, -3000000.0), (1002000.0, -3000000.0)]
+    ]
+
+    request = {"type": "FeatureCollection", "crs": "EPSG:3577", "features": [
+        {"type": "Feature", "id": "a", "geometry": _polygon(1000010.0, -3000010.0, 300.0)},
+        {"type": "Feature", "id": "b", "geometry": _polygon(1000100.0, -3000100.0, 300.0)},
+        {"type": "Feature", "properties": {"id": "c"}, "geometry": _polygon(1002050.0, -3000050.0, 200.0)},
+    ]}
+    features = [(feature_id, Geometry(geom.json, crs=CRS("EPSG:3577"))) for feature_id, geom in _parse_geoms(request)]
+    assert [feature_id for feature_id, _ in features] == ["a", "b", "c"]
+
+    product = construct(product="sample", measurements=["water"], group_by="time",
+                        output_crs="EPSG:3577", resolution=25)
+    drill_class = type("Drill", (IndexedCountDrill, ZonalCountDrill), {}) if zonal else IndexedCountDrill
+    drill = drill_class(about={"identifier": "CountDrill", "title": "Count"}, input=product, style={})
+
+    result = drill.batch_handler(None, features)
+    assert list(result["feature_id"].unique()) == ["a", "b", "c"]
+    for feature_id, geom in features:
+        expected = drill.drill_box(drill.query_box(None, None, geom), geom, {})
+        single = result[result["feature_id"] == feature_id].drop(columns=["feature_id"]).reset_index(drop=True)
+        pandas.testing.assert_frame_equal(single, expected)
+
+
+def test_scattered_features_are_not_clustered(tmp_path):
+    datasets = [_dataset(tmp_path, "2020-01-01", np.zeros((20, 20), dtype="uint8"))]
+    bag = VirtualDatasetBag(datasets, POLYGON, {"sample": datasets[0].product})
+    geoms = [Geometry(_polygon(x, y, 20.0), crs=CRS("EPSG:3577"))
+             for x, y in [(1000010.0, -3000010.0), (1000470.0, -3000470.0), (1000015.0, -3000015.0)]]
+
+    # the features at opposite corners of the scene are drilled apart, over the scene each
+    clusters = sorted(_cluster_features(bag, geoms))
+    assert clusters == [([0, 2], {datasets[0].id}), ([1], {datasets[0].id})]
+
+    # unless the limit allows for a box that big
+    assert list(_cluster_features(bag, geoms, max_ratio=1000.0)) == [([0, 1, 2], {datasets[0].id})]
@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+from affine import Affine
+from datacube.testutils import mk_sample_dataset
+from datacube.utils.geometry import CRS, GeoBox, Geometry
+from datacube.virtual.impl import VirtualDatasetBag
+
+from datacube_wps.querycache import QueryCache, tile
+
+
+class FakeProduct(dict):
+    def __init__(self, datasets):
+        super().__init__(product="sample")
+        self.datasets = datasets
+        self.queries = 0
+
+    def query(self, dc, time=None, geopolygon=None):
+        self.queries += 1
+        datasets = [ds for ds in self.datasets if ds.extent.intersects(geopolygon.to_crs(ds.crs))]
+        return VirtualDatasetBag(datasets, geopolygon, {"sample": None})
+
+
+def _dataset(index, x):
+    geobox = GeoBox(40, 40, Affine(25, 0, x, 0, -25, -3000000.0), "EPSG:3577")
+    return mk_sample_dataset([{"name": "water"}], id=f"10000000-0000-0000-0000-00000000000{index}", geobox=geobox)
+
+
+def _point(x, y):
+    return Geometry({"type": "Point", "coordinates": (x, y)}, crs=CRS("EPSG:3577"))
+
+
+def test_query_cache_shares_tiles():
+    datasets = [_dataset(1, 1000000.0), _dataset(2, 1001000.0)]
+    product = FakeProduct(datasets)
+    dc = SimpleNamespace()
+    cache = QueryCache(ttl=600, tile_size=0.1)
+
+    first, second = _point(1000500.0, -3000500.0), _point(1001500.0, -3000500.0)
+    assert tile(first, 0.1).boundingbox == tile(second, 0.1).boundingbox
+
+    bag = cache.query(product, dc, ("2000-01-01", "2001-01-01"), first)
+    assert [ds.id for ds in bag.contained_datasets()] == [datasets[0].id]
+    assert bag.geopolygon == first
+    # a nearby drill is answered from the same tile, narrowed down to its own datasets
+    bag = cache.query(product, dc, ("2000-01-01", "2001-01-01"), second)
+    assert [ds.id for ds in bag.contained_datasets()] == [datasets[1].id]
+    assert product.queries == 1
+
+    # another time range is another entry
+    cache.query(product, dc, ("2001-01-01", "2002-01-01"), first)
+    assert product.queries == 2
+
+    # the index is not asked again until the entry expires
+    datasets.append(_dataset(3, 1000000.0))
+    bag = cache.query(product, dc, ("2000-01-01", "2001-01-01"), first)
+    assert product.queries == 2
+    assert len(list(bag.contained_datasets())) == 1
+
+
+def test_query_cache_expires():
+    datasets = [_dataset(1, 1000000.0)]
+    product = FakeProduct(datasets)
+    cache = QueryCache(ttl=1e-9)
+    cache.query(product, SimpleNamespace(), None, _point(1000500.0, -3000500.0))
+    datasets.append(_dataset(2, 1000000.0))
+    bag = cache.query(product, SimpleNamespace(), None, _point(1000500.0, -3000500.0))
+    assert product.queries == 2
+    # datasets indexed in the meantime are found once it has expired
+    assert len(list(bag.contained_datasets())) == 2
@@ -0,0 +1,55 @@
+import os
+import signal
+from concurrent.futures import TimeoutError as FutureTimeout
+
+import pytest
+
+from datacube_wps.render import WARM_SPEC, RenderPool, render_chart
+
+
+@pytest.fixture
+def pool():
+    renderer = RenderPool(workers=1, timeout=120)
+    yield renderer
+    renderer.shutdown()
+
+
+def test_render_pool_matches_in_process(pool):
+    rendered = pool.render(WARM_SPEC, ["svg", "html"])
+    assert rendered["svg"] == render_chart(WARM_SPEC, "svg")
+    assert rendered["html"] == render_chart(WARM_SPEC, "html")
+    assert RenderPool(workers=0).render(WARM_SPEC, ["svg"]) == {"svg": rendered["svg"]}
+
+
+def _pids(renderer):
+    return {worker.process.pid for worker in list(renderer._idle.queue)}
+
+
+def test_render_pool_restarts_broken_worker(pool):
+    pool.render(WARM_SPEC, ["svg"])
+    (pid,) = _pids(pool)
+    os.kill(pid, signal.SIGKILL)
+
+    assert pool.render(WARM_SPEC, ["svg"])["svg"].startswith(b"<svg")
+    assert pid not in _pids(pool)
+
+
+def test_render_pool_times_out_only_its_worker():
+    renderer = RenderPool(workers=2, timeout=120)
+    try:
+        renderer.render(WARM_SPEC, ["svg"])
+        before = _pids(renderer)
+
+        renderer._timeout = 1e-6
+        # the future timeout, which is not the builtin TimeoutError before Python 3.11
+        with pytest.raises(FutureTimeout):
+            renderer.render(WARM_SPEC, ["svg"])
+        after = _pids(renderer)
+        # the worker past its timeout is replaced, the other one is left alone
+        assert len(after) == 2
+        assert len(before & after) == 1
+
+        renderer._timeout = 120
+        assert renderer.render(WARM_SPEC, ["svg"])["svg"].startswith(b"<svg")
+    finally:
+        renderer.shutdown()
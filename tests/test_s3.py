@@ -1,11 +1,21 @@
+import gzip
+import io
+import json
+import os
+
 import altair as alt
 import boto3
+import pandas
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
 import pywps.configuration as config
 from moto import mock_s3
 from vega_datasets import data
 
-from datacube_wps.processes import (upload_chart_html_to_S3,
+from datacube_wps.processes import (_render_outputs, upload_chart_html_to_S3,
                                     upload_chart_svg_to_S3)
+from datacube_wps.publish import PUBLISHER, OutputPublisher
 
 TEST_CHART = chart = (
         alt.Chart(data.cars.url)
@@ -24,6 +34,7 @@ def test_s3_svg_chart_upload():
     location = {'LocationConstraint': region}
     client = boto3.client("s3", region_name=region)
     client.create_bucket(Bucket=bucket, CreateBucketConfiguration=location)
+    PUBLISHER._reset()
     upload_chart_svg_to_S3(TEST_CHART, "abcd")
 
 
@@ -35,4 +46,98 @@ def test_s3_html_chart_upload():
     location = {'LocationConstraint': region}
     client = boto3.client("s3", region_name=region)
     client.create_bucket(Bucket=bucket, CreateBucketConfiguration=location)
+    PUBLISHER._reset()
     upload_chart_html_to_S3(TEST_CHART, "abcd")
+
+
+@mock_s3
+def test_publisher_uploads_concurrently():
+    config.load_configuration(TEST_CFG)
+    bucket = config.get_config_value("s3", "bucket")
+    region = config.get_config_value("s3", "region")
+    client = boto3.client("s3", region_name=region)
+    client.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': region})
+
+    publisher = OutputPublisher()
+    futures = [publisher.submit(f"abcd/{index}.txt", lambda: b"body", "text/plain") for index in range(4)]
+    urls = [future.result() for future in futures]
+
+    assert urls[0].endswith(f"{bucket}.s3.amazonaws.com/abcd/0.txt")
+    assert "?" not in urls[0]
+    assert client.get_object(Bucket=bucket, Key="abcd/3.txt")["Body"].read() == b"body"
+    assert publisher.upload("abcd/private", b"body", public=False) == f"s3://{bucket}/abcd/private"
+
+
+@mock_s3
+def test_render_outputs():
+    config.load_configuration(TEST_CFG)
+    bucket = config.get_config_value("s3", "bucket")
+    region = config.get_config_value("s3", "region")
+    client = boto3.client("s3", region_name=region)
+    client.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': region})
+    PUBLISHER._reset()
+
+    df = pandas.DataFrame({"time": pandas.date_range("2000-01-01", periods=3), "value": [1, 2, 3]})
+    chart = alt.Chart(df).mark_line().encode(x="time:T", y="value:Q")
+    outputs = _render_outputs("abcd", {}, df, chart)
+
+    assert outputs["image"]["data"].endswith("/abcd/chart.svg")
+    assert outputs["url"]["data"].endswith("/abcd/chart.html")
+    assert client.get_object(Bucket=bucket, Key="abcd/chart.svg")["ContentType"] == "image/svg+xml"
+
+
+@mock_s3
+@pytest.mark.parametrize("indexed", [False, True])
+@pytest.mark.parametrize("output_format", ["parquet", "arrow", "json.gz"])
+def test_render_outputs_columnar(output_format, indexed):
+    config.load_configuration(TEST_CFG)
+    bucket = config.get_config_value("s3", "bucket")
+    region = config.get_config_value("s3", "region")
+    client = boto3.client("s3", region_name=region)
+    client.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': region})
+    PUBLISHER._reset()
+
+    df = pandas.DataFrame({"time": pandas.date_range("2000-01-01", periods=3), "value": [1.0, 2.0, 3.0]})
+    # WIT rows are indexed by time
+    written = df.set_index("time") if indexed else df
+    outputs = _render_outputs("abcd", {}, written, None, output_format=output_format, identifier="WIT")
+
+    url = outputs["url"]["data"]
+    assert json.loads(outputs["timeseries"]["data"])["url"] == url
+    key = url[len(f"s3://{bucket}/"):]
+    assert key.startswith("wit/abcd/abcd.")
+    body = client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+    if output_format == "parquet":
+        result = pq.read_table(pa.BufferReader(body)).to_pandas()
+    elif output_format == "arrow":
+        result = pa.ipc.open_file(pa.BufferReader(body)).read_pandas()
+    else:
+        result = pandas.read_json(io.BytesIO(gzip.decompress(body)), orient="records", convert_dates=["time"])
+        written = df
+    pandas.testing.assert_frame_equal(result, written, check_dtype=False, check_freq=False)
+
+
+@mock_s3
+def test_multipart_upload(monkeypatch):
+    # the moto version in use does not decode the default aws-chunked part uploads
+    monkeypatch.setenv("AWS_REQUEST_CHECKSUM_CALCULATION", "when_required")
+    config.load_configuration(TEST_CFG)
+    bucket = config.get_config_value("s3", "bucket")
+    region = config.get_config_value("s3", "region")
+    client = boto3.client("s3", region_name=region)
+    client.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': region})
+    PUBLISHER._reset()
+
+    body = os.urandom(11 * 1024 * 1024)
+    with PUBLISHER.open("abcd/large", public=False) as sink:
+        for start in range(0, len(body), 1000_000):
+            sink.write(body[start:start + 1000_000])
+    assert client.get_object(Bucket=bucket, Key="abcd/large")["Body"].read() == body
+
+    with pytest.raises(RuntimeError):
+        with PUBLISHER.open("abcd/failed", public=False) as sink:
+            sink.write(body)
+            raise RuntimeError("serialization failed")
+    assert "Contents" not in client.list_objects_v2(Bucket=bucket, Prefix="abcd/failed")
+    assert "Uploads" not in client.list_multipart_uploads(Bucket=bucket)
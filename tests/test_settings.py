@@ -0,0 +1,35 @@
+import pytest
+import pywps.configuration as config
+
+from datacube_wps.settings import config_bool, config_number
+
+
+@pytest.fixture
+def section(monkeypatch):
+    config.load_configuration("pywps.cfg")
+    if not config.CONFIG.has_section("test"):
+        config.CONFIG.add_section("test")
+    return lambda option, value: monkeypatch.setitem(config.CONFIG["test"], option, value)
+
+
+def test_config_number(section):
+    section("workers", "3")
+    section("empty", "")
+    assert config_number("test", "workers", 1, int) == 3
+    assert config_number("test", "workers", 1.5) == 3.0
+    assert config_number("test", "empty", 2, int) == 2
+    assert config_number("test", "missing", 2.5) == 2.5
+
+
+@pytest.mark.parametrize("value, expected", [("true", True), ("1", True), ("Yes", True),
+                                             ("false", False), ("0", False), ("off", False)])
+def test_config_bool(section, value, expected):
+    section("flag", value)
+    assert config_bool("test", "flag", not expected) is expected
+    assert config_bool("test", "missing", expected) is expected
+
+
+def test_config_bool_rejects_other_values(section):
+    section("flag", "sometimes")
+    with pytest.raises(ValueError):
+        config_bool("test", "flag", False)
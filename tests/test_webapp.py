@@ -1,8 +1,15 @@
+import uuid
+
+import altair
 import boto3
+import pandas
 import pytest
+import pywps.configuration as config
 from moto import mock_s3
 
 from datacube_wps.impl import create_app
+from datacube_wps.publish import PUBLISHER
+from datacube_wps.render import chart_spec
 
 
 def test_ping(client):
@@ -53,3 +60,49 @@ def test_wofs_webapp(client):
 
     r = client.post('/?service=WPS&request=Execute', headers=headers, data=data)
     assert r.status_code == 200
+
+
+@mock_s3
+def test_deferred_chart(client, monkeypatch):
+    monkeypatch.setenv("WPS_BASEURL", "http://localhost:8000")
+    config.load_configuration("pywps.cfg")
+    monkeypatch.setitem(config.CONFIG["output"], "charts", "deferred")
+    conn = boto3.client('s3', region_name='ap-southeast-2')
+    conn.create_bucket(Bucket='dea-wps-results', CreateBucketConfiguration={'LocationConstraint': 'ap-southeast-2'})
+    PUBLISHER._reset()
+
+    name = str(uuid.uuid4())
+    df = pandas.DataFrame({"time": pandas.date_range("2000-01-01", periods=3), "value": [1, 2, 3]})
+    urls = PUBLISHER.publish_chart(name, chart_spec(altair.Chart(df).mark_line().encode(x="time:T", y="value:Q")))
+    assert urls["svg"].result() == f"http://localhost:8000/charts/{name}/chart.svg"
+    assert conn.list_objects_v2(Bucket='dea-wps-results', Prefix=f"{name}/chart.svg")['KeyCount'] == 0
+
+    r = client.get(f'/charts/{name}/chart.svg')
+    assert r.status_code == 200
+    assert r.content_type == "image/svg+xml"
+    assert r.data.startswith(b"<svg")
+    assert conn.get_object(Bucket='dea-wps-results', Key=f"{name}/chart.svg")["Body"].read() == r.data
+
+    assert client.get(f'/charts/{uuid.uuid4()}/chart.html').status_code == 404
+    assert client.get(f'/charts/{name}/chart.png').status_code == 404
+
+
+def test_ready_after_warm_up():
+    app = create_app()
+    warmup = app.extensions['warmup']
+    calls = []
+    warmup.steps = {"catalog": lambda: calls.append("catalog"), "index": lambda: calls.append("index"),
+                    "dask": lambda: 1 / 0}
+    warmup.state = {step: "pending" for step in warmup.steps}
+
+    client = app.test_client()
+    r = client.get('/ready')
+    assert r.status_code == 503
+    assert r.json["steps"]["index"] == "pending"
+
+    warmup.start().join()
+    r = client.get('/ready')
+    # a failed optional step is reported without holding the worker back
+    assert r.status_code == 200
+    assert r.json["steps"]["dask"].startswith("failed")
+    assert calls == ["catalog", "index"]
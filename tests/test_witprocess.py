@@ -0,0 +1,196 @@
+import numpy as np
+import pandas
+import pytest
+import xarray as xr
+from datacube.utils.geometry import box
+from pywps.app.exceptions import ProcessError
+
+from datacube_wps.processes.witprocess import (WIT, TWnMask,
+                                               aggregate_over_time,
+                                               time_windows)
+
+
+# the original loop based implementation, kept as a reference
+def reference_average_over_day(masked):
+    tmp = xr.Dataset()
+    for var in masked.data_vars:
+        if var != 'water':
+            valid_var = ~(np.abs(masked[var] - masked[var].attrs['nodata']) < 1e-5)
+            tmp[var] = ((masked[var].where(valid_var).sum('time', skipna=False, keep_attrs=True) / masked.time.shape[0])
+                        .fillna(masked[var].attrs['nodata']).astype('float32'))
+        else:
+            tmp[var] = masked[var].astype('int16').sum('time', keep_attrs=True).astype('int16')
+        tmp[var].attrs = masked[var].attrs
+
+    tmp = tmp.expand_dims(time=masked.time[0:1], axis=0)
+    tmp.attrs = masked.attrs
+    return tmp
+
+
+def reference_aggregate_data(masked):
+    tmp = masked[dict(time=[0])].copy(deep=True)
+    for time in masked.time.data[1:]:
+        for var in masked.data_vars:
+            if var != 'water':
+                valid_var = ~(np.abs(tmp[var] - masked[var].attrs['nodata']) < 1e-5) | tmp.water > 0
+            else:
+                valid_var = ~(np.abs(tmp.TCW - masked.TCW.attrs['nodata']) < 1e-5) | tmp.water > 0
+            tmp[var] = tmp[var].where(valid_var, 0) + masked[var].sel(time=time).where(~valid_var, 0)
+            tmp[var].attrs = masked[var].attrs
+    return tmp
+
+
+def reference_aggregate_over_time(masked, days):
+    i_start = 0
+    i_end = i_start + 1
+    aggregated = None
+    while i_end < masked.time.size:
+        time = masked.time.data[i_start]
+        while np.abs(time - masked.time.data[i_end]).astype('timedelta64[D]') < np.timedelta64(days, 'D'):
+            i_end += 1
+            if i_end >= masked.time.size:
+                break
+        if days > 1:
+            tmp = reference_aggregate_data(masked[dict(time=np.arange(i_start, i_end))])
+        else:
+            tmp = reference_average_over_day(masked[dict(time=np.arange(i_start, i_end))])
+        if aggregated is None:
+            aggregated = tmp
+        else:
+            aggregated = xr.concat([aggregated, tmp], dim='time')
+        i_start = i_end
+        i_end = i_start + 1
+    return aggregated
+
+
+def _masked(n_times, n_pixels=40, seed=0, independent=False):
+    rng = np.random.default_rng(seed)
+    offsets = np.cumsum(rng.integers(1, 40, size=n_times)) * np.timedelta64(6, 'h')
+    times = np.datetime64('2000-01-01T00:00:00', 'ns') + offsets
+
+    # each pixel is either clear, wet or cloudy, and bands are masked together
+    state = rng.choice(3, size=(n_times, n_pixels), p=[0.5, 0.2, 0.3])
+    shape = state.shape
+
+    def clear():
+        # or each band has its nodata of its own, regardless of the water observed
+        return rng.random(shape) < 0.5 if independent else state == 0
+
+    fc = {name: np.where(clear(), rng.integers(0, 100, size=shape), 255).astype('uint8')
+          for name in ['bs', 'pv', 'npv']}
+    tcw = np.where(clear(), rng.uniform(-1000, 0, size=shape), -9999).astype('float32')
+    water = (state == 1).astype('int16')
+
+    dims = ('time', 'pixel')
+    return xr.Dataset({
+        **{name: xr.DataArray(values, dims=dims, attrs={'nodata': 255}) for name, values in fc.items()},
+        'TCW': xr.DataArray(tcw, dims=dims, attrs={'nodata': -9999}),
+        'water': xr.DataArray(water, dims=dims, attrs={'nodata': 0}),
+    }, coords={'time': times}, attrs={'crs': 'EPSG:3577'})
+
+
+def test_time_windows():
+    times = pandas.to_datetime(['2000-01-01', '2000-01-03', '2000-01-04', '2000-01-06', '2000-01-20']).values
+    starts, labels = time_windows(times, 3)
+    assert list(starts) == [0, 2, 4]
+    assert list(labels) == [0, 0, 1, 1, 2]
+
+
+@pytest.mark.parametrize('independent', [False, True])
+@pytest.mark.parametrize('days', [1, 3, 10])
+def test_aggregate_over_time_matches_reference(days, independent):
+    masked = _masked(60, independent=independent)
+    expected = reference_aggregate_over_time(masked, days)
+    result = aggregate_over_time(masked, days)
+
+    # the reference drops a final window holding a single observation
+    assert result.time.size in (expected.time.size, expected.time.size + 1)
+    head = result.isel(time=slice(0, expected.time.size))
+    assert (head.time.data == expected.time.data).all()
+    for var in masked.data_vars:
+        np.testing.assert_allclose(head[var].values, expected[var].transpose('time', 'pixel').values, rtol=1e-6)
+        assert head[var].attrs == masked[var].attrs
+
+
+@pytest.mark.parametrize('days', [0, 5])
+def test_wit_by_zone_matches_single_polygons(days):
+    masked = _masked(30)
+    # mostly valid pixels, so that some rows pass the 90% valid area threshold
+    masked['TCW'] = masked.TCW.where(masked.TCW != -9999, -500)
+    labels = np.arange(masked.sizes['pixel']) % 3
+    zoned = masked.assign_coords(zone=xr.DataArray(labels, dims='pixel', attrs={'zones': 3}))
+    features = [box(zone, 0, zone + 1, 1, crs='EPSG:3577') for zone in range(3)]
+    drill = WIT(about={'identifier': 'WIT', 'title': 'WIT'}, input=None, style={})
+
+    result = drill.process_data(zoned, {'aggregate': days, 'features': features})
+    assert len(result)
+    for zone, feature in enumerate(features):
+        expected = drill.process_data(masked.isel(pixel=labels == zone), {'aggregate': days, 'feature': feature})
+        pandas.testing.assert_frame_equal(result[result['zone'] == zone].drop(columns='zone'), expected)
+
+
+def test_wit_tables_are_returned_by_url():
+    drill = WIT(about={'identifier': 'WIT', 'title': 'WIT'}, input=None, style={})
+    assert drill.output_format == 'parquet'
+    # WIT has no timeseries output to embed a csv table in
+    with pytest.raises(ProcessError):
+        drill.check_output_format('csv')
+    with pytest.raises(ProcessError):
+        WIT(about={'identifier': 'WIT', 'title': 'WIT', 'output_format': 'csv'}, input=None, style={})
+
+
+def test_aggregate_over_time_with_dask():
+    masked = _masked(30)
+    expected = aggregate_over_time(masked, 5)
+    result = aggregate_over_time(masked.chunk({'time': 1}), 5)
+    xr.testing.assert_allclose(result.compute(), expected)
+
+
+def reference_twn_mask(twn, data):
+    tci_var = 0
+    for key in twn.coeffs[twn.category].keys():
+        nodata = getattr(data[key], 'nodata', -1)
+        band = data[key].where(data[key] > nodata)
+        tci_var += band * twn.coeffs[twn.category][key]
+    tci_var.data[np.isnan(tci_var.data)] = -9999
+    tci_var = tci_var.astype(np.float32)
+
+    water_value = (((data.water & (1 << 7)) != 0)
+                   & (((data.water & (1 << 6)) | (data.water & (1 << 5)) | (data.water & (1 << 1))
+                       | (data.water & 1)) == 0)).astype('int16')
+    pmask = (((data.fmask != 2) & (data.fmask != 3) & (data.fmask != 0) & (data.nbart_contiguity == 1))
+             & (((data.water & (1 << 7)) | (data.water & (1 << 6)) | (data.water & (1 << 5))
+                 | (data.water & (1 << 1)) | (data.water & 1)) == 0))
+    return tci_var, water_value, pmask
+
+
+def _ard(seed=0):
+    rng = np.random.default_rng(seed)
+    shape = (3, 16, 16)
+    dims = ('time', 'y', 'x')
+
+    def band():
+        values = rng.integers(-999, 5000, size=shape).astype('int16')
+        values[rng.random(shape) < 0.1] = -999
+        return xr.DataArray(values, dims=dims, attrs={'nodata': -999})
+
+    return xr.Dataset({
+        **{name: band() for name in ['blue', 'green', 'red', 'nir', 'swir1', 'swir2']},
+        'fmask': xr.DataArray(rng.integers(0, 6, size=shape).astype('uint8'), dims=dims),
+        'nbart_contiguity': xr.DataArray(rng.integers(0, 2, size=shape).astype('uint8'), dims=dims),
+        'water': xr.DataArray(rng.choice([0, 1, 2, 64, 128, 130, 132, 192], size=shape).astype('uint8'), dims=dims),
+    }, attrs={'crs': 'EPSG:3577'})
+
+
+@pytest.mark.parametrize('chunks', [None, {'time': 1, 'y': 8}])
+def test_twn_mask_matches_reference(chunks):
+    data = _ard()
+    twn = TWnMask()
+    tci, water, pmask = reference_twn_mask(twn, data)
+
+    result = twn.compute(data if chunks is None else data.chunk(chunks)).compute()
+    assert result.TCW.dtype == np.float32
+    np.testing.assert_allclose(result.TCW.values, tci.values, rtol=1e-5, atol=1e-2)
+    assert (result.water.values == water.values).all()
+    assert result.water.dtype == np.int16
+    assert (result.pmask.values == pmask.values).all()
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas
+import xarray
+
+from datacube_wps.processes.wofsdrill import (OBSERVATIONS, WOFS_RULES,
+                                              WOfSDrill, classify_flags,
+                                              wofs_classifier)
+
+WOFS_FLAGS = {
+    'dry': {'bits': [7, 6, 5, 4, 3, 2, 1, 0], 'values': {0: True}},
+    'nodata': {'bits': 0, 'values': {1: True}},
+    'noncontiguous': {'bits': 1, 'values': {0: False, 1: True}},
+    'sea': {'bits': 2, 'values': {0: False, 1: True}},
+    'terrain_or_low_angle': {'bits': 3, 'values': {0: False, 1: True}},
+    'high_slope': {'bits': 4, 'values': {0: False, 1: True}},
+    'cloud_shadow': {'bits': 5, 'values': {0: False, 1: True}},
+    'cloud': {'bits': 6, 'values': {0: False, 1: True}},
+    'wet': {'bits': [7, 6, 5, 4, 3, 2, 1, 0], 'values': {128: True}},
+}
+
+
+def test_classifier_matches_rules():
+    values = np.arange(256)
+    expected = np.vectorize(lambda v: classify_flags(WOFS_FLAGS, WOFS_RULES, v))(values)
+
+    codes = wofs_classifier(WOFS_FLAGS)(values)
+    assert (np.array(OBSERVATIONS)[codes] == expected).all()
+
+
+def test_process_data_is_categorical():
+    water = np.array([0, 128, 64, 4, 132, 1], dtype='uint8')
+    times = pandas.date_range('2000-01-01', periods=len(water))
+    data = xarray.Dataset({
+        'water': xarray.DataArray(water.reshape(-1, 1, 1),
+                                  dims=('time', 'longitude', 'latitude'),
+                                  coords={'time': times, 'longitude': [140.0], 'latitude': [-30.0]},
+                                  attrs={'flags_definition': WOFS_FLAGS})
+    })
+    drill = WOfSDrill(about={'identifier': 'WOfSDrill', 'title': 'WOfS'}, input=None, style={})
+
+    df = drill.process_data(data, {})
+    assert isinstance(df['observation'].dtype, pandas.CategoricalDtype)
+    assert list(df['observation']) == ['dry', 'wet', 'not observable', 'wet', 'wet', 'not observable']
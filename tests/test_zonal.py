@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import xarray
+
+from datacube_wps.zonal import (gather_zones, zonal_frame, zonal_histogram,
+                                zonal_mean, zonal_sum)
+
+
+def _zoned(seed=0, zones=5):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, zones, size=200)
+    values = rng.uniform(0, 10, size=(3, labels.size))
+    values[rng.random(values.shape) < 0.1] = np.nan
+    data = xarray.Dataset({
+        'value': (('time', 'pixel'), values),
+        'code': (('time', 'pixel'), rng.integers(-1, 5, size=values.shape)),
+    }, coords={'time': np.arange(3).astype('datetime64[D]')})
+    zone = xarray.DataArray(labels, dims='pixel', attrs={'zones': zones + 1})
+    return data.assign_coords(zone=zone), labels
+
+
+@pytest.mark.parametrize('chunks', [None, {'time': 1, 'pixel': 64}])
+def test_zonal_statistics_match_per_zone(chunks):
+    data, labels = _zoned()
+    zoned = data if chunks is None else data.chunk(chunks)
+
+    sums = zonal_sum(zoned.value, data).compute()
+    means = zonal_mean(zoned.value, data).compute()
+    histogram = zonal_histogram(zoned.code, data, bins=3).compute()
+    # the last zone has no pixels
+    assert sums.sizes['zone'] == 6
+    for zone in range(6):
+        inside = data.isel(pixel=labels == zone)
+        np.testing.assert_allclose(sums.sel(zone=zone), inside.value.sum('pixel'))
+        if inside.sizes['pixel']:
+            np.testing.assert_allclose(means.sel(zone=zone), inside.value.mean('pixel'))
+        for code in range(3):
+            assert (histogram.sel(zone=zone, bin=code) == (inside.code == code).sum('pixel')).all()
+
+
+def test_gather_zones_repeats_overlapping_pixels():
+    data = xarray.Dataset({'value': (('time', 'y', 'x'), np.arange(2 * 4 * 4).reshape(2, 4, 4))},
+                          coords={'time': np.arange(2).astype('datetime64[D]')})
+    pixels = [(np.array([0, 1]), np.array([0, 1])), (np.array([1, 3]), np.array([1, 2]))]
+    gathered = gather_zones(data, pixels, dims=('y', 'x'))
+    assert list(gathered.zone.values) == [0, 0, 1, 1]
+
+    df = zonal_frame(zonal_sum(gathered.value, gathered).to_dataset(name='value'), gathered)
+    assert list(df.columns) == ['zone', 'time', 'value']
+    assert list(df['value']) == [0 + 5, 16 + 21, 5 + 14, 21 + 30]